@@ -0,0 +1,266 @@
+# A stand-in for a ServiceX instance and its minio object store, so the whole library can be
+# run end to end on one machine, with no network and no real transforms. Both speak just
+# enough http for the library's own clients (aiohttp for ServiceX, and the minio client or
+# aiohttp for the object store).
+import asyncio
+from email.utils import formatdate
+import hashlib
+import os
+import tempfile
+import threading
+import time
+from typing import Any, Dict, List, Optional
+import uuid
+from xml.sax.saxutils import escape
+
+from aiohttp import web
+import numpy as np
+import uproot
+
+_s3_namespace = 'http://s3.amazonaws.com/doc/2006-03-01/'
+
+# Number of entries in each basket of the ROOT files
+_basket_entries = 10000
+
+
+class Scenario:
+    'What the fake ServiceX produces for each transform, and how quickly'
+    def __init__(self, name: str, files: int = 4, entries_per_file: int = 100000,
+                 columns: int = 4, queue_delay: float = 0.0, transform_delay: float = 0.0,
+                 object_latency: float = 0.0, bandwidth: Optional[float] = None):
+        '''
+        Arguments:
+            name                Used to label the results
+            files               Number of files each transform writes
+            entries_per_file    Number of entries in the tree in each file
+            columns             Number of float64 columns in the tree (there is also an int64
+                                `EventNumber` column)
+            queue_delay         Seconds after a transform is submitted before it starts
+            transform_delay     Seconds it takes to produce each file, one after the other
+            object_latency      Seconds the object store waits before answering any request
+            bandwidth           Bytes per second each object download is limited to. None means
+                                as fast as possible.
+        '''
+        self.name = name
+        self.files = files
+        self.entries_per_file = entries_per_file
+        self.columns = columns
+        self.queue_delay = queue_delay
+        self.transform_delay = transform_delay
+        self.object_latency = object_latency
+        self.bandwidth = bandwidth
+
+    def to_dict(self) -> Dict[str, Any]:
+        return dict(self.__dict__)
+
+    @classmethod
+    def from_dict(cls, info: Dict[str, Any]) -> 'Scenario':
+        return cls(**info)
+
+
+def make_root_file(entries: int, columns: int, seed: int = 0) -> bytes:
+    '''
+    Build a ROOT file that looks like a ServiceX result: one tree with `EventNumber` and
+    `columns` random float64 branches. Returns the contents of the file.
+    '''
+    rng = np.random.RandomState(seed)
+    branches = {'EventNumber': np.arange(entries, dtype=np.int64)}
+    for i in range(columns):
+        branches[f'col{i}'] = rng.normal(size=entries)
+
+    fd, path = tempfile.mkstemp(suffix='.root')
+    os.close(fd)
+    try:
+        with uproot.recreate(path) as f_out:
+            f_out['servicex'] = uproot.newtree({name: c.dtype for name, c in branches.items()})
+            # Write it in baskets of a realistic size, rather than one per branch.
+            for start in range(0, entries, _basket_entries):
+                f_out['servicex'].extend({name: c[start:start + _basket_entries]
+                                          for name, c in branches.items()})
+        with open(path, 'rb') as f_in:
+            return f_in.read()
+    finally:
+        os.remove(path)
+
+
+class _Transform:
+    'One submitted transform, which produces its files as time goes by'
+    def __init__(self, request_id: str, scenario: Scenario):
+        self.request_id = request_id
+        self.scenario = scenario
+        self.submitted = time.time()
+        self.object_names = [f'{request_id}_{i:05}.root' for i in range(scenario.files)]
+
+    def files_processed(self) -> int:
+        running_for = time.time() - self.submitted - self.scenario.queue_delay
+        if running_for < 0:
+            return 0
+        if self.scenario.transform_delay <= 0:
+            return self.scenario.files
+        return min(self.scenario.files, int(running_for / self.scenario.transform_delay))
+
+
+class FakeServiceX:
+    '''
+    Run the fake ServiceX web API and object store on localhost, on a background thread with
+    its own event loop. Use as a context manager, or call `start` and `stop`.
+    '''
+    def __init__(self, scenario: Scenario):
+        self.scenario = scenario
+        self._data = make_root_file(scenario.entries_per_file, scenario.columns)
+        self._etag = hashlib.md5(self._data).hexdigest()
+        self._transforms = {}  # type: Dict[str, _Transform]
+        self._loop = None  # type: Optional[asyncio.AbstractEventLoop]
+        self._runners: List[web.AppRunner] = []
+        self._thread = None  # type: Optional[threading.Thread]
+        self.servicex_endpoint = ''
+        self.minio_endpoint = ''
+
+        # Number of transforms submitted, and object bytes sent, so far
+        self.transforms_submitted = 0
+        self.bytes_sent = 0
+
+    @property
+    def file_size(self) -> int:
+        'The size, in bytes, of each file the transforms produce'
+        return len(self._data)
+
+    def __enter__(self) -> 'FakeServiceX':
+        self.start()
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.stop()
+
+    def start(self) -> None:
+        'Start the servers and wait until they are listening'
+        self._loop = asyncio.new_event_loop()
+        ready = threading.Event()
+
+        def run():
+            asyncio.set_event_loop(self._loop)
+            self._loop.run_until_complete(self._start_servers())
+            ready.set()
+            self._loop.run_forever()
+
+        self._thread = threading.Thread(target=run, daemon=True)
+        self._thread.start()
+        ready.wait()
+
+    def stop(self) -> None:
+        'Stop the servers'
+        asyncio.run_coroutine_threadsafe(self._stop_servers(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+
+    async def _serve(self, app: web.Application) -> str:
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, '127.0.0.1', 0).start()
+        self._runners.append(runner)
+        host, port = runner.addresses[0][:2]
+        return f'{host}:{port}'
+
+    async def _start_servers(self) -> None:
+        servicex = web.Application()
+        servicex.router.add_post('/servicex/transformation', self._submit)
+        servicex.router.add_get('/servicex/transformation/{request_id}/status', self._status)
+        address = await self._serve(servicex)
+        self.servicex_endpoint = f'http://{address}/servicex'
+
+        minio = web.Application()
+        minio.router.add_get('/{bucket}', self._list_objects)
+        minio.router.add_get('/{bucket}/', self._list_objects)
+        minio.router.add_get('/{bucket}/{object_name}', self._get_object)
+        self.minio_endpoint = await self._serve(minio)
+
+    async def _stop_servers(self) -> None:
+        for runner in self._runners:
+            await runner.cleanup()
+
+    # The ServiceX web API
+
+    async def _submit(self, request: web.Request) -> web.Response:
+        await request.json()
+        request_id = str(uuid.uuid4())
+        self._transforms[request_id] = _Transform(request_id, self.scenario)
+        self.transforms_submitted += 1
+        return web.json_response({'request_id': request_id})
+
+    async def _status(self, request: web.Request) -> web.Response:
+        transform = self._transforms.get(request.match_info['request_id'])
+        if transform is None:
+            return web.json_response({'message': 'Unknown request id'}, status=404)
+        processed = transform.files_processed()
+        return web.json_response({'request-id': transform.request_id,
+                                  'files-processed': processed,
+                                  'files-remaining': self.scenario.files - processed,
+                                  'files-skipped': 0})
+
+    # The object store (a tiny part of the S3 API)
+
+    async def _list_objects(self, request: web.Request) -> web.Response:
+        await asyncio.sleep(self.scenario.object_latency)
+        bucket = request.match_info['bucket']
+        transform = self._transforms.get(bucket)
+        if transform is None:
+            return self._s3_error('NoSuchBucket', bucket, 404)
+        start_after = request.query.get('start-after', '')
+        names = [n for n in transform.object_names[:transform.files_processed()]
+                 if n > start_after]
+        modified = time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime(transform.submitted))
+        contents = ''.join(f'<Contents><Key>{escape(n)}</Key>'
+                           f'<LastModified>{modified}</LastModified>'
+                           f'<ETag>&quot;{self._etag}&quot;</ETag>'
+                           f'<Size>{len(self._data)}</Size>'
+                           f'<StorageClass>STANDARD</StorageClass></Contents>'
+                           for n in names)
+        body = (f'<?xml version="1.0" encoding="UTF-8"?>'
+                f'<ListBucketResult xmlns="{_s3_namespace}"><Name>{escape(bucket)}</Name>'
+                f'<Prefix></Prefix><KeyCount>{len(names)}</KeyCount><MaxKeys>1000</MaxKeys>'
+                f'<IsTruncated>false</IsTruncated>{contents}</ListBucketResult>')
+        return web.Response(body=body.encode('utf-8'), content_type='application/xml')
+
+    def _s3_error(self, code: str, resource: str, status: int) -> web.Response:
+        body = (f'<?xml version="1.0" encoding="UTF-8"?><Error><Code>{code}</Code>'
+                f'<Message>{code}</Message><Resource>{escape(resource)}</Resource>'
+                f'<RequestId>0</RequestId><HostId>0</HostId></Error>')
+        return web.Response(body=body.encode('utf-8'), status=status,
+                            content_type='application/xml')
+
+    async def _get_object(self, request: web.Request) -> web.StreamResponse:
+        await asyncio.sleep(self.scenario.object_latency)
+        transform = self._transforms.get(request.match_info['bucket'])
+        object_name = request.match_info['object_name']
+        if transform is None or object_name not in transform.object_names:
+            return self._s3_error('NoSuchKey', object_name, 404)
+
+        start, stop, status = 0, len(self._data), 200
+        headers = {'ETag': f'"{self._etag}"', 'Accept-Ranges': 'bytes',
+                   'Last-Modified': formatdate(transform.submitted, usegmt=True),
+                   'Content-Type': 'application/octet-stream'}
+        range_header = request.headers.get('Range')
+        if range_header is not None and range_header.startswith('bytes='):
+            first, _, last = range_header[len('bytes='):].partition('-')
+            start = int(first)
+            stop = min(len(self._data), int(last) + 1) if last != '' else len(self._data)
+            status = 206
+            headers['Content-Range'] = f'bytes {start}-{stop - 1}/{len(self._data)}'
+        headers['Content-Length'] = str(stop - start)
+
+        response = web.StreamResponse(status=status, headers=headers)
+        await response.prepare(request)
+        if request.method == 'HEAD':
+            return response
+
+        # Send the data in blocks, pausing between them to keep to the bandwidth.
+        block_size = 256 * 1024
+        for block_start in range(start, stop, block_size):
+            block = self._data[block_start:min(stop, block_start + block_size)]
+            await response.write(block)
+            self.bytes_sent += len(block)
+            if self.scenario.bandwidth is not None:
+                await asyncio.sleep(len(block) / self.scenario.bandwidth)
+        await response.write_eof()
+        return response
@@ -0,0 +1,295 @@
+# Time `get_data` end to end against the fake ServiceX in `fake_servicex.py`, and save the
+# results so they can be compared between commits.
+#
+#   python -m benchmarks.run_benchmarks                      # run everything, save the results
+#   python -m benchmarks.run_benchmarks -s many-small-files  # just one scenario
+#   python -m benchmarks.run_benchmarks --compare benchmarks/results/<old commit>.json
+#   python -m benchmarks.run_benchmarks --setting servicex_download_method="'aiohttp'"
+#
+# Each run of a query happens in a fresh process, so its peak memory is its own.
+import argparse
+import ast
+import json
+import multiprocessing
+import os
+import platform
+import queue
+import statistics
+import subprocess
+import sys
+import time
+import traceback
+from typing import Any, Dict, List, Optional
+
+from .fake_servicex import FakeServiceX, Scenario
+
+try:
+    import resource
+except ImportError:  # pragma: no cover
+    # Not available on Windows - peak memory is not measured there.
+    resource = None
+
+# The standard set of scenarios. Each one stresses a different part of a query.
+scenarios = [
+    Scenario('one-large-file', files=1, entries_per_file=4000000),
+    Scenario('many-small-files', files=100, entries_per_file=10000),
+    Scenario('several-files', files=8, entries_per_file=500000),
+    Scenario('slow-transform', files=10, entries_per_file=100000, queue_delay=1.0,
+             transform_delay=0.25),
+    Scenario('slow-object-store', files=10, entries_per_file=250000, object_latency=0.05,
+             bandwidth=50 * 1024 * 1024),
+]
+
+# Measurements where a larger number is better. For all the others, smaller is better.
+_larger_is_better = ('bytes_per_second', 'entries_per_second')
+
+# Seconds between checks that the process running a query is still alive
+_poll_interval = 1.0
+
+
+class BenchmarkError(Exception):
+    'A run of a scenario failed, hung, or died without sending back its measurements'
+
+
+def _run_query(scenario_info: Dict[str, Any], servicex_endpoint: str, minio_endpoint: str,
+               data_type: str, settings: Dict[str, Any], results: Any) -> None:
+    'Run one query and send back what was measured, or why it failed. Runs in its own process.'
+    try:
+        results.put(_measure_query(scenario_info, servicex_endpoint, minio_endpoint, data_type,
+                                   settings))
+    except BaseException:
+        # `ServiceX_Exception` is not an `Exception`.
+        results.put({'error': traceback.format_exc()})
+
+
+def _measure_query(scenario_info: Dict[str, Any], servicex_endpoint: str, minio_endpoint: str,
+                   data_type: str, settings: Dict[str, Any]) -> Dict[str, Any]:
+    'Run one query and return what was measured'
+    import servicex
+    import servicex.servicex as sx
+
+    # Measure the work of running the query, not the local cache or journal.
+    sx.query_journal = None
+    for name, value in settings.items():
+        setattr(sx, name, value)
+
+    adaptor = servicex.ServiceXAdaptor(servicex_endpoint, minio_endpoint=minio_endpoint)
+    stats = servicex.QueryStats()
+    first_result = []  # type: List[float]
+
+    def event_hook(event: str, info: Dict[str, Any]) -> None:
+        if event == 'decode' and len(first_result) == 0:
+            first_result.append(info['end'])
+
+    start = time.time()
+    r = servicex.get_data('(benchmark)', scenario_info['name'], data_type=data_type,
+                          use_cache=False, servicex_adaptor=adaptor, stats=stats,
+                          event_hook=event_hook)
+    wall_time = time.time() - start
+    entries = len(next(iter(r.values()))) if data_type == 'awkward' else len(r)
+    del r
+
+    adaptor.close()
+
+    # ru_maxrss is in kilobytes on linux, and bytes on MacOS.
+    peak_rss = None
+    if resource is not None:
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        peak_rss = peak_rss if sys.platform == 'darwin' else peak_rss * 1024
+
+    return {
+        'wall_time': wall_time,
+        'time_to_first_result': None if len(first_result) == 0 else first_result[0] - start,
+        'bytes_per_second': stats.bytes_downloaded / wall_time,
+        'entries_per_second': entries / wall_time,
+        'peak_rss': peak_rss,
+        'phases': stats.phases,
+    }
+
+
+def _wait_for_run(p: Any, results: Any, timeout: float) -> Dict[str, Any]:
+    '''
+    Wait for the process `p` to send back its measurements. Raises `BenchmarkError` if the run
+    failed, if the process dies without sending anything (e.g. it crashed or ran out of
+    memory), or if it takes longer than `timeout` seconds (and then stops it).
+    '''
+    give_up = time.time() + timeout
+    while True:
+        try:
+            run = results.get(timeout=_poll_interval)
+            break
+        except queue.Empty:
+            pass
+        if not p.is_alive():
+            # It may have sent its measurements just before it exited.
+            try:
+                run = results.get(timeout=_poll_interval)
+                break
+            except queue.Empty:
+                raise BenchmarkError(f'The query process exited with code {p.exitcode} '
+                                     'without sending back any measurements')
+        if time.time() > give_up:
+            p.terminate()
+            raise BenchmarkError(f'The query took more than {timeout} seconds')
+
+    if 'error' in run:
+        raise BenchmarkError(f'The query failed:\n{run["error"]}')
+    return run
+
+
+def run_scenario(scenario: Scenario, repeat: int = 3, data_type: str = 'pandas',
+                 settings: Optional[Dict[str, Any]] = None,
+                 timeout: float = 3600.0) -> Dict[str, Any]:
+    '''
+    Run the query for a scenario several times, each in a new process. Raises
+    `BenchmarkError` if any of the runs fails.
+
+    Arguments:
+        scenario            What the fake ServiceX should produce
+        repeat              Number of times to run the query
+        data_type           Passed to `get_data`
+        settings            Module level settings in `servicex.servicex` to change, by name
+        timeout             Seconds a run can take before it is stopped, and counted as failed
+
+    Returns:
+        result              The scenario, and the median and best of each measurement
+    '''
+    context = multiprocessing.get_context('spawn')
+    runs = []
+    with FakeServiceX(scenario) as fake:
+        for _ in range(repeat):
+            results = context.Queue()
+            p = context.Process(target=_run_query,
+                                args=(scenario.to_dict(), fake.servicex_endpoint,
+                                      fake.minio_endpoint, data_type, settings or {}, results))
+            p.start()
+            try:
+                run = _wait_for_run(p, results, timeout)
+            finally:
+                p.join()
+            runs.append(run)
+
+    summary = {}
+    for name in runs[0]:
+        if name == 'phases':
+            continue
+        values = [r[name] for r in runs if r[name] is not None]
+        if len(values) == 0:
+            continue
+        best = max(values) if name in _larger_is_better else min(values)
+        summary[name] = {'median': statistics.median(values), 'best': best}
+    phases = {p: statistics.median([r['phases'].get(p, 0.0) for r in runs])
+              for p in runs[0]['phases']}
+    return {'scenario': scenario.to_dict(), 'file_size': fake.file_size,
+            'measurements': summary, 'phases': phases}
+
+
+def _git_commit() -> Optional[str]:
+    'The commit the library is at, if we can tell'
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                       cwd=os.path.dirname(__file__),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(old: Dict[str, Any], new: Dict[str, Any], threshold: float) -> List[str]:
+    '''
+    Print how the median of each measurement changed between two sets of results, and return
+    a description of each one that got worse by more than `threshold` (a fraction).
+    '''
+    regressions = []
+    old_results = {r['scenario']['name']: r for r in old['results']}
+    for r in new['results']:
+        name = r['scenario']['name']
+        if name not in old_results:
+            continue
+        for measurement, values in r['measurements'].items():
+            old_values = old_results[name]['measurements'].get(measurement)
+            if old_values is None or old_values['median'] == 0:
+                continue
+            change = values['median'] / old_values['median'] - 1.0
+            worse = -change if measurement in _larger_is_better else change
+            flag = ' <-- worse' if worse > threshold else ''
+            print(f'{name:20} {measurement:22} {old_values["median"]:12.4g} -> '
+                  f'{values["median"]:12.4g} ({change:+.1%}){flag}')
+            if worse > threshold:
+                regressions.append(f'{name} {measurement} {change:+.1%}')
+    return regressions
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description='Benchmark get_data against a fake ServiceX')
+    parser.add_argument('-s', '--scenario', action='append',
+                        help='Only run this scenario (can be given more than once)')
+    parser.add_argument('-n', '--repeat', type=int, default=3,
+                        help='Number of times to run each query')
+    parser.add_argument('--data-type', default='pandas', help='pandas, awkward, or arrow')
+    parser.add_argument('--setting', action='append', default=[],
+                        help='name=value of a servicex.servicex setting, value a python literal')
+    parser.add_argument('-o', '--output', help='File to save the results in. Defaults to '
+                        'benchmarks/results/<commit>.json')
+    parser.add_argument('--compare', help='Results file from an earlier run to compare with')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='Fraction a measurement can get worse by before it is flagged')
+    parser.add_argument('--timeout', type=float, default=3600.0,
+                        help='Seconds a run of a query can take before it counts as failed')
+    args = parser.parse_args(argv)
+
+    settings = {}
+    for s in args.setting:
+        name, _, value = s.partition('=')
+        settings[name] = ast.literal_eval(value)
+
+    to_run = [s for s in scenarios if args.scenario is None or s.name in args.scenario]
+    if len(to_run) == 0:
+        parser.error(f'No scenario called {args.scenario}')
+
+    results = []
+    failed = []
+    for s in to_run:
+        print(f'Running {s.name}...', flush=True)
+        try:
+            r = run_scenario(s, repeat=args.repeat, data_type=args.data_type, settings=settings,
+                             timeout=args.timeout)
+        except BenchmarkError as e:
+            print(f'    {s.name} failed: {e}', flush=True)
+            failed.append(s.name)
+            continue
+        for measurement, values in r['measurements'].items():
+            print(f'    {measurement:22} {values["median"]:12.4g}')
+        results.append(r)
+
+    commit = _git_commit()
+    output = {
+        'commit': commit,
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'data_type': args.data_type,
+        'settings': settings,
+        'results': results,
+        'failed': failed,
+    }
+    path = args.output or os.path.join(os.path.dirname(__file__), 'results',
+                                       f'{commit or "unknown"}.json')
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, 'w') as f_out:
+        json.dump(output, f_out, indent=2)
+    print(f'Results saved to {path}')
+    if len(failed) > 0:
+        print(f'{len(failed)} scenarios failed: {", ".join(failed)}')
+        return 1
+
+    if args.compare is not None:
+        with open(args.compare, 'r') as f_in:
+            regressions = compare(json.load(f_in), output, args.threshold)
+        if len(regressions) > 0:
+            print(f'{len(regressions)} measurements got worse: {", ".join(regressions)}')
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1 +1,10 @@
-from .servicex import get_data_async, get_data, ServiceX_Exception  # NOQA
+from .servicex import get_data_async, get_data, get_data_stream_async, get_data_stream  # NOQA
+from .servicex import ServiceX_Exception, invalidate_cache  # NOQA
+from .cache import QueryCache  # NOQA
+from .dask_results import get_data_dask_async, get_data_dask  # NOQA
+from .instrumentation import opentelemetry_hook, QueryStats  # NOQA
+from .journal import QueryJournal  # NOQA
+from .lazy import get_data_lazy_async, get_data_lazy, LazyResult  # NOQA
+from .shared_cache import SharedFileCache  # NOQA
+from .sizing import TransformHistory  # NOQA
+from .servicex_adaptor import ServiceXAdaptor, TransformStatusChannel  # NOQA
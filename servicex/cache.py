@@ -0,0 +1,219 @@
+# Local on-disk caching of query results
+import getpass
+import hashlib
+import json
+import os
+import pickle
+import tempfile
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+
+def query_cache_key(json_query: Dict[str, Any], data_type: str,
+                    columns: Optional[List[str]] = None,
+                    dtypes: Optional[Dict[str, Any]] = None) -> str:
+    '''
+    Return a hash that uniquely identifies a query and the form its results are returned in.
+
+    Arguments:
+        json_query          The request that is sent to ServiceX
+        data_type           The format the data is returned in ('pandas', 'awkward', etc.)
+        columns             The columns that are loaded from the results (None for all)
+        dtypes              The numpy types columns are converted to
+
+    Returns:
+        key                 A hex string that can be used as a cache key (and a filename)
+    '''
+    # Sort the keys so that two dictionaries with the same contents generate the same hash.
+    # Leave out the defaults so keys made before they existed are still found.
+    description = {'query': json_query, 'data-type': data_type}  # type: Dict[str, Any]
+    if columns is not None:
+        description['columns'] = list(columns)
+    if dtypes is not None:
+        description['dtypes'] = {name: np.dtype(t).str for name, t in dtypes.items()}
+    normalized = json.dumps(description, sort_keys=True)
+    return hashlib.sha256(normalized.encode('utf-8')).hexdigest()
+
+
+def user_cache_path(name: str) -> str:
+    '''
+    Where something called `name` is kept on local disk by default: in a directory in the system
+    temp directory that is named after, and belongs to, the current user.
+    '''
+    user = str(os.getuid()) if hasattr(os, 'getuid') else getpass.getuser()
+    return os.path.join(tempfile.gettempdir(), f'servicex-{user}', name)
+
+
+def is_private_dir(path: str) -> bool:
+    '''
+    True if `path` is a directory that belongs to the current user and that no one else can
+    write to - so we can trust what is in it.
+    '''
+    if not hasattr(os, 'getuid'):  # pragma: no cover
+        # Windows keeps a temp directory for each user.
+        return os.path.isdir(path)
+    try:
+        info = os.stat(path)
+    except OSError:
+        return False
+    return info.st_uid == os.getuid() and (info.st_mode & 0o022) == 0
+
+
+def make_private_dir(path: str) -> None:
+    '''
+    Create a directory that only the current user can use, if it isn't there already. Raises
+    `PermissionError` if it is there, but someone else owns it or can write to it.
+    '''
+    parent = os.path.dirname(path)
+    if parent != '':
+        os.makedirs(parent, exist_ok=True)
+    try:
+        os.mkdir(path, 0o700)
+    except FileExistsError:
+        pass
+    if not is_private_dir(path):
+        raise PermissionError(f'{path} can be changed by other users, so it is not used.')
+
+
+class _TooLarge(Exception):
+    'Raised to stop writing an entry that will not fit in the cache'
+
+
+class _SizeLimitedFile:
+    'Write to a file, stopping with `_TooLarge` as soon as more than `limit` bytes are written'
+    def __init__(self, f_out: Any, limit: int):
+        self._f_out = f_out
+        self._limit = limit
+        self._written = 0
+
+    def write(self, data: Any) -> int:
+        self._written += memoryview(data).nbytes
+        if self._written > self._limit:
+            raise _TooLarge()
+        return self._f_out.write(data)
+
+
+class QueryCache:
+    '''
+    Keep the materialized results of previous queries on local disk. Each entry is stored
+    as a pickle file named after its key. When the total size of the cache grows beyond
+    `max_size` bytes, the least recently used entries are removed.
+
+    Loading a pickle can run any code, so the directory is created so that only the current
+    user can use it, and nothing is loaded from it if anyone else owns it or can write to it.
+    '''
+    def __init__(self, path: str, max_size: int = 10 * 1024 * 1024 * 1024):
+        '''
+        Arguments:
+            path                Directory where the cache files are kept. Created if needed.
+            max_size            Maximum size in bytes the cache is allowed to take on disk.
+        '''
+        self._path = path
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def path(self) -> str:
+        'The directory where the cache files live'
+        return self._path
+
+    def _entry_path(self, key: str) -> str:
+        return os.path.join(self._path, f'{key}.pickle')
+
+    def _entries(self) -> List[Tuple[float, int, str]]:
+        'Return (last-used-time, size, path) for every entry in the cache'
+        if not os.path.exists(self._path):
+            return []
+        result = []
+        for fname in os.listdir(self._path):
+            if not fname.endswith('.pickle'):
+                continue
+            fpath = os.path.join(self._path, fname)
+            try:
+                info = os.stat(fpath)
+            except FileNotFoundError:
+                # Another process may have evicted this while we were looking.
+                continue
+            result.append((info.st_mtime, info.st_size, fpath))
+        return result
+
+    def lookup(self, key: str) -> Optional[Any]:
+        '''
+        Return the cached result for `key`, or None if it is not in the cache.
+        '''
+        fpath = self._entry_path(key)
+        if not is_private_dir(self._path):
+            self.misses += 1
+            return None
+        try:
+            with open(fpath, 'rb') as f_in:
+                result = pickle.load(f_in)
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+            self.misses += 1
+            return None
+
+        # Mark this entry as recently used so eviction picks on something else.
+        os.utime(fpath, None)
+        self.hits += 1
+        return result
+
+    def save(self, key: str, value: Any) -> bool:
+        '''
+        Store `value` in the cache, and evict old entries if the cache is now too large. This
+        makes blocking calls. Raises `OSError` if it can't be written (e.g. the directory
+        belongs to someone else).
+
+        Returns:
+            saved               False if `value` alone is larger than `max_size`. Writing it
+                                stops as soon as that is known, and nothing is evicted.
+        '''
+        make_private_dir(self._path)
+
+        # Write to a temp file and move it into place so a reader never sees a partial entry.
+        fd, temp_path = tempfile.mkstemp(dir=self._path, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f_out:
+                pickle.dump(value, _SizeLimitedFile(f_out, self.max_size),
+                            protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(temp_path, self._entry_path(key))
+        except _TooLarge:
+            os.remove(temp_path)
+            return False
+        except BaseException:
+            os.remove(temp_path)
+            raise
+
+        self._evict()
+        return True
+
+    def invalidate(self, key: Optional[str] = None) -> None:
+        '''
+        Remove an entry from the cache. If `key` is None, then everything in the cache
+        is removed.
+        '''
+        paths = [e[2] for e in self._entries()] if key is None else [self._entry_path(key)]
+        for fpath in paths:
+            try:
+                os.remove(fpath)
+            except FileNotFoundError:
+                pass
+
+    @property
+    def size(self) -> int:
+        'Total number of bytes the cache is currently using on disk'
+        return sum(e[1] for e in self._entries())
+
+    def _evict(self) -> None:
+        'Remove the least recently used entries until we are under the size limit'
+        entries = sorted(self._entries())
+        total = sum(e[1] for e in entries)
+        for _, size, fpath in entries:
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(fpath)
+            except FileNotFoundError:
+                pass
+            total -= size
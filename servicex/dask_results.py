@@ -0,0 +1,137 @@
+# Return the files a query produces as the partitions of a dask collection, so that each one is
+# downloaded and loaded by whichever dask worker computes it rather than in this process.
+from typing import Any, Dict, List, Optional, Tuple  # NOQA: F401
+
+from minio import Minio  # NOQA: F401
+
+try:
+    import dask
+    import dask.dataframe as dd
+except ImportError:  # pragma: no cover
+    dask = None
+
+from . import servicex as sx
+from .decode import read_file
+from .lazy import get_data_lazy_async
+from .minio_adaptor import new_minio_client
+from .servicex_adaptor import ServiceXAdaptor
+
+# Clients for the object store in this process (e.g. a dask worker), by connection settings
+_minio_clients = {}  # type: Dict[Tuple[Tuple[str, Any], ...], Minio]
+
+
+def read_object(minio_config: Dict[str, Any], bucket: str, object_name: str, data_type: str,
+                result_format: str = 'root-file', columns: Optional[List[str]] = None,
+                dtypes: Optional[Dict[str, Any]] = None) -> Any:
+    '''
+    Download one of the files a transform wrote, and load it. This is what each partition runs
+    on the dask worker that computes it. It makes blocking calls.
+
+    Arguments:
+        minio_config        How to connect to the object store (`ServiceXAdaptor.minio_config`)
+        bucket              The bucket the file is in - the request id of the transform
+        object_name         The name of the file in the bucket
+        data_type           'pandas', 'awkward', or 'arrow'
+        result_format       The format ServiceX wrote the file in: 'root-file' or 'parquet'
+        columns             Names of the columns to load. None loads all of them.
+        dtypes              numpy types to convert columns to, by column name
+
+    Returns:
+        data                The data in the file
+    '''
+    key = tuple(sorted(minio_config.items()))
+    client = _minio_clients.get(key)
+    if client is None:
+        client = _minio_clients[key] = new_minio_client(**minio_config)
+    response = client.get_object(bucket, object_name)
+    try:
+        data = bytearray(response.read())
+    finally:
+        response.release_conn()
+    return read_file(data, data_type, result_format, columns, dtypes)
+
+
+async def get_data_dask_async(selection_query: str, dataset: str,
+                              servicex_endpoint: str = 'http://localhost:5000/servicex',
+                              data_type: str = 'pandas',
+                              image: str = 'sslhep/servicex_xaod_cpp_transformer:v0.2',
+                              servicex_adaptor: Optional[ServiceXAdaptor] = None,
+                              result_format: str = 'root-file',
+                              columns: Optional[List[str]] = None,
+                              dtypes: Optional[Dict[str, Any]] = None,
+                              workers: Optional[int] = None,
+                              chunk_size: Optional[int] = None,
+                              size_hint: Optional[int] = None) -> Any:
+    '''
+    Run a query, and return its result as a dask collection with one partition for each file
+    the transform wrote. This waits for the transform to finish (so every file is known), but
+    downloads nothing: each file is downloaded and loaded by the dask worker that computes its
+    partition. Needs the `dask` package.
+
+    Arguments:
+        selection_query     `qastle` string that specifies what columnes to extract, how to format
+                            them, and how to format them.
+        dataset             Dataset to run the query against
+        servicex_endpoint   The URL where the instance of ServivceX we are querying lives
+        data_type           'pandas' for a `dask.dataframe.DataFrame`. 'awkward' or 'arrow' for
+                            a list of `dask.delayed` objects, one for each file, as awkward
+                            arrays of this version have no dask collection.
+        image               ServiceX image that should run this
+        servicex_adaptor    Connections to ServiceX to use. If None, a shared adaptor for
+                            `servicex_endpoint` is used. The object store credentials are sent
+                            to the workers.
+        result_format       The file format ServiceX should write: 'root-file' or 'parquet'.
+        columns             Names of the columns to load. None loads all of them.
+        dtypes              numpy types to convert columns to as they are read, by column name.
+        workers, chunk_size, size_hint
+                            The size of the transform, as for `get_data_async`.
+
+    Returns:
+        result              The dask collection
+    '''
+    if dask is None:
+        raise sx.ServiceX_Exception('The dask package is needed to return a dask collection.')
+
+    adaptor = servicex_adaptor or sx._default_adaptor(servicex_endpoint)
+    lazy = await get_data_lazy_async(selection_query, dataset, servicex_endpoint, data_type,
+                                     image=image, servicex_adaptor=adaptor,
+                                     result_format=result_format, columns=columns,
+                                     dtypes=dtypes, workers=workers, chunk_size=chunk_size,
+                                     size_hint=size_hint)
+    object_names = await lazy.files_async(wait=True)
+    if len(object_names) == 0:
+        raise sx.ServiceX_Exception('The query did not produce any files.')
+
+    read = dask.delayed(read_object, pure=True)
+    partitions = [read(adaptor.minio_config, lazy.request_id, name, data_type, result_format,
+                       columns, dtypes)
+                  for name in object_names]
+    if data_type != 'pandas':
+        return partitions
+
+    # The columns and their types come from the first entry of the first file.
+    first = await lazy.read_file_async(object_names[0], entry_stop=1)
+    return dd.from_delayed(partitions, meta=first.iloc[:0], verify_meta=False)
+
+
+def get_data_dask(selection_query: str, dataset: str,
+                  servicex_endpoint: str = 'http://localhost:5000/servicex',
+                  data_type: str = 'pandas',
+                  image: str = 'sslhep/servicex_xaod_cpp_transformer:v0.2',
+                  servicex_adaptor: Optional[ServiceXAdaptor] = None,
+                  result_format: str = 'root-file',
+                  columns: Optional[List[str]] = None,
+                  dtypes: Optional[Dict[str, Any]] = None,
+                  workers: Optional[int] = None,
+                  chunk_size: Optional[int] = None,
+                  size_hint: Optional[int] = None) -> Any:
+    '''
+    Run a query, and return its result as a dask collection. See `get_data_dask_async` for a
+    description of the arguments.
+    '''
+    return sx._run_sync(get_data_dask_async(selection_query, dataset, servicex_endpoint,
+                                            data_type, image=image,
+                                            servicex_adaptor=servicex_adaptor,
+                                            result_format=result_format, columns=columns,
+                                            dtypes=dtypes, workers=workers,
+                                            chunk_size=chunk_size, size_hint=size_hint))
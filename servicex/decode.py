@@ -0,0 +1,364 @@
+# Turning the ROOT files ServiceX produces into data in memory
+from contextlib import contextmanager
+import os
+import pickle
+from typing import Any, BinaryIO, Dict, Iterator, List, Optional, Tuple, Union
+
+import awkward
+import numpy as np
+import uproot
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:  # pragma: no cover
+    # Only available in python 3.8 and later
+    shared_memory = None
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # pragma: no cover
+    # Only needed for the arrow data type and parquet files
+    pa = None
+    pq = None
+
+
+class _MemorySource(uproot.source.source.Source):
+    'Let uproot read a ROOT file that is held in memory'
+    def __init__(self, data: bytearray):
+        super().__init__(np.frombuffer(data, dtype=np.uint8))
+        self.path = '<memory>'
+
+
+def _to_arrow_array(column: Any) -> Any:
+    'Convert a numpy or jagged awkward array to arrow, without copying the data'
+    if isinstance(column, np.ndarray):
+        return pa.array(column)
+    column = column.compact()
+    return pa.LargeListArray.from_arrays(pa.array(column.offsets),
+                                         _to_arrow_array(column.content))
+
+
+def _from_arrow_array(column: Any) -> Any:
+    'Convert an arrow array to a numpy or jagged awkward array, like uproot returns'
+    if isinstance(column, pa.ChunkedArray):
+        chunks = [_from_arrow_array(c) for c in column.chunks]
+        return chunks[0] if len(chunks) == 1 else awkward.concatenate(chunks)
+    if column.null_count > 0:
+        return awkward.fromarrow(column)
+    if pa.types.is_list(column.type) or pa.types.is_large_list(column.type):
+        return awkward.JaggedArray.fromoffsets(column.offsets.to_numpy(),
+                                               _from_arrow_array(column.values))
+    return column.to_numpy(zero_copy_only=False)
+
+
+@contextmanager
+def _open_tree(source: Union[bytearray, str, uproot.source.source.Source]) -> Iterator[Any]:
+    '''
+    Open a ROOT file from memory, local disk, or an uproot `Source`, and return the first and
+    only tree in it
+    '''
+    if isinstance(source, str):
+        f_in = uproot.open(source)
+    elif isinstance(source, uproot.source.source.Source):
+        f_in = uproot.open(source.path, localsource=lambda _: source)
+    else:
+        f_in = uproot.open('<memory>', localsource=lambda _: _MemorySource(source))
+    try:
+        yield f_in[f_in.keys()[0]]
+    finally:
+        f_in._context.source.close()
+
+
+def _as_dtype(interpretation: Any, dtype: Any) -> Any:
+    'Change an uproot interpretation so the data is converted to `dtype` as it is read'
+    if isinstance(interpretation, uproot.interp.numerical.asdtype):
+        # Keep the shape of each item (e.g. a fixed size array) as it is
+        return uproot.asdtype(interpretation.fromdtype,
+                              np.dtype((np.dtype(dtype), interpretation.todtype.shape)))
+    if isinstance(interpretation, uproot.interp.jagged.asjagged):
+        return uproot.asjagged(_as_dtype(interpretation.content, dtype),
+                               skipbytes=interpretation.skipbytes)
+    raise BaseException(f'Unable to convert {interpretation} to {dtype}.')
+
+
+def _branches(tree: Any, columns: Optional[List[str]], dtypes: Optional[Dict[str, Any]]) \
+        -> Optional[Dict[bytes, Any]]:
+    '''
+    Work out which branches uproot should read, and how it should interpret them. None means
+    read all of them, as they are.
+    '''
+    if columns is None and dtypes is None:
+        return None
+    names = tree.keys() if columns is None else [c.encode() for c in columns]
+    branches = {}
+    for name in names:
+        if name not in tree:
+            raise BaseException(f'Column {name.decode()} is not in the result of the query.')
+        interpretation = tree[name].interpretation
+        if dtypes is not None and name.decode() in dtypes:
+            interpretation = _as_dtype(interpretation, dtypes[name.decode()])
+        branches[name] = interpretation
+    return branches
+
+
+def read_root_file(source: Union[bytearray, str, uproot.source.source.Source], data_type: str,
+                   columns: Optional[List[str]] = None,
+                   dtypes: Optional[Dict[str, Any]] = None,
+                   entry_start: Optional[int] = None, entry_stop: Optional[int] = None) -> Any:
+    '''
+    Load a ROOT file that has been downloaded from ServiceX, either from memory or from a
+    local file. Only the branches in `columns` (all if None) are decompressed, and those in
+    `dtypes` are converted to the given numpy type as they are read. Only the entries from
+    `entry_start` up to `entry_stop` are read (None means the start or end of the file).
+    '''
+    with _open_tree(source) as r:
+        branches = _branches(r, columns, dtypes)
+        if data_type == 'pandas':
+            return r.pandas.df(branches=branches, entrystart=entry_start, entrystop=entry_stop)
+        arrays = r.arrays(branches=branches, entrystart=entry_start, entrystop=entry_stop)
+        if data_type == 'awkward':
+            return arrays
+        elif data_type == 'arrow':
+            return pa.table({name.decode(): _to_arrow_array(column)
+                             for name, column in arrays.items()})
+        else:
+            raise BaseException(f'Internal coding error - {data_type} should not be known.')
+
+
+def root_file_schema(source: Union[bytearray, str, uproot.source.source.Source]) \
+        -> Tuple[int, Dict[str, str]]:
+    '''
+    Read the number of entries and the type of each column from a ROOT file's metadata,
+    without reading any of the data.
+
+    Returns:
+        entries             The number of entries in the file
+        schema              The type of each column by name, as uproot describes it, e.g.
+                            'float64' or, for a column with a variable number of items per
+                            entry, '[0, inf) -> float64'
+    '''
+    with _open_tree(source) as r:
+        return r.numentries, {name.decode(): str(branch.interpretation.type).strip()
+                              for name, branch in r.items()}
+
+
+def root_file_layout(source: Union[bytearray, str], columns: Optional[List[str]] = None,
+                     dtypes: Optional[Dict[str, Any]] = None) \
+        -> Optional[Tuple[int, Dict[bytes, Any]]]:
+    '''
+    Look in a ROOT file's metadata for the shape of the data in it, without reading the data.
+    `columns` and `dtypes` are as for `read_root_file`.
+
+    Returns:
+        layout              The number of entries and the numpy dtype of each column, or None
+                            if the data can't be read straight into a numpy array (e.g. a column
+                            has a variable number of items per entry).
+    '''
+    with _open_tree(source) as r:
+        interpretations = _branches(r, columns, dtypes) \
+            or {name: branch.interpretation for name, branch in r.items()}
+        flat = [isinstance(i, uproot.interp.numerical.asdtype) and i.todims == ()
+                for i in interpretations.values()]
+        if not all(flat):
+            return None
+        return r.numentries, {name: i.todtype for name, i in interpretations.items()}
+
+
+def read_root_file_into(source: Union[bytearray, str], output: Dict[bytes, np.ndarray],
+                        start: int, columns: Optional[List[str]] = None,
+                        dtypes: Optional[Dict[str, Any]] = None) -> None:
+    '''
+    Read a ROOT file straight into part of some larger, already allocated, arrays. The file
+    must have the layout `root_file_layout` returned.
+
+    Arguments:
+        source              The contents of the file, or the path to it on local disk
+        output              The arrays to fill, by column name
+        start               Index in the arrays of the file's first entry
+        columns, dtypes     As for `read_root_file`
+    '''
+    with _open_tree(source) as r:
+        stop = start + r.numentries
+        interpretations = _branches(r, columns, dtypes) \
+            or {name: branch.interpretation for name, branch in r.items()}
+        for name, interpretation in interpretations.items():
+            r[name].array(interpretation=interpretation.toarray(output[name][start:stop]))
+
+
+def _cast_arrow_type(arrow_type: Any, dtype: Any) -> Any:
+    'The arrow type with the same structure as `arrow_type`, but holding `dtype` numbers'
+    if pa.types.is_list(arrow_type):
+        return pa.list_(_cast_arrow_type(arrow_type.value_type, dtype))
+    if pa.types.is_large_list(arrow_type):
+        return pa.large_list(_cast_arrow_type(arrow_type.value_type, dtype))
+    return pa.from_numpy_dtype(np.dtype(dtype))
+
+
+def _open_parquet_file(source: Union[bytearray, str, BinaryIO]) -> Any:
+    'Open a parquet file in memory, on local disk, or behind a binary file object'
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        source = pa.BufferReader(source)
+    return pq.ParquetFile(source)
+
+
+def read_parquet_file(source: Union[bytearray, str, BinaryIO], data_type: str,
+                      columns: Optional[List[str]] = None,
+                      dtypes: Optional[Dict[str, Any]] = None,
+                      entry_start: Optional[int] = None,
+                      entry_stop: Optional[int] = None) -> Any:
+    '''
+    Load a parquet file that has been downloaded from ServiceX, either from memory or from a
+    local file. `columns`, `dtypes`, `entry_start` and `entry_stop` are as for
+    `read_root_file`. Only the row groups that hold the requested entries are read.
+    '''
+    f_in = _open_parquet_file(source)
+    if columns is not None:
+        missing = [c for c in columns if c not in f_in.schema_arrow.names]
+        if len(missing) > 0:
+            raise BaseException(f'Column {missing[0]} is not in the result of the query.')
+    if entry_start is None and entry_stop is None:
+        table = f_in.read(columns=columns)
+    else:
+        table = _read_parquet_rows(f_in, columns, entry_start or 0,
+                                   f_in.metadata.num_rows if entry_stop is None
+                                   else min(entry_stop, f_in.metadata.num_rows))
+    for name, dtype in (dtypes or {}).items():
+        if name in table.column_names:
+            i = table.column_names.index(name)
+            column = table.column(i)
+            table = table.set_column(i, name, column.cast(_cast_arrow_type(column.type, dtype)))
+    if data_type == 'pandas':
+        return table.to_pandas()
+    elif data_type == 'awkward':
+        return {name.encode(): _from_arrow_array(table.column(name))
+                for name in table.column_names}
+    elif data_type == 'arrow':
+        return table
+    else:
+        raise BaseException(f'Internal coding error - {data_type} should not be known.')
+
+
+def _read_parquet_rows(f_in: Any, columns: Optional[List[str]], start: int, stop: int) -> Any:
+    'Read rows [start, stop) of a parquet file, touching only the row groups that hold them'
+    groups = []
+    first_row = 0
+    group_start = 0
+    for i in range(f_in.num_row_groups):
+        group_rows = f_in.metadata.row_group(i).num_rows
+        if group_start < stop and group_start + group_rows > start:
+            if len(groups) == 0:
+                first_row = group_start
+            groups.append(i)
+        group_start += group_rows
+    if len(groups) == 0:
+        return f_in.schema_arrow.empty_table().select(columns or f_in.schema_arrow.names)
+    table = f_in.read_row_groups(groups, columns=columns)
+    return table.slice(start - first_row, max(0, stop - start))
+
+
+def _arrow_type_name(arrow_type: Any) -> str:
+    'Describe an arrow type the way uproot describes the type of a branch'
+    if pa.types.is_list(arrow_type) or pa.types.is_large_list(arrow_type):
+        return f'[0, inf) -> {_arrow_type_name(arrow_type.value_type)}'
+    if pa.types.is_fixed_size_list(arrow_type):
+        return f'[0, {arrow_type.list_size}) -> {_arrow_type_name(arrow_type.value_type)}'
+    try:
+        return np.dtype(arrow_type.to_pandas_dtype()).name
+    except (NotImplementedError, TypeError):
+        return str(arrow_type)
+
+
+def parquet_file_schema(source: Union[bytearray, str, BinaryIO]) -> Tuple[int, Dict[str, str]]:
+    'Like `root_file_schema`, for a parquet file. Only the footer of the file is read.'
+    f_in = _open_parquet_file(source)
+    return f_in.metadata.num_rows, {field.name: _arrow_type_name(field.type)
+                                    for field in f_in.schema_arrow}
+
+
+def read_file(source: Union[bytearray, str], data_type: str,
+              result_format: str = 'root-file', columns: Optional[List[str]] = None,
+              dtypes: Optional[Dict[str, Any]] = None, entry_start: Optional[int] = None,
+              entry_stop: Optional[int] = None) -> Any:
+    '''
+    Load a file that has been downloaded from ServiceX.
+
+    Arguments:
+        source              The contents of the file, or the path to it on local disk
+        data_type           'pandas', 'awkward', or 'arrow' (a `pyarrow.Table`)
+        result_format       The format ServiceX wrote the file in: 'root-file' or 'parquet'
+        columns             Names of the columns to read. None means all of them.
+        dtypes              numpy types to convert columns to, by column name
+        entry_start         Index of the first entry to read. None means the first in the file.
+        entry_stop          Index after the last entry to read. None means the end of the file.
+
+    Returns:
+        data                The data in the file
+    '''
+    if result_format == 'root-file':
+        return read_root_file(source, data_type, columns, dtypes, entry_start, entry_stop)
+    elif result_format == 'parquet':
+        return read_parquet_file(source, data_type, columns, dtypes, entry_start, entry_stop)
+    else:
+        raise BaseException(f'Internal coding error - {result_format} should not be known.')
+
+
+def _use_shared_memory() -> bool:
+    '''
+    Shared memory needs python 3.8. On Windows a block disappears as soon as the worker lets go
+    of it, before we get a chance to pick it up, so it can't be used there.
+    '''
+    return shared_memory is not None and os.name != 'nt'
+
+
+def read_file_in_process(source: Union[bytearray, str], data_type: str,
+                         result_format: str = 'root-file', columns: Optional[List[str]] = None,
+                         dtypes: Optional[Dict[str, Any]] = None) \
+        -> Tuple[bytes, List[Tuple[str, int]]]:
+    '''
+    Load a file in a worker process, and package it up to send back to the main process.
+    The column data is put in shared memory blocks, which saves pushing it all through the
+    pipe back to the main process. Use `unpack_decoded` to get the data back out.
+
+    Returns:
+        header              Pickled data, without the large column buffers
+        blocks              Name and size of the shared memory block for each column buffer
+    '''
+    result = read_file(source, data_type, result_format, columns, dtypes)
+    if not _use_shared_memory():
+        return pickle.dumps(result, protocol=pickle.HIGHEST_PROTOCOL), []
+
+    # Pickle protocol 5 hands us the numpy buffers separately instead of copying them into the
+    # pickle.
+    buffers = []  # type: List[pickle.PickleBuffer]
+    header = pickle.dumps(result, protocol=5, buffer_callback=buffers.append)
+
+    blocks = []
+    for b in buffers:
+        data = b.raw()
+        block = shared_memory.SharedMemory(create=True, size=max(1, data.nbytes))
+        block.buf[:data.nbytes] = data
+        blocks.append((block.name, data.nbytes))
+        block.close()
+    return header, blocks
+
+
+def unpack_decoded(payload: Tuple[bytes, List[Tuple[str, int]]]) -> Any:
+    '''
+    Turn what `read_file_in_process` sent back into the data, and free the shared
+    memory blocks.
+    '''
+    header, blocks = payload
+    if len(blocks) == 0:
+        # Pickled in-band - the only way before python 3.8, which has no `buffers` argument
+        return pickle.loads(header)
+
+    buffers = []
+    for name, size in blocks:
+        block = shared_memory.SharedMemory(name=name)
+        try:
+            buffers.append(bytearray(block.buf[:size]))
+        finally:
+            block.close()
+            block.unlink()
+    return pickle.loads(header, buffers=buffers)
@@ -0,0 +1,141 @@
+# Record where the time goes while a query runs
+from contextlib import contextmanager
+import time
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+# An event hook is called with the name of the event and a dictionary of information about it.
+# Events that cover a stretch of time have `start` and `end` (from `time.time()`) and `duration`
+# (in seconds) entries. The events are:
+#
+#   query           Running the transform for one dataset, and downloading and loading its
+#                   files. Has `dataset`.
+#   submit          Sending the transform request to ServiceX. Has `dataset` and `request_id`.
+#   queue-wait      From submitting the transform until ServiceX reports its first file done.
+#                   Has `request_id`. Not sent when picking up a transform from the journal.
+#   poll            Waiting for and getting the status of the transform. Has `request_id`,
+#                   `files_processed`, and `files_remaining`.
+#   listing         Listing the new objects in the bucket. Has `request_id` and `found`, the
+#                   number of new objects.
+#   object-found    A file has been found in the bucket. Has `request_id`, `object_name`, and
+#                   `elapsed`, the seconds since the transform was submitted. No `start` or `end`.
+#   download        Downloading a file. Has `request_id`, `object_name`, and `size` (bytes).
+#   decode          Loading a file into memory. Has `object_name`.
+#   shared-cache    Looking up a file in the shared cache (see `servicex_shared_cache`). Has
+#                   `object_name` and `found`.
+#   spill           Writing a loaded file out to local files to free up memory (see
+#                   `servicex_max_decoded_bytes`). Has `object_name` and `size` (bytes in memory).
+#   concat          Putting the files for a dataset together. Has `files`.
+#
+# Timed events also have `concurrent`, the number of events of that type that were running when
+# it started (including itself).
+EventHook = Callable[[str, Dict[str, Any]], None]
+
+
+class Instrumentation:
+    'Send events about a query to any number of hooks'
+    def __init__(self, hooks: Optional[List[EventHook]] = None):
+        self._hooks = [h for h in (hooks or []) if h is not None]
+        self._active = {}  # type: Dict[str, int]
+
+    def emit(self, event: str, **info: Any) -> None:
+        'Send an event to all the hooks'
+        for h in self._hooks:
+            h(event, info)
+
+    @contextmanager
+    def timed(self, event: str, **info: Any) -> Iterator[Dict[str, Any]]:
+        '''
+        Time the body of a `with` statement, and send an event for it when it is done. The body
+        can add to the dictionary this yields to add information to the event.
+        '''
+        self._active[event] = self._active.get(event, 0) + 1
+        info['concurrent'] = self._active[event]
+        start = time.time()
+        try:
+            yield info
+        finally:
+            self._active[event] -= 1
+            end = time.time()
+            if len(self._hooks) > 0:
+                self.emit(event, start=start, end=end, duration=end - start, **info)
+
+
+class QueryStats:
+    '''
+    Timing, size, and concurrency statistics for the queries run by a call to `get_data` or
+    `get_data_async`. Create one and pass it as the `stats` argument to have it filled in.
+    '''
+    def __init__(self):
+        # Total seconds spent in each type of event (see `EventHook`). Events of the same type
+        # often overlap, so these can add up to more than the wall clock time.
+        self.phases = {}  # type: Dict[str, float]
+
+        # Information about each file, by object name: `size`, `download_time`, `decode_time`,
+        # and `found_after` (seconds from submitting the transform until it was found).
+        self.files = {}  # type: Dict[str, Dict[str, Any]]
+
+        # The most events of each type that were running at once
+        self.max_concurrent = {}  # type: Dict[str, int]
+
+        self._download_start = None  # type: Optional[float]
+        self._download_end = None  # type: Optional[float]
+
+    def __call__(self, event: str, info: Dict[str, Any]) -> None:
+        'Record an event - this is an event hook'
+        if 'duration' in info:
+            self.phases[event] = self.phases.get(event, 0.0) + info['duration']
+        if 'concurrent' in info:
+            self.max_concurrent[event] = max(self.max_concurrent.get(event, 0),
+                                             info['concurrent'])
+
+        if 'object_name' in info:
+            file_info = self.files.setdefault(info['object_name'], {})
+            if event == 'download':
+                file_info['size'] = info.get('size')
+                file_info['download_time'] = info['duration']
+                self._download_start = info['start'] if self._download_start is None \
+                    else min(self._download_start, info['start'])
+                self._download_end = info['end'] if self._download_end is None \
+                    else max(self._download_end, info['end'])
+            elif event == 'decode':
+                file_info['decode_time'] = info['duration']
+            elif event == 'object-found':
+                file_info['found_after'] = info['elapsed']
+
+    @property
+    def bytes_downloaded(self) -> int:
+        'Total size of all the files downloaded'
+        return sum(f.get('size') or 0 for f in self.files.values())
+
+    @property
+    def download_rate(self) -> Optional[float]:
+        'Bytes downloaded per second, from when the first download started to the last ended'
+        if self._download_start is None or self._download_end <= self._download_start:
+            return None
+        return self.bytes_downloaded / (self._download_end - self._download_start)
+
+
+def opentelemetry_hook(tracer: Any = None) -> EventHook:
+    '''
+    Return an event hook that records each event that covers a stretch of time as an
+    OpenTelemetry span named `servicex.<event>`. Needs the `opentelemetry-api` package.
+
+    Arguments:
+        tracer              The tracer to create the spans with. If None, the global tracer
+                            provider's tracer for `servicex` is used.
+    '''
+    if tracer is None:
+        from opentelemetry import trace
+        tracer = trace.get_tracer('servicex')
+
+    def record(event: str, info: Dict[str, Any]) -> None:
+        if 'start' not in info:
+            return
+        times = ('start', 'end', 'duration')
+        attributes = {k: v for k, v in info.items()
+                      if k not in times and isinstance(v, (str, bool, int, float))}
+        span = tracer.start_span(f'servicex.{event}', start_time=int(info['start'] * 1e9),
+                                 attributes=attributes)
+        span.end(end_time=int(info['end'] * 1e9))
+
+    return record
@@ -0,0 +1,242 @@
+# Remember the transforms we have submitted, and the files we have downloaded from them, so that
+# a query can pick up where it left off if the process running it dies.
+import asyncio
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+from typing import Any, Dict, List, Optional, Union
+
+from .cache import is_private_dir, make_private_dir
+from .minio_adaptor import ObjectStoreDownloader
+
+
+def journal_key(servicex_endpoint: str, json_query: Dict[str, Any]) -> str:
+    '''
+    Return a hash that uniquely identifies a transform request sent to a ServiceX instance.
+
+    Arguments:
+        servicex_endpoint   The URL where the instance of ServiceX lives
+        json_query          The request that is sent to ServiceX
+
+    Returns:
+        key                 A hex string that can be used as a directory name
+    '''
+    normalized = json.dumps({'endpoint': servicex_endpoint, 'query': json_query},
+                            sort_keys=True)
+    return hashlib.sha256(normalized.encode('utf-8')).hexdigest()
+
+
+def _link_or_copy(source: str, destination: str) -> None:
+    'Make `destination` a hard link to `source`, or a copy if links are not possible here'
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copyfile(source, destination)
+
+
+class QueryJournal:
+    '''
+    A record on local disk of each transform request that has been submitted and not yet
+    finished downloading. Each entry is a directory named after its key that holds the request
+    id, and, if `keep_files` is set, a copy of each file that has been completely downloaded.
+    The copies let a rerun skip downloading those files again, but hold on to the disk space of
+    every file of the query until it completes. The entry is removed once
+    the query has completed, and entries of queries that were abandoned are removed once they
+    have not been touched for `max_age` seconds.
+
+    The directory is created so that only the current user can use it, and nothing is read from
+    it if anyone else owns it or can write to it.
+    '''
+    def __init__(self, path: str, max_age: float = 7 * 24 * 3600, keep_files: bool = False):
+        '''
+        Arguments:
+            path                Directory where the journal is kept. Created if needed.
+            max_age             Seconds after which an entry that has not been added to is
+                                removed.
+            keep_files          If True, keep a copy of each downloaded file, so that a rerun
+                                does not download it again. Otherwise only the request id is
+                                kept, so a rerun picks up the same transform, but downloads all
+                                of its files.
+        '''
+        self._path = path
+        self.max_age = max_age
+        self.keep_files = keep_files
+
+        # Objects are added from several threads at once. Each addition rewrites the record.
+        self._lock = threading.Lock()
+
+    @property
+    def path(self) -> str:
+        'The directory where the journal lives'
+        return self._path
+
+    def _entry_dir(self, key: str) -> str:
+        return os.path.join(self._path, key)
+
+    def _read(self, key: str) -> Optional[Dict[str, Any]]:
+        if not is_private_dir(self._path):
+            return None
+        try:
+            with open(os.path.join(self._entry_dir(key), 'request.json'), 'r') as f_in:
+                return json.load(f_in)
+        except (OSError, ValueError):
+            return None
+
+    def _write(self, key: str, info: Dict[str, Any]) -> None:
+        'Write the record for a request - a reader never sees a partial file'
+        entry_dir = self._entry_dir(key)
+        fd, temp_path = tempfile.mkstemp(dir=entry_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f_out:
+                json.dump(info, f_out)
+            os.replace(temp_path, os.path.join(entry_dir, 'request.json'))
+        except BaseException:
+            os.remove(temp_path)
+            raise
+
+    def request_id(self, key: str) -> Optional[str]:
+        'The id of the transform that was submitted for `key`, or None if there is none'
+        info = self._read(key)
+        return None if info is None else info['request-id']
+
+    def start(self, key: str, request_id: str) -> None:
+        '''
+        Record that a transform has been submitted. Anything recorded for `key` is removed, as
+        are entries that are too old. Raises `OSError` if the journal can't be written to.
+        '''
+        make_private_dir(self._path)
+        self.remove(key)
+        self._remove_old()
+        os.makedirs(self._entry_dir(key), exist_ok=True)
+        self._write(key, {'request-id': request_id, 'objects': []})
+
+    def _remove_old(self) -> None:
+        'Remove the entries that have not been added to for `max_age` seconds'
+        oldest = time.time() - self.max_age
+        for key in os.listdir(self._path):
+            try:
+                last_used = os.stat(os.path.join(self._entry_dir(key), 'request.json')).st_mtime
+            except OSError:
+                # Not an entry, or removed while we were looking
+                continue
+            if last_used < oldest:
+                self.remove(key)
+
+    def objects(self, key: str) -> List[str]:
+        'Names of the objects that have been completely downloaded for `key`'
+        info = self._read(key)
+        return [] if info is None else list(info['objects'])
+
+    def object_path(self, key: str, object_name: str) -> str:
+        'Where the local copy of an object is kept. Object names are too long to use directly.'
+        name_hash = hashlib.sha1(object_name.encode('utf-8')).hexdigest()
+        return os.path.join(self._entry_dir(key), f'{name_hash}.data')
+
+    def add_object(self, key: str, object_name: str, data: Union[bytearray, str]) -> None:
+        '''
+        Keep a copy of a downloaded object, and record that it is complete. Does nothing unless
+        `keep_files` is set. This makes blocking calls, and raises `OSError` if the journal
+        can't be written to.
+
+        Arguments:
+            key                 The query the object belongs to
+            object_name         Name of the object in the bucket
+            data                The contents of the object, or the path of a local file that
+                                holds them. A file is hard linked where possible, rather than
+                                copied.
+        '''
+        if not self.keep_files:
+            return
+        info = self._read(key)
+        if info is None:
+            return
+        fd, temp_path = tempfile.mkstemp(dir=self._entry_dir(key), suffix='.tmp')
+        try:
+            if isinstance(data, str):
+                os.close(fd)
+                os.remove(temp_path)
+                _link_or_copy(data, temp_path)
+            else:
+                with os.fdopen(fd, 'wb') as f_out:
+                    f_out.write(data)
+            os.replace(temp_path, self.object_path(key, object_name))
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+        with self._lock:
+            # Read it again - another thread may have added an object since.
+            info = self._read(key)
+            if info is not None and object_name not in info['objects']:
+                info['objects'].append(object_name)
+                self._write(key, info)
+
+    def remove(self, key: str) -> None:
+        'Forget a query, and remove any files kept for it'
+        shutil.rmtree(self._entry_dir(key), ignore_errors=True)
+
+
+class JournaledDownloader(ObjectStoreDownloader):
+    '''
+    Keep a copy in the journal of every file downloaded for a query, and serve files that are
+    already in the journal from there instead of the object store.
+    '''
+    def __init__(self, downloader: ObjectStoreDownloader, journal: QueryJournal, key: str):
+        '''
+        Arguments:
+            downloader          Used to fetch the files that aren't in the journal
+            journal             Where the files are kept
+            key                 The query the files belong to
+        '''
+        self._downloader = downloader
+        self._journal = journal
+        self._key = key
+        self._complete = set(journal.objects(key))
+
+    async def download_file(self, bucket: str, object_name: str, local_path: str) -> None:
+        if object_name in self._complete:
+            shutil.copyfile(self._journal.object_path(self._key, object_name), local_path)
+            return
+        await self._downloader.download_file(bucket, object_name, local_path)
+        await self._add_object(object_name, local_path)
+
+    async def download_data(self, bucket: str, object_name: str, max_in_memory_size: int) \
+            -> Union[bytearray, str]:
+        if object_name in self._complete:
+            journal_path = self._journal.object_path(self._key, object_name)
+            if os.path.getsize(journal_path) <= max_in_memory_size:
+                with open(journal_path, 'rb') as f_in:
+                    return bytearray(f_in.read())
+
+            # The caller removes the file it is given, so give it its own link to the data.
+            fd, local_path = tempfile.mkstemp(suffix='.root')
+            os.close(fd)
+            os.remove(local_path)
+            _link_or_copy(journal_path, local_path)
+            return local_path
+
+        data = await self._downloader.download_data(bucket, object_name, max_in_memory_size)
+        try:
+            await self._add_object(object_name, data)
+        except BaseException:
+            if isinstance(data, str):
+                os.remove(data)
+            raise
+        return data
+
+    async def _add_object(self, object_name: str, data: Union[bytearray, str]) -> None:
+        '''
+        Copy a downloaded file into the journal, off the event loop so other downloads carry on.
+        If the journal can't be written to, the file just isn't there to pick up later.
+        '''
+        try:
+            await asyncio.get_event_loop().run_in_executor(None, self._journal.add_object,
+                                                           self._key, object_name, data)
+        except OSError:
+            return
+        self._complete.add(object_name)
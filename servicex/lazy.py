@@ -0,0 +1,397 @@
+# A handle on the result of a query that only fetches the data that is asked for
+import asyncio
+import io
+from typing import Any, AsyncIterator, Dict, Iterator, List, Optional, Tuple, Union
+
+from minio import Minio
+import numpy as np
+import pandas as pd
+import uproot
+
+from . import servicex as sx
+from .cache import query_cache_key
+from .decode import parquet_file_schema, read_file, root_file_schema
+from .minio_adaptor import ObjectDiscovery
+from .servicex_adaptor import PollSchedule, ServiceXAdaptor
+
+# Files are read straight from the object store in blocks of this many bytes.
+_remote_block_size = 1024 * 1024
+
+
+class _ObjectReader(io.RawIOBase):
+    '''
+    A read-only file whose contents are fetched from an object in the object store as they are
+    read, with http range requests. Makes blocking calls.
+    '''
+    def __init__(self, minio_client: Minio, bucket: str, object_name: str, size: int):
+        self._client = minio_client
+        self._bucket = bucket
+        self.name = object_name
+        self.size = size
+        self._position = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._position
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        base = {io.SEEK_SET: 0, io.SEEK_CUR: self._position, io.SEEK_END: self.size}[whence]
+        self._position = max(0, base + offset)
+        return self._position
+
+    def read_range(self, start: int, stop: int) -> bytes:
+        'Fetch bytes [start, stop) of the object'
+        stop = min(stop, self.size)
+        if stop <= start:
+            return b''
+        response = self._client.get_partial_object(self._bucket, self.name, offset=start,
+                                                   length=stop - start)
+        try:
+            return response.read()
+        finally:
+            response.release_conn()
+
+    def readinto(self, buffer: Any) -> int:
+        data = self.read_range(self._position, self._position + len(buffer))
+        buffer[:len(data)] = data
+        self._position += len(data)
+        return len(data)
+
+
+class _ObjectSource(uproot.source.chunked.ChunkedSource):
+    'Let uproot read a ROOT file straight from the object store, fetching only what it needs'
+    def __init__(self, reader: _ObjectReader):
+        super().__init__('<object store>', _remote_block_size, 100 * _remote_block_size, None)
+        self._reader = reader
+
+    def _open(self) -> None:
+        pass
+
+    def size(self) -> int:
+        return self._reader.size
+
+    def _read(self, chunkindex: int) -> np.ndarray:
+        start = chunkindex * self._chunkbytes
+        return np.frombuffer(self._reader.read_range(start, start + self._chunkbytes),
+                             dtype=np.uint8)
+
+
+def _open_remote(minio_client: Minio, bucket: str, object_name: str, size: Optional[int],
+                 result_format: str) -> Any:
+    'Open an object for reading in place, as something the decoders accept - blocks'
+    if size is None:
+        size = minio_client.stat_object(bucket, object_name).size
+    reader = _ObjectReader(minio_client, bucket, object_name, size)
+    if result_format == 'root-file':
+        return _ObjectSource(reader)
+    return io.BufferedReader(reader, buffer_size=_remote_block_size)
+
+
+def _run(coroutine: Any) -> Any:
+    'Run a coroutine to completion from synchronous code, as `get_data` does'
+    return sx._run_sync(coroutine)
+
+
+class LazyResult:
+    '''
+    The result of a query whose transform has been submitted to ServiceX, but none of whose data
+    has been downloaded. Only what is asked for is fetched: looking at the schema or the first
+    few entries reads just the parts of a file needed, straight from the object store, while
+    `to_pandas` and friends download and load everything.
+
+    Every method has a synchronous version, and an async version whose name ends in `_async`.
+    '''
+    def __init__(self, adaptor: ServiceXAdaptor, json_query: Dict[str, Any], request_id: str,
+                 data_type: str, columns: Optional[List[str]] = None,
+                 dtypes: Optional[Dict[str, Any]] = None):
+        '''
+        Arguments:
+            adaptor             Connections to ServiceX and its object store
+            json_query          The transform request that was submitted
+            request_id          The id ServiceX gave the transform
+            data_type           The default for how data comes back: 'pandas', 'awkward', or
+                                'arrow'
+            columns             The columns to read by default. None means all of them.
+            dtypes              numpy types to convert columns to, by column name
+        '''
+        self._adaptor = adaptor
+        self._json_query = json_query
+        self._request_id = request_id
+        self._data_type = data_type
+        self._columns = columns
+        self._dtypes = dtypes
+        self._discovery = ObjectDiscovery(adaptor.minio_client, request_id)
+        self._files = []  # type: List[str]
+        self._done = False
+
+    @property
+    def request_id(self) -> str:
+        'The id ServiceX gave the transform'
+        return self._request_id
+
+    @property
+    def result_format(self) -> str:
+        'The format of the files: root-file or parquet'
+        return self._json_query['result-format']
+
+    async def status_async(self) -> Tuple[Optional[int], int]:
+        '''
+        Returns:
+            files_remaining     How many files remain to be processed. None if not yet known.
+            files_processed     How many files have been processed.
+        '''
+        return await sx._get_transform_status(self._adaptor.session(), self._adaptor.endpoint,
+                                              self._request_id)
+
+    def status(self) -> Tuple[Optional[int], int]:
+        return _run(self.status_async())
+
+    async def _update_files(self, delay: Optional[float] = None) -> None:
+        '''
+        Check the status of the transform (after `delay` seconds, through the shared status
+        tracker, if given), and look for new files
+        '''
+        if delay is None:
+            files_remaining, files_processed = await self.status_async()
+        else:
+            files_remaining, files_processed = await sx._poll_transform(
+                self._adaptor.session(), self._adaptor.endpoint, self._request_id, delay)
+        new_files = await asyncio.get_event_loop().run_in_executor(
+            None, self._discovery.new_objects, files_processed)
+        self._files.extend(new_files)
+        self._done = files_remaining == 0
+
+    async def _wait_for_files(self, count: Optional[int]) -> List[str]:
+        'Wait until there are at least `count` files (all of them if None) or the transform ends'
+        schedule = PollSchedule(sx.servicex_status_poll_min_time, sx.servicex_status_poll_time,
+                                sx.servicex_status_poll_backoff)
+        await self._update_files()
+        while not self._done and (count is None or len(self._files) < count):
+            n_files = len(self._files)
+            await self._update_files(schedule.delay)
+            schedule.update(len(self._files) != n_files)
+        return sorted(self._files)
+
+    async def files_async(self, wait: bool = False) -> List[str]:
+        '''
+        Names of the files the transform has written so far, in sorted order.
+
+        Arguments:
+            wait                If True, wait for the transform to finish, so all the files
+                                are returned.
+        '''
+        return await self._wait_for_files(None) if wait else await self._wait_for_files(0)
+
+    def files(self, wait: bool = False) -> List[str]:
+        return _run(self.files_async(wait))
+
+    async def _first_file(self) -> str:
+        files = await self._wait_for_files(1)
+        if len(files) == 0:
+            raise sx.ServiceX_Exception('The query did not produce any files.')
+        return files[0]
+
+    def _read_remote(self, object_name: str, read: Any) -> Any:
+        'Open a file in place in the object store, and run `read` on it - blocks'
+        size, _ = self._discovery.object_info(object_name)
+        source = _open_remote(self._adaptor.minio_client, self._request_id, object_name, size,
+                              self.result_format)
+        try:
+            return read(source)
+        finally:
+            source.close()
+
+    async def schema_async(self) -> Dict[str, str]:
+        '''
+        The type of each column, by name (see `servicex.decode.root_file_schema`), read from
+        the first file's metadata. Waits for the first file if need be.
+        '''
+        object_name = await self._first_file()
+        schema = root_file_schema if self.result_format == 'root-file' else parquet_file_schema
+        _, columns = await asyncio.wrap_future(sx._decode_executor.submit(
+            self._read_remote, object_name, schema))
+        return columns
+
+    def schema(self) -> Dict[str, str]:
+        return _run(self.schema_async())
+
+    async def read_file_async(self, object_name: str, columns: Optional[List[str]] = None,
+                              entry_start: Optional[int] = None,
+                              entry_stop: Optional[int] = None,
+                              data_type: Optional[str] = None) -> Any:
+        '''
+        Read part of one file, fetching only the parts of it that are needed from the object
+        store.
+
+        Arguments:
+            object_name         One of the names returned by `files`
+            columns             Columns to read. None means the ones given when the query was
+                                made.
+            entry_start         Index in the file of the first entry to read. None means 0.
+            entry_stop          Index after the last entry to read. None means the end.
+            data_type           'pandas', 'awkward', or 'arrow'. None means the one given when
+                                the query was made.
+        '''
+        data_type = data_type or self._data_type
+        columns = columns if columns is not None else self._columns
+        return await asyncio.wrap_future(sx._decode_executor.submit(
+            self._read_remote, object_name,
+            lambda source: read_file(source, data_type, self.result_format, columns,
+                                     self._dtypes, entry_start, entry_stop)))
+
+    def read_file(self, object_name: str, columns: Optional[List[str]] = None,
+                  entry_start: Optional[int] = None, entry_stop: Optional[int] = None,
+                  data_type: Optional[str] = None) -> Any:
+        return _run(self.read_file_async(object_name, columns, entry_start, entry_stop,
+                                         data_type))
+
+    async def head_async(self, n: int = 5, columns: Optional[List[str]] = None) -> Any:
+        '''
+        The first `n` entries of the result, read from as few files as possible. Waits for the
+        files as need be.
+        '''
+        data_type = self._data_type
+        parts = []
+        have = 0
+        index = 0
+        while have < n:
+            files = await self._wait_for_files(index + 1)
+            if len(files) <= index:
+                break
+            part = await self.read_file_async(files[index], columns, entry_stop=n - have)
+            have += len(next(iter(part.values()))) if data_type == 'awkward' else len(part)
+            parts.append(part)
+            index += 1
+        if len(parts) == 0:
+            raise sx.ServiceX_Exception('The query did not produce any files.')
+        return sx._concat_results(parts, data_type)
+
+    def head(self, n: int = 5, columns: Optional[List[str]] = None) -> Any:
+        return _run(self.head_async(n, columns))
+
+    async def _materialize(self, data_type: str, columns: Optional[List[str]]) -> Any:
+        'Download and load all the files, through the local cache'
+        columns = columns if columns is not None else self._columns
+        cache_key = query_cache_key(self._json_query, data_type, columns, self._dtypes)
+        cached = await sx._cache_lookup(sx.query_cache, cache_key)
+        if cached is not None:
+            return cached
+
+        client = self._adaptor.session()
+        downloader = sx._new_downloader(self._adaptor.minio_client, client)
+        return await sx._run_shared_query(
+            self._adaptor.endpoint, cache_key, True,
+            lambda: sx._run_query(client, self._adaptor.endpoint, self._adaptor.minio_client,
+                                  downloader, self._json_query, data_type, columns=columns,
+                                  dtypes=self._dtypes, request_id=self._request_id))
+
+    async def to_pandas_async(self, columns: Optional[List[str]] = None) -> pd.DataFrame:
+        'Download and load the whole result (or just `columns` of it) as a DataFrame'
+        return await self._materialize('pandas', columns)
+
+    def to_pandas(self, columns: Optional[List[str]] = None) -> pd.DataFrame:
+        return _run(self.to_pandas_async(columns))
+
+    async def to_awkward_async(self, columns: Optional[List[str]] = None) \
+            -> Dict[bytes, np.ndarray]:
+        'Download and load the whole result (or just `columns` of it) as awkward arrays'
+        return await self._materialize('awkward', columns)
+
+    def to_awkward(self, columns: Optional[List[str]] = None) -> Dict[bytes, np.ndarray]:
+        return _run(self.to_awkward_async(columns))
+
+    async def iter_files_async(self, max_in_flight: int = 5) \
+            -> AsyncIterator[Union[pd.DataFrame, Dict[bytes, np.ndarray]]]:
+        '''
+        Download and load each file, and return them one at a time in the order they finish
+        downloading. At most `max_in_flight` files are held at once.
+        '''
+        client = self._adaptor.session()
+        downloader = sx._new_downloader(self._adaptor.minio_client, client)
+        files = sx._stream_query_files(client, self._adaptor.endpoint,
+                                       self._adaptor.minio_client, downloader, self._json_query,
+                                       self._data_type, max_in_flight=max_in_flight,
+                                       columns=self._columns, dtypes=self._dtypes,
+                                       request_id=self._request_id)
+        try:
+            async for _, data in files:
+                yield data
+        finally:
+            await files.aclose()
+
+    def iter_files(self, max_in_flight: int = 5) \
+            -> Iterator[Union[pd.DataFrame, Dict[bytes, np.ndarray]]]:
+        return sx._iterate_sync(self.iter_files_async(max_in_flight))
+
+
+async def get_data_lazy_async(selection_query: str, dataset: str,
+                              servicex_endpoint: str = 'http://localhost:5000/servicex',
+                              data_type: str = 'pandas',
+                              image: str = 'sslhep/servicex_xaod_cpp_transformer:v0.2',
+                              servicex_adaptor: Optional[ServiceXAdaptor] = None,
+                              result_format: str = 'root-file',
+                              columns: Optional[List[str]] = None,
+                              dtypes: Optional[Dict[str, Any]] = None,
+                              workers: Optional[int] = None,
+                              chunk_size: Optional[int] = None,
+                              size_hint: Optional[int] = None) -> LazyResult:
+    '''
+    Submit a query, and return a handle on its result as soon as ServiceX has accepted it.
+    Nothing is downloaded until it is asked for through the handle.
+
+    Arguments:
+        selection_query     `qastle` string that specifies what columnes to extract, how to format
+                            them, and how to format them.
+        dataset             Dataset to run the query against
+        servicex_endpoint   The URL where the instance of ServivceX we are querying lives
+        data_type           How the data should come back by default: 'pandas', 'awkward', or
+                            'arrow'
+        image               ServiceX image that should run this
+        servicex_adaptor    Connections to ServiceX to use. If None, a shared adaptor for
+                            `servicex_endpoint` is used.
+        result_format       The file format ServiceX should write: 'root-file' or 'parquet'.
+        columns             Names of the columns to read by default. None means all of them.
+        dtypes              numpy types to convert columns to as they are read, by column name.
+        workers, chunk_size, size_hint
+                            The size of the transform, as for `get_data_async`.
+
+    Returns:
+        result              A `LazyResult` for the query
+    '''
+    datasets = sx._check_arguments(dataset, data_type, result_format, columns, dtypes)
+    if len(datasets) != 1:
+        raise sx.ServiceX_Exception('Only a single dataset can be queried lazily.')
+
+    json_query = sx._build_json_query(selection_query, datasets[0], image, result_format)
+    adaptor = servicex_adaptor or sx._default_adaptor(servicex_endpoint)
+    transform_size = sx._transform_size(json_query, workers, chunk_size, size_hint)
+    request_id, _ = await sx._submit_query(adaptor.session(), adaptor.endpoint, json_query,
+                                           transform_size=transform_size)
+    return LazyResult(adaptor, json_query, request_id, data_type, columns, dtypes)
+
+
+def get_data_lazy(selection_query: str, dataset: str,
+                  servicex_endpoint: str = 'http://localhost:5000/servicex',
+                  data_type: str = 'pandas',
+                  image: str = 'sslhep/servicex_xaod_cpp_transformer:v0.2',
+                  servicex_adaptor: Optional[ServiceXAdaptor] = None,
+                  result_format: str = 'root-file',
+                  columns: Optional[List[str]] = None,
+                  dtypes: Optional[Dict[str, Any]] = None,
+                  workers: Optional[int] = None,
+                  chunk_size: Optional[int] = None,
+                  size_hint: Optional[int] = None) -> LazyResult:
+    '''
+    Submit a query, and return a handle on its result. See `get_data_lazy_async` for a
+    description of the arguments.
+    '''
+    return _run(get_data_lazy_async(selection_query, dataset, servicex_endpoint, data_type,
+                                    image=image, servicex_adaptor=servicex_adaptor,
+                                    result_format=result_format, columns=columns,
+                                    dtypes=dtypes, workers=workers, chunk_size=chunk_size,
+                                    size_hint=size_hint))
@@ -0,0 +1,511 @@
+# Download files from the minio object store that ServiceX writes its results to.
+import asyncio
+import concurrent.futures
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import os
+import re
+import tempfile
+import time
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set, Tuple, Union  # NOQA: F401
+import urllib
+
+import aiohttp
+import certifi
+import numpy as np
+from minio import Minio, ResponseError
+from minio.error import NoSuchBucket
+from retry import retry
+import urllib3
+
+
+def new_minio_client(end_point: str, minio_endpoint: Optional[str] = None,
+                     access_key: str = 'miniouser', secret_key: str = 'leftfoot1',
+                     secure: bool = False, pool_size: Optional[int] = None) -> Minio:
+    '''
+    Create a client for the minio object store that lives with the ServiceX instance
+
+    Arguments:
+        end_point           Web API address where servicex lives
+        minio_endpoint      host:port of the object store. If None, we assume it is on port 9000
+                            of the same host as ServiceX.
+        access_key          Object store credentials
+        secret_key          Object store credentials
+        secure              If True, use https to talk to the object store
+        pool_size           Maximum number of connections to keep open to the object store. If
+                            None, use the minio default.
+    '''
+    if minio_endpoint is None:
+        # We need to assume where the minio port is and go from there.
+        end_point_parse = urllib.parse.urlparse(end_point)
+        minio_endpoint = f'{end_point_parse.hostname}:9000'
+
+    # Same as the minio default connection pool, but with our size.
+    http_client = None if pool_size is None \
+        else urllib3.PoolManager(timeout=urllib3.Timeout.DEFAULT_TIMEOUT,
+                                 maxsize=pool_size,
+                                 cert_reqs='CERT_REQUIRED',
+                                 ca_certs=os.environ.get('SSL_CERT_FILE') or certifi.where(),
+                                 retries=urllib3.Retry(total=5, backoff_factor=0.2,
+                                                       status_forcelist=[500, 502, 503, 504]))
+
+    # Setting the region means minio does not have to ask the server for it when it
+    # builds a pre-signed url.
+    return Minio(minio_endpoint,
+                 access_key=access_key,
+                 secret_key=secret_key,
+                 secure=secure,
+                 region='us-east-1',
+                 http_client=http_client)
+
+
+@retry(delay=1, tries=10, exceptions=ResponseError)
+def protected_list_objects(client: Minio, request_id: str, start_after: str = '') -> List[Any]:
+    'Return a list of objects in a minio bucket, starting after the given name'
+    # The minio call returns a generator, so read it all in here where we can retry failures.
+    return list(client.list_objects_v2(request_id, start_after=start_after))
+
+
+class ObjectDiscovery:
+    '''
+    Find the objects ServiceX has written to a request's bucket, returning each one only once.
+
+    Object names come back from a listing in sorted order, so each listing starts after the last
+    name we've already seen. A new object whose name sorts before that will be missed by an
+    incremental listing - so if we know more files have been processed than we've found, we
+    fall back to listing everything.
+    '''
+    def __init__(self, minio_client: Minio, bucket: str, seen: Iterable[str] = ()):
+        '''
+        Arguments:
+            minio_client        Client for the object store
+            bucket              The bucket to look in (the ServiceX request id)
+            seen                Objects that are already known about, and so won't be returned
+        '''
+        self._client = minio_client
+        self._bucket = bucket
+        self._seen = set(seen)  # type: Set[str]
+        self._info = {}  # type: Dict[str, Tuple[Optional[int], Optional[str]]]
+        self._cursor = ''
+
+    @property
+    def count(self) -> int:
+        'The number of objects found so far'
+        return len(self._seen)
+
+    def object_info(self, object_name: str) -> Tuple[Optional[int], Optional[str]]:
+        'The size and ETag the listing gave for an object. Either is None if not known.'
+        return self._info.get(object_name, (None, None))
+
+    def _list(self, start_after: str) -> List[str]:
+        try:
+            objects = protected_list_objects(self._client, self._bucket, start_after=start_after)
+        except NoSuchBucket:
+            # ServiceX hasn't written anything yet
+            return []
+        names = [o.object_name for o in objects]
+        for o in objects:
+            self._info[o.object_name] = (o.size if isinstance(o.size, int) else None,
+                                         o.etag if isinstance(o.etag, str) else None)
+        new_names = [n for n in names if n not in self._seen]
+        self._seen.update(new_names)
+        if len(names) > 0:
+            self._cursor = max(self._cursor, max(names))
+        return new_names
+
+    def new_objects(self, files_processed: int = 0) -> List[str]:
+        '''
+        Return the objects that have appeared since we last looked. This makes blocking calls.
+
+        Arguments:
+            files_processed     The number of files ServiceX says it has finished. If, after
+                                an incremental listing, we have found fewer objects than this,
+                                everything is listed again to find the ones we missed.
+        '''
+        new_names = self._list(self._cursor)
+        if self.count < files_processed:
+            new_names += self._list('')
+        return new_names
+
+
+class ObjectStoreDownloader:
+    '''
+    Base class for something that can copy a file out of the object store to local disk. Derive
+    from this to add a new way of fetching files.
+    '''
+    async def download_file(self, bucket: str, object_name: str, local_path: str) -> None:
+        '''
+        Copy an object from the object store to a local file.
+
+        Arguments:
+            bucket              The bucket the object lives in (the ServiceX request id)
+            object_name         Name of the object in the bucket
+            local_path          Path of the file to write. Overwritten if it exists.
+        '''
+        raise NotImplementedError()
+
+    async def download_data(self, bucket: str, object_name: str, max_in_memory_size: int) \
+            -> Union[bytearray, str]:
+        '''
+        Fetch an object from the object store, into memory if it is small enough.
+
+        Arguments:
+            bucket              The bucket the object lives in (the ServiceX request id)
+            object_name         Name of the object in the bucket
+            max_in_memory_size  Objects larger than this many bytes are written to a temp file
+                                instead of being kept in memory.
+
+        Returns:
+            data                The contents of the object, or the path of the temp file they
+                                were written to. The caller must delete the temp file.
+        '''
+        # Without a way to fetch into memory, everything goes into a temp file. Use a unique
+        # name so two requests can never step on each other.
+        fd, local_path = tempfile.mkstemp(suffix='.root')
+        os.close(fd)
+        try:
+            await self.download_file(bucket, object_name, local_path)
+        except BaseException:
+            os.remove(local_path)
+            raise
+        return local_path
+
+
+def _remove_quietly(path: str) -> None:
+    'Remove a file if it is there'
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def _downloaded_size(data: Union[bytearray, str]) -> int:
+    'Number of bytes in a downloaded file, held in memory or on local disk'
+    return os.path.getsize(data) if isinstance(data, str) else len(data)
+
+
+def _discard_future_result(future: Union[asyncio.Future, concurrent.futures.Future]) -> None:
+    'Done callback for a download no one wants any more: remove any temp file it wrote'
+    if not future.cancelled() and future.exception() is None \
+            and isinstance(future.result(), str):
+        _remove_quietly(future.result())
+
+
+class _SpillBuffer:
+    '''
+    Accumulate data in memory until it grows beyond a limit, after which everything is written
+    to a temp file instead.
+    '''
+    def __init__(self, max_in_memory_size: int):
+        self._max_size = max_in_memory_size
+        self._buffer = bytearray()  # type: Optional[bytearray]
+        self._file = None
+        self._path = None  # type: Optional[str]
+
+    def write(self, data: bytes) -> None:
+        if self._buffer is not None and len(self._buffer) + len(data) > self._max_size:
+            fd, self._path = tempfile.mkstemp(suffix='.root')
+            self._file = os.fdopen(fd, 'wb')
+            self._file.write(self._buffer)
+            self._buffer = None
+        if self._buffer is not None:
+            self._buffer.extend(data)
+        else:
+            self._file.write(data)
+
+    def close(self) -> Union[bytearray, str]:
+        'Finish writing, and return the data or the path to the temp file'
+        if self._file is not None:
+            self._file.close()
+            return self._path
+        return self._buffer
+
+    def discard(self) -> None:
+        'Something went wrong - clean up anything that made it to disk'
+        if self._file is not None:
+            self._file.close()
+            os.remove(self._path)
+
+
+class MinioThreadDownloader(ObjectStoreDownloader):
+    '''
+    Download files with the `minio` client. The minio library uses blocking http requests,
+    so each download runs on a thread from a pool, which also sets how many downloads can
+    run at once.
+    '''
+    def __init__(self, minio_client: Minio, executor: ThreadPoolExecutor):
+        self._client = minio_client
+        self._executor = executor
+
+    async def download_file(self, bucket: str, object_name: str, local_path: str) -> None:
+        future = self._executor.submit(self._client.fget_object, bucket, object_name, local_path)
+        try:
+            await asyncio.wrap_future(future)
+        except asyncio.CancelledError:
+            # The thread can't be stopped, and will leave the file behind when it finishes.
+            future.add_done_callback(lambda _: _remove_quietly(local_path))
+            raise
+
+    def _get_object(self, bucket: str, object_name: str, max_in_memory_size: int) \
+            -> Union[bytearray, str]:
+        'Stream an object into memory (or a temp file if it is too big) - blocks'
+        response = self._client.get_object(bucket, object_name)
+        buffer = _SpillBuffer(max_in_memory_size)
+        try:
+            for data in response.stream(amt=1024 * 1024):
+                buffer.write(data)
+        except BaseException:
+            buffer.discard()
+            raise
+        finally:
+            response.release_conn()
+        return buffer.close()
+
+    async def download_data(self, bucket: str, object_name: str, max_in_memory_size: int) \
+            -> Union[bytearray, str]:
+        if max_in_memory_size <= 0:
+            return await super().download_data(bucket, object_name, max_in_memory_size)
+        future = self._executor.submit(self._get_object, bucket, object_name, max_in_memory_size)
+        try:
+            return await asyncio.wrap_future(future)
+        except asyncio.CancelledError:
+            # The thread can't be stopped - clean up whatever it leaves when it finishes.
+            future.add_done_callback(_discard_future_result)
+            raise
+
+
+class AioHttpDownloader(ObjectStoreDownloader):
+    '''
+    Download files over `aiohttp` on the event loop that is already running the
+    status polling. Requests are made with pre-signed urls from the minio client, so there are
+    no blocking calls. Large files are fetched in several parts at once with http range
+    requests.
+    '''
+    def __init__(self, minio_client: Minio, client: aiohttp.ClientSession,
+                 max_concurrent: int = 20, part_size: int = 16 * 1024 * 1024):
+        '''
+        Arguments:
+            minio_client        Used to build the pre-signed urls
+            client              The session to make the requests on (and reuse the
+                                connections of)
+            max_concurrent      Maximum number of http requests that can be running at once
+            part_size           Files larger than this are fetched in parts of this size
+        '''
+        self._minio = minio_client
+        self._client = client
+        self._limit = asyncio.Semaphore(max_concurrent)
+        self._part_size = part_size
+
+    async def _get_range(self, url: str, start: int, stop: int) \
+            -> Tuple[bytes, Optional[int]]:
+        '''
+        Fetch bytes [start, stop) of the url. Returns the data and the total size of the object
+        if the server honored the range request, or None if it sent back the whole object.
+        '''
+        headers = {'Range': f'bytes={start}-{stop - 1}'}
+        async with self._limit:
+            async with self._client.get(url, headers=headers) as response:
+                if response.status not in (200, 206):
+                    raise BaseException(f'Unable to download object - http error '
+                                        f'{response.status}')
+                data = await response.read()
+                if response.status == 200:
+                    return data, None
+                content_range = re.match(r'bytes \d+-\d+/(\d+)',
+                                         response.headers.get('Content-Range', ''))
+                return data, None if content_range is None else int(content_range[1])
+
+    async def download_file(self, bucket: str, object_name: str, local_path: str) -> None:
+        url = self._minio.presigned_get_object(bucket, object_name)
+
+        # The first part tells us how large the object is, so we know how many other
+        # parts to ask for.
+        first, total_size = await self._get_range(url, 0, self._part_size)
+        await self._write_file(url, object_name, first, total_size, local_path)
+
+    async def _write_file(self, url: str, object_name: str, first: bytes,
+                          total_size: Optional[int], local_path: str) -> None:
+        'Write the first part, and fetch and write all the others, to a local file'
+        parts = [] if total_size is None \
+            else [(start, min(start + self._part_size, total_size))
+                  for start in range(self._part_size, total_size, self._part_size)]
+
+        with open(local_path, 'wb') as f_out:
+            f_out.write(first)
+
+            # Each part is written as soon as it arrives. Everything runs on the one event loop
+            # thread, so the seek and write can't be interleaved with another part's.
+            async def fetch_part(start: int, stop: int):
+                data, _ = await self._get_range(url, start, stop)
+                f_out.seek(start)
+                f_out.write(data)
+
+            await asyncio.gather(*[fetch_part(start, stop) for start, stop in parts])
+
+        if total_size is not None and os.path.getsize(local_path) != total_size:
+            raise BaseException(f'Downloaded {os.path.getsize(local_path)} bytes of '
+                                f'{object_name}, but expected {total_size}.')
+
+    async def download_data(self, bucket: str, object_name: str, max_in_memory_size: int) \
+            -> Union[bytearray, str]:
+        url = self._minio.presigned_get_object(bucket, object_name)
+        first, total_size = await self._get_range(url, 0, self._part_size)
+
+        if total_size is not None and total_size > max_in_memory_size:
+            # Too big to hold - write it to a temp file instead.
+            fd, local_path = tempfile.mkstemp(suffix='.root')
+            os.close(fd)
+            try:
+                await self._write_file(url, object_name, first, total_size, local_path)
+            except BaseException:
+                os.remove(local_path)
+                raise
+            return local_path
+
+        if total_size is None:
+            # The server sent the whole thing back in one go.
+            return bytearray(first)
+
+        # Fill in each part of the buffer as it arrives.
+        buffer = bytearray(total_size)
+        buffer[0:len(first)] = first
+
+        async def fetch_part(start: int, stop: int):
+            data, _ = await self._get_range(url, start, stop)
+            buffer[start:start + len(data)] = data
+
+        await asyncio.gather(*[fetch_part(start, min(start + self._part_size, total_size))
+                               for start in range(len(first), total_size, self._part_size)])
+        return buffer
+
+
+def _md5(data: Union[bytearray, str]) -> str:
+    'Return the md5 hex digest of some data, or of the contents of a file - blocks'
+    if not isinstance(data, str):
+        return hashlib.md5(data).hexdigest()
+    digest = hashlib.md5()
+    with open(data, 'rb') as f_in:
+        for block in iter(lambda: f_in.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class ResilientDownloader(ObjectStoreDownloader):
+    '''
+    Wrap another downloader to make it robust against failed, corrupt, and slow downloads:
+
+    - A download that fails is tried again, after a delay that doubles each time.
+    - What arrives is checked against the size (and, optionally, the md5 ETag) the object
+      store listed for the object. A mismatch counts as a failure.
+    - Optionally, a download that is taking much longer than the others have is hedged: a
+      second copy is started, and whichever finishes first is used.
+    '''
+    def __init__(self, downloader: ObjectStoreDownloader,
+                 object_info: Callable[[str], Tuple[Optional[int], Optional[str]]],
+                 tries: int = 3, retry_delay: float = 1.0, verify: Optional[str] = 'size',
+                 hedge_percentile: Optional[float] = None, hedge_min_samples: int = 5):
+        '''
+        Arguments:
+            downloader          Does the actual downloading
+            object_info         Returns the expected size and ETag of an object (either can
+                                be None if not known). See `ObjectDiscovery.object_info`.
+            tries               Number of times to try each download before giving up
+            retry_delay         Seconds to wait before the first retry. Doubles for each one.
+            verify              None, 'size', or 'etag' (size and, for objects that were not
+                                uploaded in parts, the md5 checksum)
+            hedge_percentile    If not None, a download that has been running longer than this
+                                percentile of the downloads that have finished is started a
+                                second time.
+            hedge_min_samples   The number of downloads that must have finished before any are
+                                hedged.
+        '''
+        self._downloader = downloader
+        self._object_info = object_info
+        self._tries = max(1, tries)
+        self._retry_delay = retry_delay
+        self._verify = verify
+        self._hedge_percentile = hedge_percentile
+        self._hedge_min_samples = hedge_min_samples
+        self._latencies = []  # type: List[float]
+
+    async def _check(self, object_name: str, data: Union[bytearray, str]) -> None:
+        'Raise if the data is not what the object store listed'
+        if self._verify is None:
+            return
+        size, etag = self._object_info(object_name)
+        actual_size = _downloaded_size(data)
+        if size is not None and actual_size != size:
+            raise BaseException(f'Downloaded {actual_size} bytes of {object_name}, but '
+                                f'expected {size}.')
+        # A multi-part upload's ETag isn't an md5 of the contents.
+        if self._verify == 'etag' and etag is not None and '-' not in etag:
+            checksum = await asyncio.get_event_loop().run_in_executor(None, _md5, data)
+            if checksum != etag:
+                raise BaseException(f'Downloaded {object_name} has md5 {checksum}, but '
+                                    f'expected {etag}.')
+
+    async def _with_retries(self, object_name: str, fetch: Callable[[], Any]) -> Any:
+        'Run a download, checking what it returns, until it works or we run out of tries'
+        for attempt in range(self._tries):
+            try:
+                data = await fetch()
+                try:
+                    await self._check(object_name, data)
+                except BaseException:
+                    if isinstance(data, str):
+                        _remove_quietly(data)
+                    raise
+                return data
+            except (asyncio.CancelledError, KeyboardInterrupt, SystemExit):
+                raise
+            except BaseException:
+                if attempt == self._tries - 1:
+                    raise
+            await asyncio.sleep(self._retry_delay * (2 ** attempt))
+
+    def _hedge_after(self) -> Optional[float]:
+        'Seconds after which a download should be hedged, or None if it should not be'
+        if self._hedge_percentile is None or len(self._latencies) < self._hedge_min_samples:
+            return None
+        return float(np.percentile(self._latencies, self._hedge_percentile))
+
+    async def download_file(self, bucket: str, object_name: str, local_path: str) -> None:
+        # Two downloads can't write to the same file, so this one is never hedged.
+        async def fetch():
+            await self._downloader.download_file(bucket, object_name, local_path)
+            return local_path
+        await self._with_retries(object_name, fetch)
+
+    async def download_data(self, bucket: str, object_name: str, max_in_memory_size: int) \
+            -> Union[bytearray, str]:
+        def start() -> asyncio.Future:
+            return asyncio.ensure_future(self._with_retries(
+                object_name,
+                lambda: self._downloader.download_data(bucket, object_name,
+                                                       max_in_memory_size)))
+
+        started = time.monotonic()
+        hedge_after = self._hedge_after()
+        running = [start()]
+        try:
+            if hedge_after is not None:
+                done, _ = await asyncio.wait(running, timeout=hedge_after)
+                if len(done) == 0:
+                    running.append(start())
+
+            # Use the first one to work. Only give up if they all fail.
+            while True:
+                done, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+                running = [f for f in running if f not in done]
+                worked = [f for f in done if f.exception() is None]
+                if len(worked) > 0:
+                    for f in worked[1:]:
+                        _discard_future_result(f)
+                    self._latencies.append(time.monotonic() - started)
+                    return worked[0].result()
+                if len(running) == 0:
+                    raise done.pop().exception()
+        finally:
+            for f in running:
+                f.cancel()
+                f.add_done_callback(_discard_future_result)
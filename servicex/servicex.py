@@ -1,24 +1,168 @@
 # Main front end interface
 import asyncio
-from concurrent.futures import ThreadPoolExecutor
+import atexit
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import hashlib
+import multiprocessing
 import os
+import shutil
 import tempfile
-from typing import Any, Dict, Iterable, List, Optional, Tuple, Union
-import urllib
+import threading
+import time
+from typing import (Any, AsyncIterator, Awaitable, Callable, Dict, Iterable, Iterator, List,
+                    Optional, Tuple, Union)
 
 import aiohttp
 import awkward
-from minio import Minio, ResponseError
-import nest_asyncio
+from minio import Minio
 import numpy as np
 import pandas as pd
-from retry import retry
-import uproot
 
+try:
+    import pyarrow as pa
+except ImportError:  # pragma: no cover
+    pa = None
+
+from .cache import QueryCache, query_cache_key, user_cache_path
+from .decode import (read_file, read_file_in_process, read_root_file_into, root_file_layout,
+                     unpack_decoded)
+from .instrumentation import EventHook, Instrumentation, QueryStats
+from .journal import journal_key, JournaledDownloader, QueryJournal
+from .minio_adaptor import (_downloaded_size, AioHttpDownloader, MinioThreadDownloader,
+                            ObjectDiscovery, ObjectStoreDownloader, ResilientDownloader)
+from .servicex_adaptor import (PollSchedule, ServiceXAdaptor, StatusTracker,  # NOQA: F401
+                               TransformStatusChannel)
+from .shared_cache import SharedFileCache
+from .sizing import choose_transform_size, TransformHistory, TransformSize
+from .spill import data_size, spill, SpilledData
 
 # Number of seconds to wait between polling servicex for the status of a transform job
-# while waiting for it to finish.
+# while waiting for it to finish. Polling starts at the minimum, backs off by the backoff factor
+# each time nothing has changed, up to the maximum (`servicex_status_poll_time`), and drops back
+# to the minimum when more files have been processed.
 servicex_status_poll_time = 5.0
+servicex_status_poll_min_time = 0.25
+servicex_status_poll_backoff = 2.0
+
+# If ServiceX can push status updates (or supports long-polling), set this to a
+# `TransformStatusChannel` that listens for them. Polling is used whenever it has nothing.
+servicex_status_channel = None  # type: Optional[TransformStatusChannel]
+
+# The status of all the transforms running against an endpoint is fetched by one task (see
+# `StatusTracker`). This is the most status requests it sends at once, and how close together
+# (in seconds) polls of different transforms must come due to be sent in the same round.
+servicex_status_concurrency = 10
+servicex_status_batch_window = 0.1
+
+# How large a transform is asked for - its number of "workers" and its "chunk-size":
+#   None        Always `servicex_transform_workers` and `servicex_transform_chunk_size`
+#   'auto'      Sized from how much the query is expected to produce: the `size_hint` given to
+#               the query, or else what the same query (or, failing that, any query against the
+#               same dataset) produced last time (see `transform_history`). There is one worker
+#               per file, up to `servicex_transform_max_workers`, and larger files get larger
+#               chunks. The download concurrency is raised to match the number of workers, up to
+#               `servicex_max_download_concurrency`.
+# The `workers` and `chunk_size` arguments of a query override both.
+servicex_transform_sizing = None  # type: Optional[str]
+servicex_transform_workers = 5
+servicex_transform_chunk_size = 1000
+servicex_transform_max_workers = 200
+servicex_max_download_concurrency = 20
+
+# How files are downloaded from the object store:
+#   'minio'     The minio client, run on a pool of threads (it makes blocking calls)
+#   'aiohttp'   aiohttp on the same event loop as everything else, with large files fetched
+#               in several parts at once.
+# An instance of an `ObjectStoreDownloader` can also be used.
+servicex_download_method = 'minio'
+
+# Maximum number of downloads (or, for aiohttp, http requests) that run at once.
+servicex_download_concurrency = 5
+
+# When downloading with aiohttp, files larger than this many bytes are fetched in parts.
+servicex_download_part_size = 16 * 1024 * 1024
+
+# Each file download is tried this many times before the query fails. The first retry waits
+# `servicex_download_retry_delay` seconds, and each one after that waits twice as long.
+servicex_download_tries = 3
+servicex_download_retry_delay = 1.0
+
+# What is downloaded is checked against the object store's listing: None (no check), 'size', or
+# 'etag' (the size and, where the object store has one, the md5 checksum). A mismatch counts
+# as a failed try.
+servicex_download_verify = 'size'  # type: Optional[str]
+
+# If set, a download that has been running longer than this percentile of those that have
+# already finished for the query is started a second time, and whichever copy arrives first is
+# used. This stops a few slow objects from holding up a whole query.
+servicex_download_hedge_percentile = None  # type: Optional[float]
+
+# Files up to this many bytes are downloaded into memory and read directly from there. Larger
+# files are written to a temp file that is removed after it has been read. 0 means files are
+# always written to a temp file.
+servicex_in_memory_max_size = 0
+
+# Number of worker processes the downloaded files are read (decompressed and converted to numpy
+# arrays) in. Reading is mostly bound by the python GIL, so threads do not help much. The
+# arrays are handed back through shared memory. 0 means files are read on a small pool of
+# threads in this process instead.
+servicex_decode_processes = 0
+
+# If True, the complete result of `get_data` is built without first loading each file on its
+# own and then copying them all together. All the files are downloaded, their sizes are read
+# from the ROOT metadata, the result is allocated once, and each file is then read straight
+# into its place in it and freed. This roughly halves the peak memory needed for a large
+# result, but files are not read while the others are still downloading. It is used for
+# pandas and awkward results from ROOT files when every column has one number per entry and
+# `servicex_decode_processes` is 0.
+servicex_preallocate_results = False
+
+# Limit on the total size, in bytes (as listed by the object store), of the files that are being
+# downloaded and loaded at once. New downloads wait until there is room - though one file is
+# always allowed, however large. None means no limit.
+servicex_max_in_flight_bytes = None  # type: Optional[int]
+
+# Limit on the memory, in bytes, taken up by loaded files that are waiting for the rest of the
+# query so they can be put together. Beyond it each newly loaded file is written out to local
+# columnar files (numpy `.npy`, or arrow IPC files), which are memory mapped back in when the
+# result is put together. None means everything is kept in memory.
+servicex_max_decoded_bytes = None  # type: Optional[int]
+
+# Directory the files written out for `servicex_max_decoded_bytes` go in. None means the
+# system temp directory. They are removed when the query finishes.
+servicex_spill_directory = None  # type: Optional[str]
+
+# Results of previous queries are kept on local disk (in a directory of the temp directory that
+# belongs to the current user) so that re-running an identical query does not need to go back to
+# ServiceX. Replace this with a new `QueryCache` to move it or change its size.
+query_cache = QueryCache(user_cache_path('query_cache'))
+
+# The results of queries run with `incremental=True`, kept file by file (see
+# `_incremental_file_key`), so the next run only needs to fetch and save the files that are new.
+incremental_results = QueryCache(user_cache_path('incremental'))
+
+# A cache of loaded files that all the processes on this machine can share, e.g. in a directory
+# every user of a shared login node can write to. Files are taken from it (memory mapped) rather
+# than downloaded and loaded again, and a query whose files are all there does not go to
+# ServiceX at all. None means it is not used.
+servicex_shared_cache = None  # type: Optional[SharedFileCache]
+
+# Seconds to wait before checking again whether another process has finished downloading a file
+# to the shared cache.
+_shared_cache_lock_poll = 0.1
+
+# Each transform that is submitted is recorded on local disk (next to the query cache) until the
+# query completes. If the process dies part way through, running the same query again picks up
+# the same transform rather than submitting a new one. Use a `QueryJournal` with `keep_files`
+# set to also keep a copy of every file downloaded, so only the missing ones are downloaded
+# again. Set to None to turn this off.
+query_journal = QueryJournal(user_cache_path('journal'))  # type: Optional[QueryJournal]
+
+
+# How many files, and bytes, each query produced the last time it ran, for 'auto' transform
+# sizing. Set to None to turn off recording.
+transform_history = TransformHistory(user_cache_path('transform_history')) \
+    # type: Optional[TransformHistory]
 
 
 class ServiceX_Exception(BaseException):
@@ -65,181 +209,1284 @@ def santize_filename(fname: str):
                 .replace(':', '_')
 
 
-# Threadpool on which downloads occur. This is because the current minio library
-# uses blocking http requests, so we can't use asyncio to interleave them.
-_download_executor = ThreadPoolExecutor(max_workers=5)
+# Threadpool on which the ROOT files are read. This runs at the same time as the downloads.
+_decode_executor = ThreadPoolExecutor(max_workers=5)
+
+# Process pools for reading the ROOT files, by number of workers. Created when first needed.
+_decode_process_executors = {}  # type: Dict[int, ProcessPoolExecutor]
+
+# How the decode worker processes are started. A process forked while other threads (the event
+# loop, the download pools) hold locks can deadlock, so they are started from a clean process.
+_decode_process_start = 'forkserver' \
+    if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+
+# Threadpools for the minio downloads, by number of workers. The minio library uses blocking
+# http requests, so we can't use asyncio to interleave them.
+_download_executors = {}  # type: Dict[int, ThreadPoolExecutor]
+
+
+def _new_process_executor(max_workers: int) -> ProcessPoolExecutor:
+    'A pool of decode worker processes, started as `_decode_process_start` says'
+    context = multiprocessing.get_context(_decode_process_start)
+    try:
+        return ProcessPoolExecutor(max_workers=max_workers, mp_context=context)
+    except TypeError:  # pragma: no cover
+        # python 3.6 can't be told how to start them, and forks them.
+        return ProcessPoolExecutor(max_workers=max_workers)
+
+
+@atexit.register
+def _shutdown_decode_processes() -> None:
+    'Stop the decode worker processes, so none are left behind at exit'
+    while len(_decode_process_executors) > 0:
+        _, executor = _decode_process_executors.popitem()
+        executor.shutdown(wait=True)
 
 
-def _download_file(minio_client: Minio, request_id: str, bucket_fname: str, data_type: str) \
-        -> pd.DataFrame:
+async def _decode_file(data: Union[bytearray, str], data_type: str, result_format: str,
+                       columns: Optional[List[str]] = None,
+                       dtypes: Optional[Dict[str, Any]] = None) \
+        -> Union[pd.DataFrame, Dict[bytes, np.ndarray]]:
+    'Read a downloaded file on the thread pool, or in a worker process if configured'
+    if servicex_decode_processes <= 0:
+        return await asyncio.wrap_future(_decode_executor.submit(read_file, data, data_type,
+                                                                 result_format, columns,
+                                                                 dtypes))
+
+    if servicex_decode_processes not in _decode_process_executors:
+        _decode_process_executors[servicex_decode_processes] = \
+            _new_process_executor(servicex_decode_processes)
+    executor = _decode_process_executors[servicex_decode_processes]
+    payload = await asyncio.wrap_future(executor.submit(read_file_in_process, data, data_type,
+                                                        result_format, columns, dtypes))
+    return unpack_decoded(payload)
+
+
+async def _timed_download(downloader: ObjectStoreDownloader, request_id: str,
+                          bucket_fname: str, instrumentation: Optional[Instrumentation]) \
+        -> Union[bytearray, str]:
+    'Download a single file from the minio object store, and report how long it took'
+    with (instrumentation or Instrumentation()).timed('download', request_id=request_id,
+                                                      object_name=bucket_fname) as info:
+        data = await downloader.download_data(request_id, bucket_fname,
+                                              servicex_in_memory_max_size)
+        info['size'] = _downloaded_size(data)
+    return data
+
+
+async def _download_file(downloader: ObjectStoreDownloader, request_id: str, bucket_fname: str,
+                         data_type: str, result_format: str = 'root-file',
+                         columns: Optional[List[str]] = None,
+                         dtypes: Optional[Dict[str, Any]] = None,
+                         instrumentation: Optional[Instrumentation] = None,
+                         shared_key: Optional[str] = None) \
+        -> Union[pd.DataFrame, Dict[bytes, np.ndarray]]:
     '''
-    Download a single file to a local temp file from the minio object store
+    Download a single file from the minio object store, and load it (only `columns`, converted
+    to `dtypes`). If the file had to be written to local disk, it is removed once it has been
+    loaded. If `shared_key` is given the file is taken from, or added to, the shared cache.
     '''
-    local_filename = santize_filename(bucket_fname)
-    local_filepath = os.path.join(tempfile.gettempdir(), local_filename)
-    # TODO: clean up these temporary files when done?
-    minio_client.fget_object(request_id, bucket_fname, local_filepath)
+    instrumentation = instrumentation or Instrumentation()
+    cache = servicex_shared_cache
+    if cache is None or shared_key is None:
+        return await _download_and_decode_file(downloader, request_id, bucket_fname, data_type,
+                                               result_format, columns, dtypes, instrumentation)
 
-    # Load it into uproot and get the first and only key out of it.
-    f_in = uproot.open(local_filepath)
+    # Only one process downloads each file - the others wait for it and take its copy.
+    lock = cache.try_lock(shared_key, bucket_fname)
+    while lock is None:
+        await asyncio.sleep(_shared_cache_lock_poll)
+        lock = cache.try_lock(shared_key, bucket_fname)
     try:
-        r = f_in[f_in.keys()[0]]
-        if data_type == 'pandas':
-            return r.pandas.df()
-        elif data_type == 'awkward':
-            return r.arrays()
-        else:
-            raise BaseException(f'Internal coding error - {data_type} should not be known.')
+        with instrumentation.timed('shared-cache', object_name=bucket_fname) as info:
+            data = cache.lookup(shared_key, bucket_fname)
+            info['found'] = data is not None
+        if data is not None:
+            return data
+
+        data = await _download_and_decode_file(downloader, request_id, bucket_fname, data_type,
+                                               result_format, columns, dtypes, instrumentation)
+        try:
+            await asyncio.get_event_loop().run_in_executor(None, cache.save, shared_key,
+                                                           bucket_fname, data)
+        except OSError:
+            # The cache is only an optimization - e.g. a full disk should not stop the query.
+            pass
+        return data
+    finally:
+        lock.release()
+
+
+async def _download_and_decode_file(downloader: ObjectStoreDownloader, request_id: str,
+                                    bucket_fname: str, data_type: str, result_format: str,
+                                    columns: Optional[List[str]],
+                                    dtypes: Optional[Dict[str, Any]],
+                                    instrumentation: Instrumentation) \
+        -> Union[pd.DataFrame, Dict[bytes, np.ndarray]]:
+    'Download a single file and load it, removing the local copy if one was written'
+    data = await _timed_download(downloader, request_id, bucket_fname, instrumentation)
+    try:
+        with instrumentation.timed('decode', object_name=bucket_fname):
+            return await _decode_file(data, data_type, result_format, columns, dtypes)
+    finally:
+        if isinstance(data, str):
+            os.remove(data)
+
+
+async def _download_raw_file(downloader: ObjectStoreDownloader, request_id: str,
+                             bucket_fname: str, columns: Optional[List[str]] = None,
+                             dtypes: Optional[Dict[str, Any]] = None,
+                             instrumentation: Optional[Instrumentation] = None) \
+        -> Tuple[Union[bytearray, str], Optional[Tuple[int, Dict[bytes, Any]]]]:
+    '''
+    Download a single file from the minio object store without loading it, and look up the
+    layout of the data in it (see `root_file_layout`). The caller must remove the temp file if
+    one was written.
+    '''
+    data = await _timed_download(downloader, request_id, bucket_fname, instrumentation)
+    try:
+        layout = await asyncio.wrap_future(_decode_executor.submit(root_file_layout, data,
+                                                                   columns, dtypes))
+    except BaseException:
+        if isinstance(data, str):
+            os.remove(data)
+        raise
+    return data, layout
+
+
+# Connections to each ServiceX endpoint, shared by every query that does not bring its own.
+_adaptors = {}  # type: Dict[str, ServiceXAdaptor]
+
+
+def _default_adaptor(servicex_endpoint: str) -> ServiceXAdaptor:
+    'Return the shared adaptor for an endpoint'
+    if servicex_endpoint not in _adaptors:
+        _adaptors[servicex_endpoint] = ServiceXAdaptor(servicex_endpoint)
+    return _adaptors[servicex_endpoint]
+
+
+# Seconds to wait for each session of the shared adaptors to close when python exits
+_adaptor_close_timeout = 5.0
+
+
+@atexit.register
+def _close_default_adaptors() -> None:
+    'Close the connections of the adaptors the library created, so none are left open at exit'
+    for adaptor in list(_adaptors.values()):
+        try:
+            adaptor.close(_adaptor_close_timeout)
+        except Exception:
+            # Too late to report it - the process is going away anyway.
+            pass
+
+
+async def _cache_lookup(cache: QueryCache, key: str) -> Optional[Any]:
+    'Look up `key` in `cache` off the event loop - loading a large result takes a while'
+    return await asyncio.get_event_loop().run_in_executor(None, cache.lookup, key)
+
+
+async def _cache_save(cache: QueryCache, key: str, value: Any) -> None:
+    '''
+    Save `value` in `cache` off the event loop. If it can't be written, the result is still
+    good - it just won't be there next time.
+    '''
+    try:
+        await asyncio.get_event_loop().run_in_executor(None, cache.save, key, value)
+    except OSError:
+        pass
+
+
+class _SharedQuery:
+    'A query that is running, whose result identical queries made at the same time wait for'
+    def __init__(self):
+        self.future = None  # type: Optional[asyncio.Future]
+        self.waiters = 0
+        self.save_to_cache = False
+
+
+# Queries that are running, by event loop, endpoint, query, and whether they are incremental
+# (see `_run_shared_query`).
+_running_queries = {} \
+    # type: Dict[Tuple[asyncio.AbstractEventLoop, str, str, bool], _SharedQuery]
+
+
+async def _run_shared_query(servicex_endpoint: str, cache_key: str, use_cache: bool,
+                            run: Callable[[], Awaitable[Any]], incremental: bool = False) -> Any:
+    '''
+    Run a query, unless an identical one is already running, in which case wait for that one's
+    result instead. Every caller gets back the same result object.
+
+    Arguments:
+        servicex_endpoint   The URL where the instance of ServiceX lives
+        cache_key           Identifies the query and the form its results are returned in
+        use_cache           If True, the result is saved to the query cache (once, no matter how
+                            many callers share it)
+        run                 Runs the query - only called if it is not already running
+        incremental         True if `run` fetches the query incrementally. It then only shares
+                            with other incremental runs, as the files it fetches differ.
+
+    Returns:
+        result              The result of the query
+    '''
+    key = (asyncio.get_event_loop(), servicex_endpoint, cache_key, incremental)
+    shared = _running_queries.get(key)
+    if shared is None:
+        shared = _SharedQuery()
+
+        async def run_and_save() -> Any:
+            try:
+                r = await run()
+                if shared.save_to_cache:
+                    await _cache_save(query_cache, cache_key, r)
+                return r
+            finally:
+                del _running_queries[key]
+
+        _running_queries[key] = shared
+        shared.future = asyncio.ensure_future(run_and_save())
+    shared.save_to_cache = shared.save_to_cache or use_cache
+
+    # One caller giving up must not stop the query for the others - only the last one does.
+    shared.waiters += 1
+    try:
+        return await asyncio.shield(shared.future)
+    except asyncio.CancelledError:
+        if shared.waiters == 1:
+            shared.future.cancel()
+        raise
     finally:
-        f_in._context.source.close()
+        shared.waiters -= 1
 
 
-@retry(delay=1, tries=10, exceptions=ResponseError)
-def protected_list_objects(client: Minio, request_id: str):
-    'Return a list of objects in a minio bucket'
-    return client.list_objects(request_id)
+def _new_downloader(minio_client: Minio, client: aiohttp.ClientSession,
+                    concurrency: Optional[int] = None) -> ObjectStoreDownloader:
+    '''
+    Create the downloader for a query as configured by `servicex_download_method`, running
+    `concurrency` downloads at once (`servicex_download_concurrency` if None)
+    '''
+    concurrency = concurrency or servicex_download_concurrency
+    if servicex_download_method == 'minio':
+        if concurrency not in _download_executors:
+            _download_executors[concurrency] = ThreadPoolExecutor(max_workers=concurrency)
+        return MinioThreadDownloader(minio_client, _download_executors[concurrency])
+    elif servicex_download_method == 'aiohttp':
+        return AioHttpDownloader(minio_client, client, max_concurrent=concurrency,
+                                 part_size=servicex_download_part_size)
+    elif isinstance(servicex_download_method, ObjectStoreDownloader):
+        return servicex_download_method
+    else:
+        raise ServiceX_Exception(f'Unknown download method "{servicex_download_method}".')
+
+
+def _start_download(downloader: ObjectStoreDownloader, request_id: str, fname: str,
+                    data_type: str, result_format: str = 'root-file',
+                    download_only: bool = False, columns: Optional[List[str]] = None,
+                    dtypes: Optional[Dict[str, Any]] = None,
+                    instrumentation: Optional[Instrumentation] = None,
+                    shared_key: Optional[str] = None) -> asyncio.Future:
+    'Start downloading and loading (unless `download_only` is set) a file in the background'
+    if download_only:
+        return asyncio.ensure_future(_download_raw_file(downloader, request_id, fname, columns,
+                                                        dtypes, instrumentation))
+    return asyncio.ensure_future(_download_file(downloader, request_id, fname, data_type,
+                                                result_format, columns, dtypes,
+                                                instrumentation, shared_key))
+
+
+def _build_json_query(selection_query: str, dataset: str, image: str,
+                      result_format: str = 'root-file') -> Dict[str, Any]:
+    'Build the transform request that is sent to ServiceX'
+    return {
+        "did": dataset,
+        "selection": selection_query,
+        "image": image,
+        "result-destination": "object-store",
+        "result-format": result_format,
+        "chunk-size": 1000,
+        "workers": 5
+    }
 
 
-async def _download_new_files(files_queued: Iterable[str], end_point: str,
-                              request_id: str,
-                              data_type: str) -> Dict[str, Any]:
+def _transform_size(json_query: Dict[str, Any], workers: Optional[int] = None,
+                    chunk_size: Optional[int] = None,
+                    size_hint: Optional[int] = None) -> TransformSize:
     '''
-    Get the list of files in a minio bucket and download any files we've not already started. We
-    queue them up, and return a list of the futures that point to the files when they
-    are downloaded.
+    Decide how large a transform to ask for, as configured by `servicex_transform_sizing`.
+    `workers` and `chunk_size`, if given, are used as they are.
     '''
-    # We need to assume where the minio port is and go from there.
-    end_point_parse = urllib.parse.urlparse(end_point)
-    minio_endpoint = f'{end_point_parse.hostname}:9000'
+    size = TransformSize(servicex_transform_workers, servicex_transform_chunk_size,
+                         servicex_download_concurrency)
+    if servicex_transform_sizing == 'auto':
+        expected, files = size_hint, None
+        if expected is None and transform_history is not None:
+            previous = transform_history.lookup(json_query)
+            if previous is not None:
+                expected, files = previous['size'], previous['files']
+        size = choose_transform_size(expected, files, size, servicex_transform_max_workers,
+                                     servicex_max_download_concurrency)
+    elif servicex_transform_sizing is not None:
+        raise ServiceX_Exception(f'Unknown transform sizing "{servicex_transform_sizing}".')
+
+    if workers is not None:
+        size.workers = workers
+    if chunk_size is not None:
+        size.chunk_size = chunk_size
+    return size
+
+
+def _check_arguments(datasets: Union[str, List[str]], data_type: str,
+                     result_format: str = 'root-file', columns: Optional[List[str]] = None,
+                     dtypes: Optional[Dict[str, Any]] = None) -> List[str]:
+    'Clean up and check the arguments common to all the entry points'
+    if isinstance(datasets, str):
+        datasets = [datasets]
+    if len(datasets) == 0:
+        raise ServiceX_Exception('At least one dataset must be given.')
+
+    if data_type not in ('pandas', 'awkward', 'arrow'):
+        raise BaseException('Unknown return type.')
+    if result_format not in ('root-file', 'parquet'):
+        raise ServiceX_Exception(f'Unknown result format "{result_format}".')
+    if (data_type == 'arrow' or result_format == 'parquet') and pa is None:
+        raise ServiceX_Exception('The pyarrow package must be installed to use arrow or '
+                                 'parquet.')
+    if isinstance(columns, str):
+        raise ServiceX_Exception('columns must be a list of column names.')
+    if dtypes is not None:
+        try:
+            for t in dtypes.values():
+                np.dtype(t)
+        except TypeError as e:
+            raise ServiceX_Exception(f'Bad type in dtypes: {e}')
 
-    minio_client = Minio(minio_endpoint,
-                         access_key='miniouser',
-                         secret_key='leftfoot1',
-                         secure=False)
+    return datasets
 
-    files = list([f.object_name for f in protected_list_objects(minio_client, request_id)])  \
-        # type: List[str]
-    new_files = [fname for fname in files if fname not in files_queued]
 
-    # Submit in a thread pool so they can run and block concurrently.
-    futures = {fname: asyncio.wrap_future(_download_executor.submit(_download_file, minio_client,
-                                          request_id, fname, data_type))
-               for fname in new_files}
-    return futures
+def invalidate_cache(selection_query: str, datasets: Union[str, List[str]],
+                     data_type: str = 'pandas',
+                     image: str = 'sslhep/servicex_xaod_cpp_transformer:v0.2',
+                     result_format: str = 'root-file',
+                     columns: Optional[List[str]] = None,
+                     dtypes: Optional[Dict[str, Any]] = None):
+    '''
+    Remove the cached result of a query so the next request for it goes back to ServiceX.
+    The arguments must match those given to `get_data` or `get_data_async`.
+    '''
+    if isinstance(datasets, str):
+        datasets = [datasets]
+    for ds in datasets:
+        key = query_cache_key(_build_json_query(selection_query, ds, image, result_format),
+                              data_type, columns, dtypes)
+        query_cache.invalidate(key)
+        for fname in incremental_results.lookup(key) or []:
+            incremental_results.invalidate(_incremental_file_key(key, fname))
+        incremental_results.invalidate(key)
 
 
 async def get_data_async(selection_query: str, datasets: Union[str, List[str]],
                          servicex_endpoint: str = 'http://localhost:5000/servicex',
                          data_type: str = 'pandas',
-                         image: str = 'sslhep/servicex_xaod_cpp_transformer:v0.2') \
-        -> Union[pd.DataFrame, Dict[bytes, np.ndarray]]:
+                         image: str = 'sslhep/servicex_xaod_cpp_transformer:v0.2',
+                         use_cache: bool = True,
+                         combine_datasets: bool = False,
+                         servicex_adaptor: Optional[ServiceXAdaptor] = None,
+                         result_format: str = 'root-file',
+                         columns: Optional[List[str]] = None,
+                         dtypes: Optional[Dict[str, Any]] = None,
+                         stats: Optional[QueryStats] = None,
+                         event_hook: Optional[EventHook] = None,
+                         workers: Optional[int] = None,
+                         chunk_size: Optional[int] = None,
+                         size_hint: Optional[int] = None,
+                         incremental: bool = False) \
+        -> Union[pd.DataFrame, Dict[bytes, np.ndarray],
+                 Dict[str, Union[pd.DataFrame, Dict[bytes, np.ndarray]]]]:
     '''
     Return data from a query with data sets
 
     Arguments:
         selection_query     `qastle` string that specifies what columnes to extract, how to format
                             them, and how to format them.
-        datasets            Dataset or datasets to run the query against.
+        datasets            Dataset or list of datasets to run the query against. The transforms
+                            for a list of datasets are all run at the same time.
         service_endpoint    The URL where the instance of ServivceX we are querying lives
-        data_type           How should the data come back? 'pandas' and 'awkward' are the only
-                            legal values. Defaults to 'pandas'
+        data_type           How should the data come back? 'pandas', 'awkward', or 'arrow' (a
+                            `pyarrow.Table`). Defaults to 'pandas'
         image               ServiceX image that should run this
+        use_cache           If True, return the result of an identical previous query from the
+                            local cache if it is there, and save this result to the cache.
+        combine_datasets    If True and `datasets` is a list, return the results for all the
+                            datasets in one DataFrame or awkward array, with a `dataset` column
+                            holding the name of the dataset each row came from.
+        servicex_adaptor    Connections to ServiceX to use for this query. If given,
+                            `servicex_endpoint` is ignored. If None, a shared adaptor for
+                            `servicex_endpoint` is used.
+        result_format       The file format ServiceX should write: 'root-file' (the default) or
+                            'parquet'.
+        columns             Names of the columns to load. Only these are decompressed. None
+                            (the default) loads all of them.
+        dtypes              numpy types to convert columns to as they are read, by column name.
+                            For example, `{'JetPt': 'float32'}` halves the memory used by a
+                            `float64` column.
+        stats               A `QueryStats` to fill in with how long each part of the query took,
+                            and how much was downloaded.
+        event_hook          Called as `event_hook(event, info)` as each part of the query
+                            finishes. See `servicex.instrumentation` for the events.
+        workers             Number of workers to run each transform on. If None, see
+                            `servicex_transform_sizing`.
+        chunk_size          The "chunk-size" of each transform. If None, see
+                            `servicex_transform_sizing`.
+        size_hint           The number of bytes of results each dataset is expected to produce,
+                            used to size the transforms when `servicex_transform_sizing` is
+                            'auto'.
+        incremental         If True, always go back to ServiceX (the dataset may have grown),
+                            but only download the files that were not part of the last
+                            incremental run of this query, and add them to the result kept from
+                            then (see `incremental_results`). Files that are gone are dropped.
+
+    If an identical query is already running in this process (on the same event loop), its
+    transform and downloads are shared rather than started again, and both calls return the
+    same object. Only the call that started the query reports to its `stats` and `event_hook`.
 
     Returns:
-        df                  Pandas DataFrame that contains the resulting flat data, or an awkward
-                            array. Everything is in memory.
+        df                  Pandas DataFrame that contains the resulting flat data, an awkward
+                            array, or a `pyarrow.Table`. Everything is in memory. If
+                            `datasets` is a list, then a dictionary of these indexed by dataset
+                            name (unless `combine_datasets` is True).
     '''
-    # Parameter clean up
-    if isinstance(datasets, str):
-        datasets = [datasets]
-    assert len(datasets) == 1
+    single_dataset = isinstance(datasets, str)
+    datasets = _check_arguments(datasets, data_type, result_format, columns, dtypes)
 
-    if (data_type != 'pandas') and (data_type != 'awkward'):
-        raise BaseException('Unknown return type.')
+    # Build the queries. If we've already run them, then there is no need to go to ServiceX.
+    json_queries = [_build_json_query(selection_query, ds, image, result_format)
+                    for ds in datasets]
+    cache_keys = [query_cache_key(q, data_type, columns, dtypes) for q in json_queries]
+    if use_cache and not incremental:
+        results = list(await asyncio.gather(*[_cache_lookup(query_cache, k)
+                                              for k in cache_keys]))
+    else:
+        results = [None] * len(cache_keys)
+
+    # Run all the rest at once. They share a session and a downloader, so all the downloads are
+    # limited by the same concurrency budget. A query that is already running (e.g. started by
+    # another coroutine) is not started again - we wait for its result.
+    missing = [i for i, r in enumerate(results) if r is None]
+    if len(missing) > 0:
+        adaptor = servicex_adaptor or _default_adaptor(servicex_endpoint)
+        client = adaptor.session()
+        sizes = {i: _transform_size(json_queries[i], workers, chunk_size, size_hint)
+                 for i in missing}
+        downloader = _new_downloader(adaptor.minio_client, client,
+                                     max(s.download_concurrency for s in sizes.values()))
+        instrumentation = Instrumentation([stats, event_hook])
+
+        def run(i: int) -> Callable[[], Awaitable[Any]]:
+            if incremental:
+                return lambda: _run_query_incremental(client, adaptor.endpoint,
+                                                      adaptor.minio_client, downloader,
+                                                      json_queries[i], data_type,
+                                                      cache_keys[i], columns=columns,
+                                                      dtypes=dtypes,
+                                                      instrumentation=instrumentation,
+                                                      transform_size=sizes[i])
+            return lambda: _run_query(client, adaptor.endpoint, adaptor.minio_client,
+                                      downloader, json_queries[i], data_type, columns=columns,
+                                      dtypes=dtypes, instrumentation=instrumentation,
+                                      transform_size=sizes[i])
+
+        new_results = await asyncio.gather(*[_run_shared_query(adaptor.endpoint, cache_keys[i],
+                                                               use_cache, run(i), incremental)
+                                             for i in missing])
+        for i, r in zip(missing, new_results):
+            results[i] = r
+
+    if single_dataset:
+        return results[0]
+    if combine_datasets:
+        return _combine_datasets(datasets, results, data_type)
+    return dict(zip(datasets, results))
 
-    # Build the query, get a request ID back.
-    json_query = {
-        "did": datasets[0],
-        "selection": selection_query,
-        "image": image,
-        "result-destination": "object-store",
-        "result-format": "root-file",
-        "chunk-size": 1000,
-        "workers": 5
-    }
 
-    # Start the async context manager. We should use only one for the whole app, however,
-    # that just isn't going to work here. The advantage is better handling of connections.
-    # TODO: Option to pass in the connectino pool?
-    async with aiohttp.ClientSession() as client:
-        async with client.post(f'{servicex_endpoint}/transformation', json=json_query) as response:
+def _concat_results(all_files: List[Union[pd.DataFrame, Dict[bytes, np.ndarray]]],
+                    data_type: str) -> Union[pd.DataFrame, Dict[bytes, np.ndarray]]:
+    'Stich together the data from several files'
+    assert len(all_files) > 0
+    if len(all_files) == 1:
+        return all_files[0]
+    else:
+        if data_type == 'pandas':
+            r = pd.concat(all_files)
+            assert isinstance(r, pd.DataFrame)
+            return r
+        elif data_type == 'awkward':
+            col_names = all_files[0].keys()
+            return {c: awkward.concatenate([ar[c] for ar in all_files]) for c in col_names}
+        elif data_type == 'arrow':
+            # Each file's table becomes a chunk of the result - nothing is copied.
+            return pa.concat_tables(all_files)
+        else:
+            raise BaseException(f'Internal programming error - {data_type} should not be'
+                                ' unknown.')
+
+
+def _combine_datasets(datasets: List[str],
+                      results: List[Union[pd.DataFrame, Dict[bytes, np.ndarray]]],
+                      data_type: str) -> Union[pd.DataFrame, Dict[bytes, np.ndarray]]:
+    'Put the results from several datasets together, tagging each row with its dataset'
+    combined = _concat_results(results, data_type)
+    lengths = [len(next(iter(r.values()))) if data_type == 'awkward' else len(r)
+               for r in results]
+    if data_type == 'arrow':
+        indices = np.repeat(np.arange(len(datasets), dtype=np.int32), lengths)
+        return combined.append_column('dataset',
+                                      pa.DictionaryArray.from_arrays(indices, datasets))
+
+    dataset_column = np.repeat(np.array(datasets), lengths)
+    if data_type == 'pandas':
+        # Don't modify the frame that came back from the cache or a single dataset.
+        combined = combined.copy() if len(results) == 1 else combined
+        combined['dataset'] = pd.Categorical(dataset_column, categories=datasets)
+    else:
+        combined = dict(combined)
+        combined[b'dataset'] = dataset_column
+    return combined
+
+
+async def _run_query(client: aiohttp.ClientSession, servicex_endpoint: str,
+                     minio_client: Minio, downloader: ObjectStoreDownloader,
+                     json_query: Dict[str, Any], data_type: str,
+                     columns: Optional[List[str]] = None,
+                     dtypes: Optional[Dict[str, Any]] = None,
+                     instrumentation: Optional[Instrumentation] = None,
+                     request_id: Optional[str] = None,
+                     transform_size: Optional[TransformSize] = None) \
+        -> Union[pd.DataFrame, Dict[bytes, np.ndarray]]:
+    '''
+    Submit the transform request to ServiceX (unless `request_id`, the id of the transform, is
+    given), wait for it to finish, and download and combine the results.
+    '''
+    instrumentation = instrumentation or Instrumentation()
+    with instrumentation.timed('query', dataset=json_query['did']):
+        if servicex_preallocate_results and servicex_decode_processes <= 0 \
+                and data_type in ('pandas', 'awkward') \
+                and json_query['result-format'] == 'root-file':
+            return await _run_query_preallocated(client, servicex_endpoint, minio_client,
+                                                 downloader, json_query, data_type, columns,
+                                                 dtypes, instrumentation, request_id,
+                                                 transform_size)
+
+        # Wait for all the files to arrive so we can stich them together. Sort by name so the
+        # order does not depend on which download happened to finish first.
+        downloaded = {}  # type: Dict[str, Any]
+        held_bytes = 0
+        spill_directory = None  # type: Optional[str]
+        try:
+            async for fname, data in _stream_query_files(client, servicex_endpoint,
+                                                         minio_client, downloader, json_query,
+                                                         data_type, columns=columns,
+                                                         dtypes=dtypes,
+                                                         instrumentation=instrumentation,
+                                                         request_id=request_id,
+                                                         transform_size=transform_size):
+                size = data_size(data)
+                if servicex_max_decoded_bytes is not None \
+                        and held_bytes + size > servicex_max_decoded_bytes:
+                    if spill_directory is None:
+                        spill_directory = tempfile.mkdtemp(prefix='servicex-spill-',
+                                                           dir=servicex_spill_directory)
+                    with instrumentation.timed('spill', object_name=fname, size=size):
+                        spilled = await asyncio.get_event_loop().run_in_executor(
+                            None, spill, data, spill_directory, str(len(downloaded)))
+                    if spilled is not None:
+                        data, size = spilled, 0
+                held_bytes += size
+                downloaded[fname] = data
+
+            with instrumentation.timed('concat', files=len(downloaded)):
+                # Joining arrow tables does not copy them, so spilled ones are read back in
+                # rather than left pointing at files that are about to be removed - as is a
+                # file that is the whole result.
+                in_memory = len(downloaded) == 1 or data_type == 'arrow'
+                all_files = [downloaded[fname] for fname in sorted(downloaded.keys())]
+                downloaded.clear()
+                return _concat_results([d.load(in_memory) if isinstance(d, SpilledData) else d
+                                        for d in all_files], data_type)
+        finally:
+            if spill_directory is not None:
+                shutil.rmtree(spill_directory, ignore_errors=True)
+
+
+def _incremental_file_key(key: str, fname: str) -> str:
+    '''
+    Where one file of the incremental result for `key` is kept in `incremental_results`. The
+    names of the files are kept under `key` itself. File names are too long to use directly.
+    '''
+    return f'{key}-{hashlib.sha1(fname.encode("utf-8")).hexdigest()}'
+
+
+async def _incremental_lookup(key: str) -> Dict[str, Any]:
+    'The files of the incremental result for `key` that are still in `incremental_results`'
+    fnames = await _cache_lookup(incremental_results, key) or []
+    found = await asyncio.gather(*[_cache_lookup(incremental_results,
+                                                 _incremental_file_key(key, fname))
+                                   for fname in fnames])
+    return {fname: data for fname, data in zip(fnames, found) if data is not None}
+
+
+async def _run_query_incremental(client: aiohttp.ClientSession, servicex_endpoint: str,
+                                 minio_client: Minio, downloader: ObjectStoreDownloader,
+                                 json_query: Dict[str, Any], data_type: str, key: str,
+                                 columns: Optional[List[str]] = None,
+                                 dtypes: Optional[Dict[str, Any]] = None,
+                                 instrumentation: Optional[Instrumentation] = None,
+                                 transform_size: Optional[TransformSize] = None) \
+        -> Union[pd.DataFrame, Dict[bytes, np.ndarray]]:
+    '''
+    Submit the transform request to ServiceX, and download only the files that are not in the
+    result kept in `incremental_results` under `key`. The files ServiceX writes are named after
+    the input files they come from, so a file we already have holds the same data. The result
+    is put back together from all the files in the same order as `_run_query` would.
+    '''
+    instrumentation = instrumentation or Instrumentation()
+    with instrumentation.timed('query', dataset=json_query['did']):
+        previous = await _incremental_lookup(key)
+        files = {}  # type: Dict[str, Any]
+        new_files = []
+        async for fname, data in _stream_query_files(client, servicex_endpoint, minio_client,
+                                                     downloader, json_query, data_type,
+                                                     columns=columns, dtypes=dtypes,
+                                                     instrumentation=instrumentation,
+                                                     transform_size=transform_size,
+                                                     skip_objects=previous.keys()):
+            if data is None:
+                files[fname] = previous[fname]
+            else:
+                files[fname] = data
+                new_files.append(fname)
+
+        # Only the new files are written. Files that ServiceX no longer writes (their input is
+        # gone) are left out. Any that can't be kept are just fetched again next time.
+        await asyncio.gather(*[_cache_save(incremental_results, _incremental_file_key(key, fname),
+                                           files[fname])
+                               for fname in new_files])
+        await _cache_save(incremental_results, key, sorted(files.keys()))
+        gone = [_incremental_file_key(key, fname) for fname in previous.keys()
+                if fname not in files]
+        loop = asyncio.get_event_loop()
+        await asyncio.gather(*[loop.run_in_executor(None, incremental_results.invalidate, k)
+                               for k in gone])
+        with instrumentation.timed('concat', files=len(files)):
+            return _concat_results([files[fname] for fname in sorted(files.keys())],
+                                   data_type)
+
+
+async def _run_query_preallocated(client: aiohttp.ClientSession, servicex_endpoint: str,
+                                  minio_client: Minio, downloader: ObjectStoreDownloader,
+                                  json_query: Dict[str, Any], data_type: str,
+                                  columns: Optional[List[str]] = None,
+                                  dtypes: Optional[Dict[str, Any]] = None,
+                                  instrumentation: Optional[Instrumentation] = None,
+                                  request_id: Optional[str] = None,
+                                  transform_size: Optional[TransformSize] = None) \
+        -> Union[pd.DataFrame, Dict[bytes, np.ndarray]]:
+    '''
+    Like `_run_query`, but download all the files first, and then read each one straight into
+    its place in the result.
+    '''
+    instrumentation = instrumentation or Instrumentation()
+    downloaded = {}
+    files = []  # type: List[Optional[Tuple[Union[bytearray, str], Any]]]
+    try:
+        async for fname, data in _stream_query_files(client, servicex_endpoint, minio_client,
+                                                     downloader, json_query, data_type,
+                                                     download_only=True, columns=columns,
+                                                     dtypes=dtypes,
+                                                     instrumentation=instrumentation,
+                                                     request_id=request_id,
+                                                     transform_size=transform_size):
+            downloaded[fname] = data
+        fnames = sorted(downloaded.keys())
+        files = [downloaded[fname] for fname in fnames]
+        downloaded.clear()
+
+        # If we can't read everything in place, load each file and stitch them together.
+        layouts = [layout for _, layout in files]
+        if len(files) == 0 \
+                or any(layout is None or layout[1] != layouts[0][1] for layout in layouts):
+            async def decode(fname: str, data: Union[bytearray, str]) -> Any:
+                with instrumentation.timed('decode', object_name=fname):
+                    return await _decode_file(data, data_type, 'root-file', columns, dtypes)
+
+            all_files = await asyncio.gather(*[decode(fname, data)
+                                               for fname, (data, _) in zip(fnames, files)])
+            with instrumentation.timed('concat', files=len(all_files)):
+                return _concat_results(all_files, data_type)
+
+        lengths = [n for n, _ in layouts]
+        output = {name: np.empty(sum(lengths), dtype=dtype)
+                  for name, dtype in layouts[0][1].items()}
+        starts = np.cumsum([0] + lengths[:-1])
+
+        async def fill(index: int) -> None:
+            data = files[index][0]
+            with instrumentation.timed('decode', object_name=fnames[index]):
+                await asyncio.wrap_future(_decode_executor.submit(read_root_file_into, data,
+                                                                  output, int(starts[index]),
+                                                                  columns, dtypes))
+            # Done with the file - let go of it right away.
+            files[index] = None
+            if isinstance(data, str):
+                os.remove(data)
+
+        await asyncio.gather(*[fill(i) for i in range(len(files))])
+    finally:
+        for f in list(downloaded.values()) + files:
+            if f is not None and isinstance(f[0], str) and os.path.exists(f[0]):
+                os.remove(f[0])
+
+    if data_type == 'awkward':
+        return output
+    # Each file's entries are numbered from zero, as they are when the files are concatenated.
+    index = pd.RangeIndex(lengths[0], name='entry') if len(lengths) == 1 \
+        else pd.Index(np.concatenate([np.arange(n) for n in lengths]), name='entry')
+    return pd.DataFrame({name.decode(): c for name, c in output.items()}, index=index,
+                        copy=False)
+
+
+# The status trackers for each session (and so event loop) and endpoint. Each is removed once
+# nothing is waiting on it.
+_status_trackers = {}  # type: Dict[Tuple[aiohttp.ClientSession, str], StatusTracker]
+
+
+async def _tracked_status(client: aiohttp.ClientSession, servicex_endpoint: str,
+                          request_id: str, delay: float) -> Tuple[Optional[int], int]:
+    'Wait `delay` seconds and get the status of a transform through the shared tracker'
+    key = (client, servicex_endpoint)
+    tracker = _status_trackers.get(key)
+    if tracker is None:
+        tracker = StatusTracker(lambda r_id: _get_transform_status(client, servicex_endpoint,
+                                                                   r_id),
+                                max_concurrent=servicex_status_concurrency,
+                                batch_window=servicex_status_batch_window)
+        _status_trackers[key] = tracker
+    try:
+        return await tracker.wait_for_status(request_id, delay)
+    finally:
+        if len(tracker.request_ids) == 0 and _status_trackers.get(key) is tracker:
+            del _status_trackers[key]
+
+
+async def _poll_transform(client: aiohttp.ClientSession, servicex_endpoint: str,
+                          request_id: str, delay: float) -> Tuple[Optional[int], int]:
+    '''
+    Wait for the next status of a transform - either pushed to us through the status channel,
+    or by waiting `delay` seconds and then asking for it.
+    '''
+    if servicex_status_channel is not None:
+        status = await servicex_status_channel.wait_for_status(servicex_endpoint, request_id,
+                                                               delay)
+        if status is not None:
+            return status
+        delay = 0.0
+    return await _tracked_status(client, servicex_endpoint, request_id, delay)
+
+
+async def _submit_query(client: aiohttp.ClientSession, servicex_endpoint: str,
+                        json_query: Dict[str, Any],
+                        instrumentation: Optional[Instrumentation] = None,
+                        transform_size: Optional[TransformSize] = None) -> Tuple[str, bool]:
+    '''
+    Submit a transform request to ServiceX - unless an earlier run submitted the same one and
+    did not finish, in which case pick that one up (see `query_journal`). The size of the
+    transform (`transform_size`) is not part of what makes two requests the same.
+
+    Returns:
+        request_id          The id of the transform
+        submitted           True if the transform was submitted just now
+    '''
+    # If an earlier run submitted this transform and did not finish, pick up where it left off.
+    journal = query_journal
+    key = journal_key(servicex_endpoint, json_query)
+    request_id = None if journal is None else journal.request_id(key)
+    if request_id is not None:
+        try:
+            await _get_transform_status(client, servicex_endpoint, request_id)
+            return request_id, False
+        except asyncio.CancelledError:
+            raise
+        except BaseException:
+            # ServiceX no longer knows about it - start over
+            pass
+
+    request = dict(json_query)
+    if transform_size is not None:
+        request['workers'] = transform_size.workers
+        request['chunk-size'] = transform_size.chunk_size
+    with (instrumentation or Instrumentation()).timed('submit',
+                                                      dataset=json_query['did']) as info:
+        async with client.post(f'{servicex_endpoint}/transformation',
+                               json=request) as response:
             # TODO: Make sure to throw the correct type of exception
             r = await response.json()
             if response.status != 200:
                 raise ServiceX_Exception('ServiceX rejected the transformation request: '
                                          f'({response.status}){r}')
             request_id = r["request_id"]
+            info['request_id'] = request_id
+    _start_journal(journal, key, request_id)
+    return request_id, True
+
+
+def _start_journal(journal: Optional[QueryJournal], key: str, request_id: str) -> None:
+    'Record a transform in the journal. A journal that can\'t be written to is not used.'
+    if journal is None:
+        return
+    try:
+        journal.start(key, request_id)
+    except OSError:
+        pass
+
+
+async def _stream_query_files(client: aiohttp.ClientSession, servicex_endpoint: str,
+                              minio_client: Minio, downloader: ObjectStoreDownloader,
+                              json_query: Dict[str, Any], data_type: str,
+                              max_in_flight: Optional[int] = None,
+                              download_only: bool = False,
+                              columns: Optional[List[str]] = None,
+                              dtypes: Optional[Dict[str, Any]] = None,
+                              instrumentation: Optional[Instrumentation] = None,
+                              request_id: Optional[str] = None,
+                              transform_size: Optional[TransformSize] = None,
+                              skip_objects: Optional[Iterable[str]] = None) \
+        -> AsyncIterator[Tuple[str, Union[pd.DataFrame, Dict[bytes, np.ndarray]]]]:
+    '''
+    Submit the transform request to ServiceX, and yield the name and contents of each file
+    as soon as it has been downloaded. Files are yielded in the order they finish.
 
-        # Sit here waiting for the results to come in. In case there are missing items
-        # in the minio stream, we will avoid counting that. That should be an explicit error taken
-        # care of further on down in the code.
-        done = False
-        files_downloading = {}
-        last_files_processed = 0
-        while not done:
-            await asyncio.sleep(servicex_status_poll_time)
-            files_remaining, files_processed = await _get_transform_status(client,
-                                                                           servicex_endpoint,
-                                                                           request_id)
-            if files_processed != last_files_processed:
-                new_downloads = await _download_new_files(files_downloading.keys(),
-                                                          servicex_endpoint, request_id,
-                                                          data_type)
-                files_downloading.update(new_downloads)
+    Arguments:
+        client              Session to use to talk to ServiceX
+        servicex_endpoint   The URL where the instance of ServivceX we are querying lives
+        minio_client        Client for the object store the files are written to
+        downloader          Used to download the files. Shared between queries so they all
+                            live within the same concurrency limit.
+        json_query          The transform request to send to ServiceX
+        data_type           'pandas' or 'awkward'
+        max_in_flight       Maximum number of files that are downloading or downloaded but not
+                            yet handed back. None means no limit.
+        download_only       If True, don't load the files. Yield what `_download_raw_file`
+                            returns instead.
+        columns             Names of the columns to load. None loads all of them.
+        dtypes              numpy types to convert columns to, by column name
+        instrumentation     Where to report the time taken by each step
+        request_id          The id of the transform, if it has already been submitted
+        transform_size      How large a transform to submit. None for what `json_query` has.
+        skip_objects        Names of files the caller already has. These are yielded with None
+                            as their contents as they are found, rather than downloaded. The
+                            transform is always submitted (the shared cache is not used), so
+                            that every file it writes is found.
+    '''
+    instrumentation = instrumentation or Instrumentation()
+    journal = query_journal
+    skip = set(skip_objects) if skip_objects is not None else None
+    key = journal_key(servicex_endpoint, json_query)
+
+    # If every file of this query is in the shared cache, there is no need to go to ServiceX.
+    cache = servicex_shared_cache
+    shared_key = None if cache is None or download_only \
+        else query_cache_key(json_query, data_type, columns, dtypes)
+    if shared_key is not None and request_id is None and skip is None:
+        cached_files = _shared_query_files(cache, shared_key, instrumentation)
+        if cached_files is not None:
+            for fname, data in cached_files:
+                yield fname, data
+            return
+
+    # How long the transform waits before ServiceX starts on it is only known if we submit it.
+    submitted = time.time()
+    if request_id is None:
+        request_id, waiting_in_queue = await _submit_query(client, servicex_endpoint,
+                                                           json_query, instrumentation,
+                                                           transform_size)
+    else:
+        waiting_in_queue = False
+        if journal is not None and journal.request_id(key) != request_id:
+            _start_journal(journal, key, request_id)
+
+    # Files downloaded by an earlier run are loaded from the journal.
+    keep_files = journal is not None and journal.keep_files
+    files_pending = journal.objects(key) if keep_files else []
+    discovery = ObjectDiscovery(minio_client, request_id, seen=files_pending)
+    skipped_pending = [f for f in files_pending if skip is not None and f in skip]
+    files_pending = [f for f in files_pending if skip is None or f not in skip]
+
+    # Downloads are retried, checked against the listing, and hedged before they make it into
+    # the journal.
+    downloader = ResilientDownloader(downloader, discovery.object_info,
+                                     tries=servicex_download_tries,
+                                     retry_delay=servicex_download_retry_delay,
+                                     verify=servicex_download_verify,
+                                     hedge_percentile=servicex_download_hedge_percentile)
+    if keep_files:
+        downloader = JournaledDownloader(downloader, journal, key)
+
+    # Sit here waiting for the results to come in. In case there are missing items
+    # in the minio stream, we will avoid counting that. That should be an explicit error taken
+    # care of further on down in the code.
+    done = False
+    in_flight = {}  # type: Dict[asyncio.Future, str]
+    in_flight_sizes = {}  # type: Dict[asyncio.Future, int]
+    handed_back = []  # type: List[str]
+    skipped = []  # type: List[str]
+    last_files_processed = 0
+    poll_task = None  # type: Optional[asyncio.Future]
+    poll_schedule = PollSchedule(servicex_status_poll_min_time, servicex_status_poll_time,
+                                 servicex_status_poll_backoff)
+    try:
+        while True:
+            # Files the caller already has are handed straight back
+            while len(skipped_pending) > 0:
+                fname = skipped_pending.pop(0)
+                skipped.append(fname)
+                yield fname, None
+
+            # Start as many downloads as the window allows, by number and by size
+            while len(files_pending) > 0 \
+                    and (max_in_flight is None or len(in_flight) < max_in_flight):
+                size = discovery.object_info(files_pending[0])[0] or 0
+                if servicex_max_in_flight_bytes is not None and len(in_flight) > 0 \
+                        and sum(in_flight_sizes.values()) + size > servicex_max_in_flight_bytes:
+                    break
+                fname = files_pending.pop(0)
+                future = _start_download(downloader, request_id, fname, data_type,
+                                         json_query['result-format'],
+                                         download_only=download_only, columns=columns,
+                                         dtypes=dtypes, instrumentation=instrumentation,
+                                         shared_key=shared_key)
+                in_flight[future] = fname
+                in_flight_sizes[future] = size
+
+            if done and len(in_flight) == 0 and len(files_pending) == 0 \
+                    and len(skipped_pending) == 0:
+                break
+
+            # Wake up when either a download finishes or it is time to check on the status.
+            waiting_for = set(in_flight.keys())
+            if not done:
+                if poll_task is None:
+                    poll_started = time.time()
+                    poll_task = asyncio.ensure_future(
+                        _poll_transform(client, servicex_endpoint, request_id,
+                                        poll_schedule.delay))
+                waiting_for.add(poll_task)
+            finished, _ = await asyncio.wait(waiting_for,
+                                             return_when=asyncio.FIRST_COMPLETED)
+
+            if poll_task is not None and poll_task in finished:
+                files_remaining, files_processed = poll_task.result()
+                poll_task = None
+                now = time.time()
+                instrumentation.emit('poll', start=poll_started, end=now,
+                                     duration=now - poll_started, request_id=request_id,
+                                     files_processed=files_processed,
+                                     files_remaining=files_remaining)
+                poll_schedule.update(files_processed != last_files_processed)
                 last_files_processed = files_processed
+                done = (files_remaining is not None) and files_remaining == 0
 
-            done = (files_remaining is not None) and files_remaining == 0
+                # Look for new files every time - don't wait for the status to tell us. The
+                # listing makes blocking calls, so run it off the event loop.
+                with instrumentation.timed('listing', request_id=request_id) as info:
+                    new_files = await asyncio.get_event_loop().run_in_executor(
+                        None, discovery.new_objects, files_processed)
+                    info['found'] = len(new_files)
+                for fname in new_files:
+                    instrumentation.emit('object-found', request_id=request_id,
+                                         object_name=fname, elapsed=time.time() - submitted)
+                for fname in new_files:
+                    if skip is not None and fname in skip:
+                        skipped_pending.append(fname)
+                    else:
+                        files_pending.append(fname)
 
-        # Now, wait for all of them to complete so we can stich the files together.
-        all_files = await asyncio.gather(*files_downloading.values())
+                if waiting_in_queue and (files_processed > 0 or done):
+                    waiting_in_queue = False
+                    instrumentation.emit('queue-wait', start=submitted, end=now,
+                                         duration=now - submitted, request_id=request_id)
+
+            for f in finished:
+                if f in in_flight:
+                    del in_flight_sizes[f]
+                    fname = in_flight.pop(f)
+                    handed_back.append(fname)
+                    yield fname, f.result()
+    finally:
+        # If we are abandoned part way through, make sure nothing is left running.
+        left_over = list(in_flight.keys()) + ([] if poll_task is None else [poll_task])
+        for f in left_over:
+            f.cancel()
+        await asyncio.gather(*left_over, return_exceptions=True)
+
+    # Everything has been handed back, so there is nothing left to pick up.
+    if journal is not None:
+        journal.remove(key)
+    if shared_key is not None and len(skipped) == 0:
+        try:
+            cache.save_objects(shared_key, sorted(handed_back))
+        except OSError:
+            pass
+
+    # Remember how much the query produced, to size the transform next time.
+    sizes = [discovery.object_info(fname)[0] for fname in handed_back + skipped]
+    if transform_history is not None and len(sizes) > 0 and None not in sizes:
+        try:
+            transform_history.record(json_query, len(sizes), sum(sizes))
+        except OSError:
+            pass
+
+
+def _shared_query_files(cache: SharedFileCache, key: str, instrumentation: Instrumentation) \
+        -> Optional[List[Tuple[str, Any]]]:
+    '''
+    Return the name and data of every file of a query from the shared cache, or None if they
+    are not all there.
+    '''
+    names = cache.objects(key)
+    if names is None:
+        return None
+    files = []
+    for fname in names:
+        with instrumentation.timed('shared-cache', object_name=fname) as info:
+            data = cache.lookup(key, fname)
+            info['found'] = data is not None
+        if data is None:
+            return None
+        files.append((fname, data))
+    return files
+
+
+async def get_data_stream_async(selection_query: str, datasets: Union[str, List[str]],
+                                servicex_endpoint: str = 'http://localhost:5000/servicex',
+                                data_type: str = 'pandas',
+                                image: str = 'sslhep/servicex_xaod_cpp_transformer:v0.2',
+                                max_in_flight: int = 5,
+                                use_cache: bool = True,
+                                servicex_adaptor: Optional[ServiceXAdaptor] = None,
+                                result_format: str = 'root-file',
+                                columns: Optional[List[str]] = None,
+                                dtypes: Optional[Dict[str, Any]] = None,
+                                stats: Optional[QueryStats] = None,
+                                event_hook: Optional[EventHook] = None,
+                                workers: Optional[int] = None,
+                                chunk_size: Optional[int] = None,
+                                size_hint: Optional[int] = None) \
+        -> AsyncIterator[Union[pd.DataFrame, Dict[bytes, np.ndarray]]]:
+    '''
+    Return data from a query with data sets one file at a time, as each file is downloaded.
+
+    Arguments:
+        selection_query     `qastle` string that specifies what columnes to extract, how to format
+                            them, and how to format them.
+        datasets            Dataset or datasets to run the query against.
+        service_endpoint    The URL where the instance of ServivceX we are querying lives
+        data_type           How should the data come back? 'pandas', 'awkward', or 'arrow' (a
+                            `pyarrow.Table`). Defaults to 'pandas'
+        image               ServiceX image that should run this
+        max_in_flight       Maximum number of files that are being downloaded or are waiting to
+                            be handed back. This bounds the memory used.
+        use_cache           If True and the complete result of an identical query is in the
+                            local cache, it is returned as a single chunk.
+        servicex_adaptor    Connections to ServiceX to use for this query. If None, a shared
+                            adaptor for `servicex_endpoint` is used.
+        result_format       The file format ServiceX should write: 'root-file' or 'parquet'.
+        columns             Names of the columns to load. None loads all of them.
+        dtypes              numpy types to convert columns to as they are read, by column name.
+        stats, event_hook   Report how long each part of the query takes, as for
+                            `get_data_async`.
+        workers, chunk_size, size_hint
+                            The size of the transform, as for `get_data_async`.
+
+    Returns:
+        Async iterator that returns a Pandas DataFrame, an awkward array, or an arrow table for
+        each file the query produced, in the order they finish downloading.
+    '''
+    datasets = _check_arguments(datasets, data_type, result_format, columns, dtypes)
+    if len(datasets) != 1:
+        raise ServiceX_Exception('Only a single dataset can be streamed at a time.')
+
+    json_query = _build_json_query(selection_query, datasets[0], image, result_format)
+    if use_cache:
+        cached = await _cache_lookup(query_cache,
+                                     query_cache_key(json_query, data_type, columns, dtypes))
+        if cached is not None:
+            yield cached
+            return
+
+    adaptor = servicex_adaptor or _default_adaptor(servicex_endpoint)
+    client = adaptor.session()
+    transform_size = _transform_size(json_query, workers, chunk_size, size_hint)
+    downloader = _new_downloader(adaptor.minio_client, client,
+                                 transform_size.download_concurrency)
+
+    # Make sure the file stream is closed (and its downloads stopped) if we are abandoned.
+    files = _stream_query_files(client, adaptor.endpoint, adaptor.minio_client, downloader,
+                                json_query, data_type, max_in_flight=max_in_flight,
+                                columns=columns, dtypes=dtypes,
+                                instrumentation=Instrumentation([stats, event_hook]),
+                                transform_size=transform_size)
+    try:
+        async for _, data in files:
+            yield data
+    finally:
+        await files.aclose()
+
+
+# The event loop the synchronous functions run the async code on, on a background thread of its
+# own. Created when first needed, and shared by every thread that calls them.
+_background_loop = None  # type: Optional[asyncio.AbstractEventLoop]
+_background_thread = None  # type: Optional[threading.Thread]
+_background_loop_lock = threading.Lock()
 
-        # return the result
-        assert len(all_files) > 0
-        if len(all_files) == 1:
-            return all_files[0]
-        else:
-            if data_type == 'pandas':
-                r = pd.concat(all_files)
-                assert isinstance(r, pd.DataFrame)
-                return r
-            elif data_type == 'awkward':
-                col_names = all_files[0].keys()
-                return {c: awkward.concatenate([ar[c] for ar in all_files]) for c in col_names}
-            else:
-                raise BaseException(f'Internal programming error - {data_type} should not be'
-                                    ' unknown.')
+
+def _get_background_loop() -> asyncio.AbstractEventLoop:
+    'Return the background event loop, starting its thread if need be'
+    global _background_loop, _background_thread
+    with _background_loop_lock:
+        if _background_loop is None or _background_loop.is_closed():
+            loop = asyncio.new_event_loop()
+            started = threading.Event()
+
+            def run():
+                asyncio.set_event_loop(loop)
+                loop.call_soon(started.set)
+                loop.run_forever()
+
+            thread = threading.Thread(target=run, name='servicex-event-loop', daemon=True)
+            thread.start()
+            started.wait()
+            _background_loop, _background_thread = loop, thread
+        return _background_loop
+
+
+def _run_sync(coroutine: Awaitable[Any]) -> Any:
+    '''
+    Run a coroutine on the background event loop, and wait for its result. This can be called
+    from any number of threads at once, and whether or not they have an event loop running
+    (e.g. in a notebook). If the calling thread is interrupted, the coroutine is cancelled.
+    '''
+    loop = _get_background_loop()
+    try:
+        if threading.current_thread() is _background_thread:
+            raise ServiceX_Exception('The synchronous API can not be used from code run by the '
+                                     'library (e.g. an event hook) - use the async API.')
+        future = asyncio.run_coroutine_threadsafe(coroutine, loop)
+    except BaseException:
+        # It will never run, so don't leave it to be reported as never awaited.
+        close = getattr(coroutine, 'close', None)
+        if close is not None:
+            close()
+        raise
+    try:
+        return future.result()
+    except BaseException:
+        future.cancel()
+        raise
+
+
+def _iterate_sync(stream: AsyncIterator[Any]) -> Iterator[Any]:
+    'Turn an async iterator into an iterator, running it on the background event loop'
+    try:
+        while True:
+            try:
+                yield _run_sync(stream.__anext__())
+            except StopAsyncIteration:
+                return
+    finally:
+        _run_sync(stream.aclose())
 
 
 def get_data(selection_query: str, datasets: Union[str, List[str]],
              servicex_endpoint: str = 'http://localhost:5000/servicex',
              data_type: str = 'pandas',
-             image: str = 'sslhep/servicex_xaod_cpp_transformer:v0.2') \
-        -> Union[pd.DataFrame, Dict[bytes, np.ndarray]]:
+             image: str = 'sslhep/servicex_xaod_cpp_transformer:v0.2',
+             use_cache: bool = True,
+             combine_datasets: bool = False,
+             servicex_adaptor: Optional[ServiceXAdaptor] = None,
+             result_format: str = 'root-file',
+             columns: Optional[List[str]] = None,
+             dtypes: Optional[Dict[str, Any]] = None,
+             stats: Optional[QueryStats] = None,
+             event_hook: Optional[EventHook] = None,
+             workers: Optional[int] = None,
+             chunk_size: Optional[int] = None,
+             size_hint: Optional[int] = None,
+             incremental: bool = False) \
+        -> Union[pd.DataFrame, Dict[bytes, np.ndarray],
+                 Dict[str, Union[pd.DataFrame, Dict[bytes, np.ndarray]]]]:
     '''
     Return data from a query with data sets
 
     Arguments:
         selection_query     `qastle` string that specifies what columnes to extract, how to format
                             them, and how to format them.
-        datasets            Dataset or datasets to run the query against.
+        datasets            Dataset or list of datasets to run the query against.
         service_endpoint    The URL where the instance of ServivceX we are querying lives
-        data_type           How should the data come back? 'pandas' and 'awkward' are the only
-                            legal values. Defaults to 'pandas'
+        data_type           How should the data come back? 'pandas', 'awkward', or 'arrow' (a
+                            `pyarrow.Table`). Defaults to 'pandas'
+        use_cache           If True, use the local cache of previous query results.
+        combine_datasets    If True, return the results of a list of datasets together, with
+                            a `dataset` column.
+        servicex_adaptor    Connections to ServiceX to use for this query.
+        result_format       The file format ServiceX should write: 'root-file' or 'parquet'.
+        columns             Names of the columns to load. None loads all of them.
+        dtypes              numpy types to convert columns to as they are read, by column name.
+        stats               A `QueryStats` to fill in with how long each part of the query took.
+        event_hook          Called as `event_hook(event, info)` as each part of the query
+                            finishes.
+        workers, chunk_size, size_hint
+                            The size of the transform. See `get_data_async`.
+        incremental         If True, only fetch the files that are new since the last time this
+                            query was run with `incremental`. See `get_data_async`.
 
     Returns:
-        df                  Pandas DataFrame that contains the resulting flat data.
+        df                  Pandas DataFrame that contains the resulting flat data. See
+                            `get_data_async` for what is returned for a list of datasets.
+    '''
+    return _run_sync(get_data_async(selection_query, datasets, servicex_endpoint, data_type,
+                                    image=image, use_cache=use_cache,
+                                    combine_datasets=combine_datasets,
+                                    servicex_adaptor=servicex_adaptor,
+                                    result_format=result_format, columns=columns,
+                                    dtypes=dtypes, stats=stats, event_hook=event_hook,
+                                    workers=workers, chunk_size=chunk_size,
+                                    size_hint=size_hint, incremental=incremental))
+
+
+def get_data_stream(selection_query: str, datasets: Union[str, List[str]],
+                    servicex_endpoint: str = 'http://localhost:5000/servicex',
+                    data_type: str = 'pandas',
+                    image: str = 'sslhep/servicex_xaod_cpp_transformer:v0.2',
+                    max_in_flight: int = 5,
+                    use_cache: bool = True,
+                    servicex_adaptor: Optional[ServiceXAdaptor] = None,
+                    result_format: str = 'root-file',
+                    columns: Optional[List[str]] = None,
+                    dtypes: Optional[Dict[str, Any]] = None,
+                    stats: Optional[QueryStats] = None,
+                    event_hook: Optional[EventHook] = None,
+                    workers: Optional[int] = None,
+                    chunk_size: Optional[int] = None,
+                    size_hint: Optional[int] = None) \
+        -> Iterator[Union[pd.DataFrame, Dict[bytes, np.ndarray]]]:
+    '''
+    Return data from a query with data sets one file at a time, as each file is downloaded. See
+    `get_data_stream_async` for a description of the arguments.
     '''
-    nest_asyncio.apply()
-    loop = asyncio.get_event_loop()
-    return loop.run_until_complete(get_data_async(selection_query, datasets, servicex_endpoint, data_type,
-                                   image=image))
+    return _iterate_sync(get_data_stream_async(selection_query, datasets, servicex_endpoint,
+                                               data_type, image=image,
+                                               max_in_flight=max_in_flight,
+                                               use_cache=use_cache,
+                                               servicex_adaptor=servicex_adaptor,
+                                               result_format=result_format, columns=columns,
+                                               dtypes=dtypes, stats=stats,
+                                               event_hook=event_hook, workers=workers,
+                                               chunk_size=chunk_size, size_hint=size_hint))
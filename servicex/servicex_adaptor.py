@@ -0,0 +1,295 @@
+# Talking to the ServiceX web API
+import asyncio
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+import weakref
+
+import aiohttp
+from minio import Minio
+
+from .minio_adaptor import new_minio_client
+
+
+def _running_loop() -> Optional[asyncio.AbstractEventLoop]:
+    'The event loop running on this thread, or None'
+    # `asyncio.get_running_loop` raises rather than returning None, and needs python 3.7.
+    return asyncio._get_running_loop()
+
+
+class ServiceXAdaptor:
+    '''
+    Holds the connections to a ServiceX instance and its object store. Create one and pass it
+    to all your queries (or let the library create one per endpoint) so that connections are
+    pooled and reused rather than opened for every query.
+
+    Call `close` (or `close_async`) when you are done with it, or use it as a context manager
+    (`with` or `async with`). The adaptors the library creates are closed when python exits.
+    '''
+    def __init__(self, endpoint: str = 'http://localhost:5000/servicex',
+                 minio_endpoint: Optional[str] = None,
+                 minio_access_key: str = 'miniouser',
+                 minio_secret_key: str = 'leftfoot1',
+                 minio_secure: bool = False,
+                 pool_size: int = 100):
+        '''
+        Arguments:
+            endpoint            The URL where the instance of ServiceX lives
+            minio_endpoint      host:port of the object store. If None, port 9000 on the same
+                                host as ServiceX.
+            minio_access_key    Object store credentials
+            minio_secret_key    Object store credentials
+            minio_secure        Use https to talk to the object store
+            pool_size           Maximum number of connections to keep open to ServiceX, and,
+                                separately, to the object store.
+        '''
+        self._endpoint = endpoint
+        self._pool_size = pool_size
+        self._minio_config = {'end_point': endpoint, 'minio_endpoint': minio_endpoint,
+                              'access_key': minio_access_key, 'secret_key': minio_secret_key,
+                              'secure': minio_secure}
+        self._minio = new_minio_client(pool_size=pool_size, **self._minio_config)
+
+        # An aiohttp session can only be used on the event loop it was created on.
+        self._sessions = weakref.WeakKeyDictionary() \
+            # type: weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, aiohttp.ClientSession]
+
+    @property
+    def endpoint(self) -> str:
+        'The URL of the ServiceX web API'
+        return self._endpoint
+
+    @property
+    def minio_client(self) -> Minio:
+        'Client for the object store. It is thread safe, and pools its connections.'
+        return self._minio
+
+    @property
+    def minio_config(self) -> Dict[str, Any]:
+        '''
+        The arguments to `new_minio_client` to connect to the object store, e.g. from another
+        process. Includes the credentials.
+        '''
+        return dict(self._minio_config)
+
+    def session(self) -> aiohttp.ClientSession:
+        'Return the session to use to talk to ServiceX on the current event loop'
+        loop = asyncio.get_event_loop()
+        session = self._sessions.get(loop)
+        if session is None or session.closed:
+            session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self._pool_size))
+            self._sessions[loop] = session
+        return session
+
+    def _take_sessions(self) -> List[Tuple[asyncio.AbstractEventLoop, aiohttp.ClientSession]]:
+        'Forget all the open sessions, and return them with the event loop each belongs to'
+        sessions = [(loop, session) for loop, session in self._sessions.items()
+                    if not session.closed]
+        self._sessions.clear()
+        return sessions
+
+    async def close_async(self) -> None:
+        '''
+        Close the sessions on every event loop. Those that belong to another loop are closed
+        on that loop, if it is running (e.g. the one the synchronous API runs on).
+        '''
+        current = asyncio.get_event_loop()
+        closing = []
+        for loop, session in self._take_sessions():
+            if loop is current:
+                closing.append(session.close())
+            elif loop.is_running():
+                closing.append(asyncio.wrap_future(
+                    asyncio.run_coroutine_threadsafe(session.close(), loop)))
+        await asyncio.gather(*closing)
+
+    def close(self, timeout: Optional[float] = None) -> None:
+        '''
+        Close the sessions on every event loop, waiting up to `timeout` seconds for each (None
+        means no limit). A session on an event loop running on this thread can't be waited for,
+        so its close is only started - use `close_async` there.
+        '''
+        running = _running_loop()
+        for loop, session in self._take_sessions():
+            if loop is running:
+                loop.create_task(session.close())
+            elif loop.is_running():
+                asyncio.run_coroutine_threadsafe(session.close(), loop).result(timeout)
+            elif not loop.is_closed() and running is None:
+                loop.run_until_complete(session.close())
+
+    def __enter__(self) -> 'ServiceXAdaptor':
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    async def __aenter__(self) -> 'ServiceXAdaptor':
+        return self
+
+    async def __aexit__(self, *args) -> None:
+        await self.close_async()
+
+
+class PollSchedule:
+    '''
+    Decide how long to wait before asking ServiceX for the status of a transform again. We
+    start out polling quickly, so short transforms are not held up. While nothing changes we
+    back off exponentially up to a maximum, and as soon as something changes we go back to
+    polling quickly.
+    '''
+    def __init__(self, min_time: float, max_time: float, backoff: float = 2.0):
+        '''
+        Arguments:
+            min_time            Shortest time to wait between polls, in seconds
+            max_time            Longest time to wait between polls, in seconds
+            backoff             Factor the wait grows by each time nothing has changed
+        '''
+        self._max_time = max_time
+        self._min_time = min(min_time, max_time)
+        self._backoff = backoff
+        self._delay = self._min_time
+
+    @property
+    def delay(self) -> float:
+        'Number of seconds to wait before the next poll'
+        return self._delay
+
+    def update(self, changed: bool) -> None:
+        'Record the result of a poll - `changed` is True if progress was made'
+        if changed:
+            self._delay = self._min_time
+        else:
+            self._delay = min(self._max_time, self._delay * self._backoff)
+
+
+class TransformStatusChannel:
+    '''
+    Derive from this to get transform status updates pushed from ServiceX (or by long-polling),
+    rather than by polling on a timer. Whenever the channel returns None, the status is polled
+    as usual.
+    '''
+    async def wait_for_status(self, endpoint: str, request_id: str, timeout: float) \
+            -> Optional[Tuple[Optional[int], int]]:
+        '''
+        Wait for the status of a transform to change.
+
+        Arguments:
+            endpoint            Web API address where servicex lives
+            request_id          The id of the request to wait on
+            timeout             The longest time, in seconds, to wait.
+
+        Returns:
+            status              None if there is no update (or the channel isn't supported),
+                                otherwise the files remaining (None if not yet known) and the
+                                files processed.
+        '''
+        raise NotImplementedError()
+
+
+class StatusTracker:
+    '''
+    Fetches the status of every transform being waited on at one ServiceX endpoint, from a
+    single task. Waits that come due at about the same time are answered by one round of
+    requests, sent at once over the pooled session, and any number of waits on the same
+    transform share one request. Each waiter is woken by its own future, so a slow or failed
+    status request for one transform does not hold up the others.
+    '''
+    def __init__(self, fetch: Callable[[str], Awaitable[Tuple[Optional[int], int]]],
+                 max_concurrent: int = 10, batch_window: float = 0.1):
+        '''
+        Arguments:
+            fetch               Called with a request id to get the status of that transform
+            max_concurrent      Most status requests that are sent at once
+            batch_window        Waits that come due within this many seconds of each other are
+                                answered by the same status request
+        '''
+        self._fetch = fetch
+        self._max_concurrent = max_concurrent
+        self._batch_window = batch_window
+
+        # The futures waiting on each transform, and when each is due, by request id
+        self._waiters = {}  # type: Dict[str, List[Tuple[float, asyncio.Future]]]
+        self._fetching = {}  # type: Dict[str, asyncio.Future]
+        self._task = None  # type: Optional[asyncio.Future]
+        self._wakeup = None  # type: Optional[asyncio.Event]
+        self._semaphore = None  # type: Optional[asyncio.Semaphore]
+
+    @property
+    def request_ids(self) -> List[str]:
+        'The transforms that are being waited on'
+        return list(self._waiters.keys())
+
+    async def wait_for_status(self, request_id: str, delay: float) \
+            -> Tuple[Optional[int], int]:
+        '''
+        Wait `delay` seconds (a little less if other waits come due then), and return the
+        status of a transform: the files remaining (None if not yet known) and files processed.
+        '''
+        if self._wakeup is None:
+            self._wakeup = asyncio.Event()
+            self._semaphore = asyncio.Semaphore(self._max_concurrent)
+        future = asyncio.get_event_loop().create_future()
+        entry = (time.monotonic() + delay, future)
+        self._waiters.setdefault(request_id, []).append(entry)
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._run())
+        self._wakeup.set()
+        try:
+            return await future
+        finally:
+            self._remove(request_id, entry)
+
+    def _remove(self, request_id: str, entry: Tuple[float, asyncio.Future]) -> None:
+        'Stop waiting on a transform, and stop fetching its status if no one else is waiting'
+        waiters = self._waiters.get(request_id, [])
+        if entry in waiters:
+            waiters.remove(entry)
+        if len(waiters) == 0:
+            self._waiters.pop(request_id, None)
+            fetch = self._fetching.pop(request_id, None)
+            if fetch is not None:
+                fetch.cancel()
+        self._wakeup.set()
+
+    async def _run(self) -> None:
+        'Start the status requests as they come due, until no one is waiting'
+        while len(self._waiters) > 0:
+            now = time.monotonic()
+            next_due = None  # type: Optional[float]
+            for request_id, waiters in self._waiters.items():
+                if request_id in self._fetching:
+                    continue
+                due = min(d for d, _ in waiters)
+                if due <= now + self._batch_window:
+                    self._fetching[request_id] = asyncio.ensure_future(
+                        self._fetch_status(request_id))
+                else:
+                    next_due = due if next_due is None else min(next_due, due)
+
+            self._wakeup.clear()
+            timeout = None if next_due is None else max(0.0, next_due - now - self._batch_window)
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _fetch_status(self, request_id: str) -> None:
+        'Get the status of one transform, and hand it to everyone whose wait is over'
+        started = time.monotonic()
+        try:
+            async with self._semaphore:
+                result = await self._fetch(request_id)
+            error = None  # type: Optional[BaseException]
+        except asyncio.CancelledError:
+            raise
+        except BaseException as e:
+            error = e
+        self._fetching.pop(request_id, None)
+
+        for due, future in self._waiters.get(request_id, []):
+            if due <= started + self._batch_window and not future.done():
+                if error is None:
+                    future.set_result(result)
+                else:
+                    future.set_exception(error)
+        self._wakeup.set()
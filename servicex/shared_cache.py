@@ -0,0 +1,312 @@
+# A cache of loaded files on local disk that every process on a machine - whoever runs it - can
+# share, so a popular query is downloaded and loaded once per machine rather than once per user.
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+from typing import Any, List, Optional, Tuple
+
+from .spill import spill, SpilledData
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    # Not available on Windows. Entries are still published atomically there, but two
+    # processes can end up downloading the same file.
+    fcntl = None
+
+# Name of the file in each entry that says what the other files in it hold
+_contents_name = 'contents.json'
+
+# Name of the empty file in each entry whose modification time is when the entry was last used.
+# Every user can write to it, so any of them can mark the entry as used.
+_last_used_name = 'last-used'
+
+# Name of the file that lists the objects a query produced, once all of them are in the cache
+_objects_name = 'objects.json'
+
+# Prefix of the directories entries are written in before they are published
+_temp_prefix = '.tmp-'
+
+# Seconds after which a temp directory is assumed to have been left by a process that died
+_temp_max_age = 3600
+
+
+def _make_shared_dir(path: str) -> None:
+    'Create a directory that every user can add to'
+    if os.path.isdir(path):
+        return
+    os.makedirs(path, exist_ok=True)
+    try:
+        os.chmod(path, 0o777)
+    except OSError:
+        # Made by someone else in the meantime
+        pass
+
+
+def _write_json(directory: str, name: str, info: Any) -> None:
+    'Write a json file that every user can read, so it appears all at once'
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix=_temp_prefix)
+    try:
+        with os.fdopen(fd, 'w') as f_out:
+            json.dump(info, f_out)
+        os.chmod(temp_path, 0o644)
+        os.replace(temp_path, os.path.join(directory, name))
+    except BaseException:
+        os.remove(temp_path)
+        raise
+
+
+def _touch_last_used(entry_dir: str) -> None:
+    '''
+    Mark an entry as used now. Setting a file's time to now only needs write access to it, so
+    this works for every user, not just the one that wrote the entry.
+    '''
+    os.utime(os.path.join(entry_dir, _last_used_name), None)
+
+
+def _encode_contents(object_name: str, spilled: SpilledData) -> Any:
+    '''
+    Describe a spilled file in json. Column names of awkward arrays are bytes, which json can't
+    hold, so they are written as latin-1 strings. The contents are never pickled, as the files
+    may have been written by another user.
+    '''
+    info = spilled.info
+    if spilled.kind == 'awkward':
+        info = [[name.decode('latin-1') if isinstance(name, bytes) else name,
+                 isinstance(name, bytes), saved] for name, saved in info]
+    return {'object_name': object_name, 'kind': spilled.kind, 'info': info}
+
+
+def _decode_contents(directory: str, contents: Any) -> SpilledData:
+    'Turn what `_encode_contents` wrote back into a `SpilledData` for the files in `directory`'
+    info = contents['info']
+    if contents['kind'] == 'awkward':
+        info = [(name.encode('latin-1') if is_bytes else name, saved)
+                for name, is_bytes, saved in info]
+    return SpilledData(directory, contents['kind'], info)
+
+
+class _EntryLock:
+    'A lock on one entry of a `SharedFileCache`, held until `release` is called'
+    def __init__(self, fd: Optional[int]):
+        self._fd = fd
+
+    def release(self) -> None:
+        if self._fd is not None:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+            os.close(self._fd)
+            self._fd = None
+
+
+class SharedFileCache:
+    '''
+    Loaded files from ServiceX queries, kept in a directory on local disk that any number of
+    processes can use at once. Each file is stored in columnar form (`.npy` files, or an arrow
+    IPC file) which is memory mapped when it is used, so processes reading the same file share
+    one copy of it in memory.
+
+    Entries are keyed by the query (see `query_cache_key`) and the name of the object in the
+    bucket. Each is written to a temp directory and renamed into place, so it is never seen
+    half written, and a lock file makes sure only one process downloads each file. Once every
+    file of a query is in the cache, the list of them is saved too, and the query does not need
+    to go to ServiceX at all. When the cache grows beyond `max_size` bytes the least recently
+    used entries are removed.
+
+    The directory, and each entry in it, is made writable by every user, so any of them can mark
+    an entry as used or evict it. Anyone who can write to it is trusted to put the right data
+    in it.
+    '''
+    def __init__(self, path: str, max_size: int = 100 * 1024 * 1024 * 1024):
+        '''
+        Arguments:
+            path                Directory where the cache lives. Created if needed.
+            max_size            Maximum size in bytes the cache is allowed to take on disk.
+        '''
+        self._path = path
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def path(self) -> str:
+        'The directory where the cache lives'
+        return self._path
+
+    def _key_dir(self, key: str) -> str:
+        return os.path.join(self._path, key)
+
+    def _entry_dir(self, key: str, object_name: str) -> str:
+        name_hash = hashlib.sha256(object_name.encode('utf-8')).hexdigest()
+        return os.path.join(self._path, key, name_hash)
+
+    def try_lock(self, key: str, object_name: str) -> Optional[_EntryLock]:
+        '''
+        Lock the entry for a file, so other processes know it is being downloaded. Returns None
+        if another process (or another call in this one) holds the lock. Does not wait.
+        '''
+        if fcntl is None:  # pragma: no cover
+            return _EntryLock(None)
+        _make_shared_dir(self._path)
+        _make_shared_dir(self._key_dir(key))
+        lock_path = self._entry_dir(key, object_name) + '.lock'
+        try:
+            # Locks over NFS only work on files opened for writing.
+            fd = os.open(lock_path, os.O_RDWR | os.O_CREAT, 0o666)
+        except PermissionError:
+            fd = os.open(lock_path, os.O_RDONLY)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return None
+        return _EntryLock(fd)
+
+    def lookup(self, key: str, object_name: str) -> Optional[Any]:
+        '''
+        Return the data loaded from a file, memory mapped from the cache, or None if it is not
+        in the cache. Changes made to mapped arrays are not written back.
+        '''
+        entry_dir = self._entry_dir(key, object_name)
+        contents_path = os.path.join(entry_dir, _contents_name)
+        try:
+            with open(contents_path, 'r') as f_in:
+                contents = json.load(f_in)
+            if contents['object_name'] != object_name:
+                raise ValueError(f'Entry for {object_name} holds {contents["object_name"]}')
+            data = _decode_contents(entry_dir, contents).load()
+        except (OSError, ValueError, KeyError, TypeError):
+            # Not there, evicted while we were reading it, or damaged.
+            self.misses += 1
+            return None
+
+        # Mark this entry as recently used so eviction picks on something else.
+        try:
+            _touch_last_used(entry_dir)
+        except OSError:
+            # Evicted since, or written before entries had the file.
+            pass
+        self.hits += 1
+        return data
+
+    def save(self, key: str, object_name: str, data: Any) -> bool:
+        '''
+        Store the data loaded from a file, and evict old entries if the cache is now too large.
+
+        Returns:
+            saved               False if the data can't be stored in columnar form, or another
+                                process stored it first.
+        '''
+        key_dir = self._key_dir(key)
+        _make_shared_dir(self._path)
+        _make_shared_dir(key_dir)
+        temp_dir = tempfile.mkdtemp(dir=key_dir, prefix=_temp_prefix)  # type: Optional[str]
+        try:
+            spilled = spill(data, temp_dir, 'data')
+            if spilled is None:
+                return False
+            _write_json(temp_dir, _contents_name, _encode_contents(object_name, spilled))
+
+            # Whatever the umask, every user must be able to read the data, mark the entry as
+            # used, and remove the entry when evicting.
+            for name in os.listdir(temp_dir):
+                os.chmod(os.path.join(temp_dir, name), 0o644)
+            fd = os.open(os.path.join(temp_dir, _last_used_name), os.O_WRONLY | os.O_CREAT, 0o666)
+            os.close(fd)
+            os.chmod(os.path.join(temp_dir, _last_used_name), 0o666)
+            os.chmod(temp_dir, 0o777)
+            try:
+                os.rename(temp_dir, self._entry_dir(key, object_name))
+            except OSError:
+                return False
+            temp_dir = None
+        finally:
+            if temp_dir is not None:
+                shutil.rmtree(temp_dir, ignore_errors=True)
+
+        self._evict()
+        return True
+
+    def objects(self, key: str) -> Optional[List[str]]:
+        '''
+        Return the names of all the files a query produced, if they were all saved in the
+        cache, or None.
+        '''
+        try:
+            with open(os.path.join(self._key_dir(key), _objects_name), 'r') as f_in:
+                names = json.load(f_in)
+        except (OSError, ValueError):
+            return None
+        return names if isinstance(names, list) else None
+
+    def save_objects(self, key: str, object_names: List[str]) -> None:
+        'Record the names of all the files a query produced'
+        _make_shared_dir(self._path)
+        _make_shared_dir(self._key_dir(key))
+        _write_json(self._key_dir(key), _objects_name, list(object_names))
+
+    def invalidate(self, key: Optional[str] = None) -> None:
+        '''
+        Remove a query's files from the cache. If `key` is None, then everything in the cache
+        is removed.
+        '''
+        if key is not None:
+            shutil.rmtree(self._key_dir(key), ignore_errors=True)
+        elif os.path.isdir(self._path):
+            for name in os.listdir(self._path):
+                shutil.rmtree(os.path.join(self._path, name), ignore_errors=True)
+
+    def _entries(self) -> List[Tuple[float, int, str]]:
+        'Return (last-used-time, size, path) for every entry in the cache'
+        if not os.path.isdir(self._path):
+            return []
+        result = []
+        for key in os.listdir(self._path):
+            key_dir = self._key_dir(key)
+            if not os.path.isdir(key_dir):
+                continue
+            for name in os.listdir(key_dir):
+                entry_dir = os.path.join(key_dir, name)
+                if not os.path.isdir(entry_dir):
+                    continue
+                try:
+                    if name.startswith(_temp_prefix):
+                        # Left behind by a process that died part way through a save
+                        if os.stat(entry_dir).st_mtime < time.time() - _temp_max_age:
+                            shutil.rmtree(entry_dir, ignore_errors=True)
+                        continue
+                    try:
+                        last_used = os.stat(os.path.join(entry_dir, _last_used_name)).st_mtime
+                    except FileNotFoundError:
+                        # Written before entries had the file
+                        last_used = os.stat(os.path.join(entry_dir, _contents_name)).st_mtime
+                    size = sum(os.path.getsize(os.path.join(entry_dir, f))
+                               for f in os.listdir(entry_dir))
+                except FileNotFoundError:
+                    # Another process may have evicted this while we were looking.
+                    continue
+                result.append((last_used, size, entry_dir))
+        return result
+
+    @property
+    def size(self) -> int:
+        'Total number of bytes the cache is currently using on disk'
+        return sum(e[1] for e in self._entries())
+
+    def _evict(self) -> None:
+        '''
+        Remove the least recently used entries until we are under the size limit. Processes
+        that have them mapped keep their copy until they are done with it.
+        '''
+        entries = sorted(self._entries())
+        total = sum(e[1] for e in entries)
+        for _, size, entry_dir in entries:
+            if total <= self.max_size:
+                break
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            if os.path.exists(entry_dir):
+                # Not ours to remove (e.g. written before entries were writable by every user)
+                continue
+            total -= size
@@ -0,0 +1,127 @@
+# Decide how large a transform to ask ServiceX for, from how much data the query is expected to
+# produce.
+import hashlib
+import json
+import math
+import os
+import tempfile
+import time
+from typing import Any, Dict, Optional
+
+# The transform is given one worker for about this many bytes of results when only their total
+# size is known. When the number of files is known there is one worker per file.
+_bytes_per_worker = 256 * 1024 * 1024
+
+# The chunk size grows from the default by one chunk's worth of entries for about this many bytes
+# in each result file.
+_bytes_per_chunk_step = 10 * 1024 * 1024
+
+
+class TransformSize:
+    'The size of a transform, and of the downloading done to keep up with it'
+    def __init__(self, workers: int, chunk_size: int, download_concurrency: int):
+        '''
+        Arguments:
+            workers             Number of workers ServiceX runs the transform on
+            chunk_size          The transform's "chunk-size"
+            download_concurrency
+                                Number of files to download at once
+        '''
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self.download_concurrency = download_concurrency
+
+    def __repr__(self) -> str:
+        return f'TransformSize(workers={self.workers}, chunk_size={self.chunk_size}, ' \
+            f'download_concurrency={self.download_concurrency})'
+
+
+def choose_transform_size(size: Optional[int], files: Optional[int], default: TransformSize,
+                          max_workers: int, max_download_concurrency: int) -> TransformSize:
+    '''
+    Size a transform from what it is expected to produce. Each part that can't be worked out
+    is taken from `default`.
+
+    Arguments:
+        size                Total bytes of results expected, or None if not known
+        files               Number of result files expected (one per input file), or None
+        default             Used for anything that can't be estimated, and as the smallest
+                            download concurrency
+        max_workers         Most workers to ask for
+        max_download_concurrency
+                            Most files to download at once
+
+    Returns:
+        size                The transform size to use
+    '''
+    if files is not None and files > 0:
+        workers = min(files, max_workers)
+    elif size is not None:
+        workers = max(1, min(int(math.ceil(size / _bytes_per_worker)), max_workers))
+    else:
+        return default
+
+    chunk_size = default.chunk_size
+    if size is not None and files is not None and files > 0:
+        chunk_size *= max(1, int(size / files / _bytes_per_chunk_step))
+
+    download_concurrency = max(default.download_concurrency,
+                               min(workers, max_download_concurrency))
+    return TransformSize(workers, chunk_size, download_concurrency)
+
+
+def _hash(info: Any) -> str:
+    return hashlib.sha256(json.dumps(info, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+class TransformHistory:
+    '''
+    A record on local disk of how many files, and bytes, each query produced the last time it
+    was run - and, for queries that have never been run, any query against the same dataset.
+    Used to size transforms automatically.
+    '''
+    def __init__(self, path: str):
+        '''
+        Arguments:
+            path                Directory where the history is kept. Created if needed.
+        '''
+        self._path = path
+
+    @property
+    def path(self) -> str:
+        'The directory where the history lives'
+        return self._path
+
+    def _entry_path(self, kind: str, info: Any) -> str:
+        return os.path.join(self._path, f'{kind}-{_hash(info)}.json')
+
+    def record(self, json_query: Dict[str, Any], files: int, size: int) -> None:
+        'Record what a query produced'
+        os.makedirs(self._path, exist_ok=True)
+        entry = {'files': files, 'size': size, 'time': time.time()}
+        for path in (self._entry_path('query', json_query),
+                     self._entry_path('dataset', json_query['did'])):
+            # Write to a temp file and move it into place so a reader never sees part of it.
+            fd, temp_path = tempfile.mkstemp(dir=self._path, suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'w') as f_out:
+                    json.dump(entry, f_out)
+                os.replace(temp_path, path)
+            except BaseException:
+                os.remove(temp_path)
+                raise
+
+    def lookup(self, json_query: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        '''
+        Return what the query produced last time (a dictionary with `files` and `size`), or,
+        if it has not been run, what the last query against the same dataset produced. None if
+        neither is known.
+        '''
+        for path in (self._entry_path('query', json_query),
+                     self._entry_path('dataset', json_query['did'])):
+            try:
+                with open(path, 'r') as f_in:
+                    return json.load(f_in)
+            except (OSError, ValueError):
+                continue
+        return None
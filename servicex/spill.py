@@ -0,0 +1,137 @@
+# Move loaded results out of memory and into local files, and back again
+import os
+from typing import Any, List, Optional, Tuple
+
+import awkward
+import numpy as np
+import pandas as pd
+
+try:
+    import pyarrow as pa
+except ImportError:  # pragma: no cover
+    pa = None
+
+
+def data_size(data: Any) -> int:
+    'The number of bytes of memory the data a file was loaded into takes up'
+    if isinstance(data, pd.DataFrame):
+        return int(data.memory_usage(index=True, deep=False).sum())
+    if isinstance(data, dict):
+        return sum(int(getattr(c, 'nbytes', 0)) for c in data.values())
+    return int(getattr(data, 'nbytes', 0))
+
+
+def _save_array(directory: str, name: str, array: Any) -> Optional[Tuple[str, Any]]:
+    '''
+    Write a numpy array, or a jagged array of them, to `.npy` files. Returns what is needed to
+    load it again (with file names relative to `directory`), or None if it is something else
+    (which is left alone).
+    '''
+    if isinstance(array, np.ndarray):
+        if array.dtype.hasobject:
+            return None
+        np.save(os.path.join(directory, f'{name}.npy'), array, allow_pickle=False)
+        return 'numpy', f'{name}.npy'
+    if isinstance(array, awkward.JaggedArray):
+        array = array.compact()
+        offsets = _save_array(directory, f'{name}.offsets', array.offsets)
+        content = _save_array(directory, f'{name}.content', array.content)
+        if offsets is None or content is None:
+            return None
+        return 'jagged', (offsets, content)
+    return None
+
+
+def _load_array(directory: str, saved: Tuple[str, Any], in_memory: bool) -> Any:
+    '''
+    Load (or memory map) an array written by `_save_array`. Mapped arrays are copy-on-write:
+    they can be changed, but the changes are not written back to the files.
+    '''
+    kind, info = saved
+    if kind == 'numpy':
+        # A plain array viewing the mapped file - not all of awkward copes with `np.memmap`.
+        return np.asarray(np.load(os.path.join(directory, info),
+                                  mmap_mode=None if in_memory else 'c'))
+    offsets, content = info
+    return awkward.JaggedArray.fromoffsets(_load_array(directory, offsets, in_memory),
+                                           _load_array(directory, content, in_memory))
+
+
+class SpilledData:
+    '''
+    The data loaded from a file, written out to local columnar files to free up memory: numpy
+    `.npy` files for each column of a DataFrame or awkward array, and an arrow IPC file for an
+    arrow table. Loading it memory maps the files, so the operating system only brings back in
+    the pages that are used, and can drop them again.
+
+    Only the file names relative to `directory` are kept, so the files can be moved, and
+    `kind` and `info` can be saved and used to make a new `SpilledData` for the new place.
+    '''
+    def __init__(self, directory: str, kind: str, info: Any):
+        self.directory = directory
+        self.kind = kind
+        self.info = info
+
+    def load(self, in_memory: bool = False) -> Any:
+        '''
+        Return the data, backed by the files (memory mapped), or, if `in_memory` is set, read
+        back into memory so the files can be removed.
+        '''
+        if self.kind == 'arrow':
+            path = os.path.join(self.directory, self.info)
+            source = pa.OSFile(path, 'rb') if in_memory else pa.memory_map(path, 'r')
+            return pa.ipc.open_file(source).read_all()
+        if self.kind == 'awkward':
+            return {name: _load_array(self.directory, saved, in_memory)
+                    for name, saved in self.info}
+        index_names, columns = self.info
+        df = pd.DataFrame({name: _load_array(self.directory, saved, in_memory)
+                           for name, saved in columns}, copy=False)
+        return df.set_index(index_names) if len(index_names) > 0 else df
+
+
+def spill(data: Any, directory: str, name: str) -> Optional[SpilledData]:
+    '''
+    Write data that was loaded from a file to local files in `directory`, with names that start
+    with `name`. This makes blocking calls.
+
+    Returns:
+        spilled             How to get the data back, or None if it is of a kind that can't be
+                            written out (e.g. a DataFrame column of python objects).
+    '''
+    if pa is not None and isinstance(data, pa.Table):
+        with pa.OSFile(os.path.join(directory, f'{name}.arrow'), 'wb') as sink:
+            with pa.ipc.new_file(sink, data.schema) as writer:
+                writer.write_table(data)
+        return SpilledData(directory, 'arrow', f'{name}.arrow')
+
+    if isinstance(data, dict):
+        saved: List[Tuple[Any, Any]] = []
+        for i, (column_name, column) in enumerate(data.items()):
+            s = _save_array(directory, f'{name}.{i}', column)
+            if s is None:
+                return None
+            saved.append((column_name, s))
+        return SpilledData(directory, 'awkward', saved)
+
+    if isinstance(data, pd.DataFrame):
+        # The index (e.g. entry and subentry) is written out as ordinary columns.
+        # An unnamed index has to be the default one, which loading recreates.
+        index_names = [n for n in data.index.names if n is not None]
+        if len(index_names) == 0:
+            if not data.index.equals(pd.RangeIndex(len(data))):
+                return None
+        elif len(index_names) != data.index.nlevels:
+            return None
+        flat = data.reset_index() if len(index_names) > 0 else data
+        if not all(isinstance(n, str) for n in flat.columns):
+            return None
+        columns: List[Tuple[str, Any]] = []
+        for i, column_name in enumerate(flat.columns):
+            s = _save_array(directory, f'{name}.{i}', flat[column_name].to_numpy())
+            if s is None:
+                return None
+            columns.append((column_name, s))
+        return SpilledData(directory, 'pandas', (index_names, columns))
+
+    return None
@@ -19,17 +19,26 @@ setup(name="servicex",
       maintainer_email="gwatts@uw.edu",
       url="https://github.com/iris-hep/func_adl_xAOD",
       license="TBD",
-      python_requires='>=3.6, <=3.8.1',
+      python_requires='>=3.6',
       test_suite="tests",
       install_requires=[
           "pandas~=1.0",
           "uproot~=3.7",
           "retry~=0.9",
           "aiohttp~=3.6",
-          "minio~=5.0",
-          "nest_asyncio>=1.3"
+          "minio~=5.0"
       ],
       extras_require={
+          'arrow': [
+              'pyarrow>=1.0'
+          ],
+          'opentelemetry': [
+              'opentelemetry-api'
+          ],
+          'dask': [
+              'dask[dataframe]',
+              'distributed'
+          ],
           'test': [
               'pytest>=3.9',
               'pytest-asyncio',
@@ -40,7 +49,11 @@ setup(name="servicex",
               'codecov',
               'autopep8',
               'twine',
-              'jupyterlab'
+              'jupyterlab',
+              'pyarrow>=1.0',
+              'opentelemetry-sdk',
+              'dask[dataframe]',
+              'distributed'
           ],
       },
       classifiers=[
@@ -0,0 +1,40 @@
+import pytest
+
+import servicex as fe
+from servicex.sizing import TransformHistory
+
+
+@pytest.fixture(autouse=True)
+def clean_query_cache(tmp_path):
+    'Each test gets its own empty query cache so results do not leak between tests'
+    old_cache = fe.servicex.query_cache
+    fe.servicex.query_cache = fe.QueryCache(str(tmp_path / 'query_cache'))
+    yield fe.servicex.query_cache
+    fe.servicex.query_cache = old_cache
+
+
+@pytest.fixture(autouse=True)
+def clean_query_journal(tmp_path):
+    'Each test gets its own empty journal so transforms are not picked up between tests'
+    old_journal = fe.servicex.query_journal
+    fe.servicex.query_journal = fe.QueryJournal(str(tmp_path / 'journal'))
+    yield fe.servicex.query_journal
+    fe.servicex.query_journal = old_journal
+
+
+@pytest.fixture(autouse=True)
+def clean_transform_history(tmp_path):
+    'Each test gets its own empty record of what queries produced'
+    old_history = fe.servicex.transform_history
+    fe.servicex.transform_history = TransformHistory(str(tmp_path / 'transform_history'))
+    yield fe.servicex.transform_history
+    fe.servicex.transform_history = old_history
+
+
+@pytest.fixture(autouse=True)
+def clean_incremental_results(tmp_path):
+    'Each test gets its own empty store of incremental results'
+    old_results = fe.servicex.incremental_results
+    fe.servicex.incremental_results = fe.QueryCache(str(tmp_path / 'incremental'))
+    yield fe.servicex.incremental_results
+    fe.servicex.incremental_results = old_results
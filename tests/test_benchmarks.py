@@ -0,0 +1,83 @@
+import queue
+
+import pytest
+
+from benchmarks.fake_servicex import FakeServiceX, Scenario
+from benchmarks.run_benchmarks import _wait_for_run, BenchmarkError, compare, main, run_scenario
+import servicex as fe
+
+
+@pytest.fixture(scope='module')
+def fake_servicex():
+    with FakeServiceX(Scenario('tiny', files=3, entries_per_file=1000, columns=2,
+                               transform_delay=0.05)) as fake:
+        yield fake
+
+
+@pytest.mark.parametrize('method', ['minio', 'aiohttp'])
+def test_get_data_from_fake(fake_servicex, method, mocker):
+    mocker.patch('servicex.servicex.servicex_download_method', method)
+    adaptor = fe.ServiceXAdaptor(fake_servicex.servicex_endpoint,
+                                 minio_endpoint=fake_servicex.minio_endpoint)
+    stats = fe.QueryStats()
+    r = fe.get_data('(valid qastle string)', 'tiny', use_cache=False, servicex_adaptor=adaptor,
+                    stats=stats)
+    assert len(r) == 3000
+    assert list(r.columns) == ['EventNumber', 'col0', 'col1']
+    assert stats.bytes_downloaded == 3 * fake_servicex.file_size
+
+
+def test_run_scenario():
+    r = run_scenario(Scenario('tiny', files=2, entries_per_file=1000, columns=1), repeat=1)
+    assert r['scenario']['name'] == 'tiny'
+    assert r['measurements']['wall_time']['median'] > 0
+    assert r['measurements']['entries_per_second']['best'] > 0
+    assert 'download' in r['phases']
+
+
+def test_run_scenario_fails():
+    'A run that fails in its process is reported, rather than waited on forever'
+    with pytest.raises(BenchmarkError, match='Unknown download method'):
+        run_scenario(Scenario('tiny', files=1, entries_per_file=1000, columns=1), repeat=1,
+                     settings={'servicex_download_method': 'carrier-pigeon'})
+
+
+def test_wait_for_run_process_died(mocker):
+    'A process that dies without sending anything back (e.g. killed for using too much memory)'
+    mocker.patch('benchmarks.run_benchmarks._poll_interval', 0.01)
+    p = mocker.MagicMock(exitcode=-9)
+    p.is_alive.return_value = False
+    with pytest.raises(BenchmarkError, match='exited with code -9'):
+        _wait_for_run(p, queue.Queue(), 60)
+
+
+def test_wait_for_run_timeout(mocker):
+    mocker.patch('benchmarks.run_benchmarks._poll_interval', 0.01)
+    p = mocker.MagicMock()
+    p.is_alive.return_value = True
+    with pytest.raises(BenchmarkError, match='more than 0.05 seconds'):
+        _wait_for_run(p, queue.Queue(), 0.05)
+    p.terminate.assert_called_once()
+
+
+def test_main_reports_failed_scenario(tmp_path, capsys):
+    output = str(tmp_path / 'results.json')
+    assert main(['-s', 'many-small-files', '-n', '1', '-o', output,
+                 '--setting', "servicex_download_method='carrier-pigeon'"]) == 1
+    assert 'many-small-files failed' in capsys.readouterr().out
+
+
+def _results(wall_time, rate):
+    return {'results': [{'scenario': {'name': 'a'},
+                         'measurements': {'wall_time': {'median': wall_time},
+                                          'bytes_per_second': {'median': rate}}}]}
+
+
+def test_compare_no_change():
+    assert compare(_results(1.0, 100.0), _results(1.05, 97.0), 0.1) == []
+
+
+def test_compare_regressions():
+    regressions = compare(_results(1.0, 100.0), _results(1.5, 50.0), 0.1)
+    assert len(regressions) == 2
+    assert regressions[0].startswith('a wall_time')
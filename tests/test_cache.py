@@ -0,0 +1,119 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from servicex.cache import QueryCache, query_cache_key, user_cache_path
+
+
+def test_key_stable():
+    k1 = query_cache_key({'did': 'ds1', 'selection': 'q'}, 'pandas')
+    k2 = query_cache_key({'selection': 'q', 'did': 'ds1'}, 'pandas')
+    assert k1 == k2
+
+
+def test_key_data_type():
+    k1 = query_cache_key({'did': 'ds1', 'selection': 'q'}, 'pandas')
+    k2 = query_cache_key({'did': 'ds1', 'selection': 'q'}, 'awkward')
+    assert k1 != k2
+
+
+def test_key_columns():
+    q = {'did': 'ds1', 'selection': 'q'}
+    assert query_cache_key(q, 'pandas') == query_cache_key(q, 'pandas', None, None)
+    assert query_cache_key(q, 'pandas') != query_cache_key(q, 'pandas', ['JetPt'])
+    assert query_cache_key(q, 'pandas', dtypes={'JetPt': 'float32'}) \
+        == query_cache_key(q, 'pandas', dtypes={'JetPt': np.float32})
+    assert query_cache_key(q, 'pandas', dtypes={'JetPt': 'float32'}) \
+        != query_cache_key(q, 'pandas', dtypes={'JetPt': 'float64'})
+
+
+def test_miss_then_hit(tmp_path):
+    c = QueryCache(str(tmp_path))
+    assert c.lookup('1234') is None
+    c.save('1234', pd.DataFrame({'JetPt': [1.0, 2.0]}))
+    r = c.lookup('1234')
+    assert isinstance(r, pd.DataFrame)
+    assert len(r) == 2
+    assert c.hits == 1
+    assert c.misses == 1
+
+
+def test_invalidate_one(tmp_path):
+    c = QueryCache(str(tmp_path))
+    c.save('1', [1])
+    c.save('2', [2])
+    c.invalidate('1')
+    assert c.lookup('1') is None
+    assert c.lookup('2') == [2]
+
+
+def test_invalidate_all(tmp_path):
+    c = QueryCache(str(tmp_path))
+    c.save('1', [1])
+    c.save('2', [2])
+    c.invalidate()
+    assert c.lookup('1') is None
+    assert c.lookup('2') is None
+    assert c.size == 0
+
+
+def test_invalidate_missing(tmp_path):
+    c = QueryCache(str(tmp_path / 'not_there'))
+    c.invalidate('1')
+    c.invalidate()
+
+
+def test_lru_eviction(tmp_path):
+    c = QueryCache(str(tmp_path))
+    c.save('1', b'a' * 1000)
+    c.save('2', b'b' * 1000)
+    os.utime(c._entry_path('1'), (1, 1))
+    os.utime(c._entry_path('2'), (2, 2))
+
+    # Touch 1 so it is more recent than 2.
+    assert c.lookup('1') is not None
+
+    c.max_size = 2500
+    c.save('3', b'c' * 1000)
+    assert c.lookup('2') is None
+    assert c.lookup('1') is not None
+    assert c.lookup('3') is not None
+
+
+def test_too_large_not_saved(tmp_path):
+    'An entry bigger than the whole cache must not push everything else out'
+    c = QueryCache(str(tmp_path / 'cache'), max_size=2500)
+    c.save('1', b'a' * 1000)
+    c.save('2', b'b' * 1000)
+
+    assert not c.save('3', b'c' * 3000)
+    assert c.lookup('3') is None
+    assert c.lookup('1') is not None
+    assert c.lookup('2') is not None
+    assert sorted(os.listdir(str(tmp_path / 'cache'))) == ['1.pickle', '2.pickle']
+
+
+def test_user_cache_path():
+    path = user_cache_path('query_cache')
+    assert os.path.basename(path) == 'query_cache'
+    assert os.path.basename(os.path.dirname(path)).startswith('servicex-')
+
+
+@pytest.mark.skipif(not hasattr(os, 'getuid'), reason='No file owners on this platform')
+def test_created_private(tmp_path):
+    c = QueryCache(str(tmp_path / 'cache'))
+    c.save('1234', pd.DataFrame({'JetPt': [1.0, 2.0]}))
+    assert os.stat(str(tmp_path / 'cache')).st_mode & 0o077 == 0
+
+
+@pytest.mark.skipif(not hasattr(os, 'getuid'), reason='No file owners on this platform')
+def test_not_loaded_if_others_can_write(tmp_path):
+    'Anyone who can write to the directory could plant a pickle there'
+    c = QueryCache(str(tmp_path / 'cache'))
+    c.save('1234', pd.DataFrame({'JetPt': [1.0, 2.0]}))
+    os.chmod(str(tmp_path / 'cache'), 0o777)
+    assert c.lookup('1234') is None
+    with pytest.raises(PermissionError):
+        c.save('1234', pd.DataFrame({'JetPt': [1.0, 2.0]}))
@@ -0,0 +1,77 @@
+import pandas as pd
+import pytest
+
+from benchmarks.fake_servicex import FakeServiceX, Scenario
+import servicex as fe
+from servicex import dask_results
+
+
+@pytest.fixture(scope='module')
+def fake_servicex():
+    with FakeServiceX(Scenario('dask', files=3, entries_per_file=1000, columns=2,
+                               transform_delay=0.05)) as fake:
+        yield fake
+
+
+@pytest.fixture()
+def adaptor(fake_servicex):
+    adaptor = fe.ServiceXAdaptor(fake_servicex.servicex_endpoint,
+                                 minio_endpoint=fake_servicex.minio_endpoint)
+    yield adaptor
+    adaptor.close()
+
+
+def test_minio_config(adaptor, fake_servicex):
+    config = adaptor.minio_config
+    assert config['minio_endpoint'] == fake_servicex.minio_endpoint
+    assert config['access_key'] == 'miniouser'
+
+
+def test_read_object(adaptor):
+    lazy = fe.get_data_lazy('(valid qastle string)', 'dask_ds', servicex_adaptor=adaptor)
+    name = lazy.files(wait=True)[0]
+    r = dask_results.read_object(adaptor.minio_config, lazy.request_id, name, 'pandas',
+                                 columns=['EventNumber'])
+    assert isinstance(r, pd.DataFrame)
+    assert list(r.EventNumber) == list(range(1000))
+
+    r = dask_results.read_object(adaptor.minio_config, lazy.request_id, name, 'awkward')
+    assert len(r[b'col0']) == 1000
+
+
+def test_no_dask(adaptor, mocker):
+    mocker.patch.object(dask_results, 'dask', None)
+    with pytest.raises(fe.ServiceX_Exception):
+        fe.get_data_dask('(valid qastle string)', 'dask_ds', servicex_adaptor=adaptor)
+
+
+def test_dask_dataframe(adaptor, fake_servicex):
+    pytest.importorskip('dask.dataframe')
+    sent = fake_servicex.bytes_sent
+    r = fe.get_data_dask('(valid qastle string)', 'dask_ds', servicex_adaptor=adaptor)
+    assert r.npartitions == 3
+    assert list(r.columns) == ['EventNumber', 'col0', 'col1']
+    # At most the first file has been read so far, to find the columns.
+    assert fake_servicex.bytes_sent - sent < 3 * fake_servicex.file_size
+
+    df = r.compute(scheduler='threads')
+    assert len(df) == 3000
+
+
+def test_dask_awkward_partitions(adaptor):
+    dask = pytest.importorskip('dask')
+    parts = fe.get_data_dask('(valid qastle string)', 'dask_ds', data_type='awkward',
+                             servicex_adaptor=adaptor)
+    assert len(parts) == 3
+    r = dask.compute(*parts, scheduler='threads')
+    assert [len(p[b'EventNumber']) for p in r] == [1000] * 3
+
+
+def test_dask_local_cluster(adaptor):
+    pytest.importorskip('dask.dataframe')
+    distributed = pytest.importorskip('distributed')
+    r = fe.get_data_dask('(valid qastle string)', 'dask_ds', servicex_adaptor=adaptor,
+                         columns=['EventNumber'])
+    with distributed.LocalCluster(n_workers=2, processes=True) as cluster:
+        with distributed.Client(cluster):
+            assert r.EventNumber.sum().compute() == 3 * sum(range(1000))
@@ -0,0 +1,122 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from servicex import decode
+
+
+def test_read_file_pandas():
+    r = decode.read_root_file('tests/sample_servicex_output.root', 'pandas')
+    assert isinstance(r, pd.DataFrame)
+    assert len(r) == 283458
+
+
+def test_read_memory_awkward():
+    with open('tests/sample_servicex_output.root', 'rb') as f_in:
+        data = bytearray(f_in.read())
+    r = decode.read_root_file(data, 'awkward')
+    assert len(r[b'JetPt']) == 283458
+
+
+def test_read_bad_data_type():
+    with pytest.raises(BaseException):
+        decode.read_root_file('tests/sample_servicex_output.root', 'fork')
+
+
+@pytest.mark.skipif(not decode._use_shared_memory(), reason='No shared memory on this platform')
+def test_shared_memory_round_trip():
+    header, blocks = decode.read_file_in_process('tests/sample_servicex_output.root',
+                                                 'pandas')
+    assert len(blocks) > 0
+    r = decode.unpack_decoded((header, blocks))
+    assert len(r) == 283458
+
+    # The blocks are freed once they have been read
+    for name, _ in blocks:
+        assert not os.path.exists(f'/dev/shm/{name.lstrip("/")}')
+
+
+def test_shared_memory_round_trip_awkward():
+    r = decode.unpack_decoded(
+        decode.read_file_in_process('tests/sample_servicex_output.root', 'awkward'))
+    assert len(r[b'JetPt']) == 283458
+
+
+def test_no_shared_memory(mocker):
+    mocker.patch('servicex.decode._use_shared_memory', return_value=False)
+    header, blocks = decode.read_file_in_process('tests/sample_servicex_output.root',
+                                                 'pandas')
+    assert blocks == []
+    assert len(decode.unpack_decoded((header, blocks))) == 283458
+
+
+def test_read_arrow():
+    r = decode.read_root_file('tests/sample_servicex_output.root', 'arrow')
+    assert r.num_rows == 283458
+    assert r.column_names == ['JetPt']
+
+
+def test_jagged_to_arrow():
+    import awkward
+    jagged = awkward.JaggedArray.fromiter([[1.0, 2.0], [], [3.0]])
+    r = decode._to_arrow_array(jagged[1:])
+    assert r.to_pylist() == [[], [3.0]]
+
+
+def test_read_parquet_from_memory(tmp_path):
+    import pyarrow.parquet as pq
+    path = str(tmp_path / 'sample.parquet')
+    pq.write_table(decode.read_root_file('tests/sample_servicex_output.root', 'arrow'), path)
+    with open(path, 'rb') as f_in:
+        data = bytearray(f_in.read())
+    r = decode.read_file(data, 'pandas', 'parquet')
+    assert len(r) == 283458
+
+
+def test_arrow_to_jagged():
+    import pyarrow as pa
+    r = decode._from_arrow_array(pa.chunked_array([pa.array([[1.0, 2.0], []]),
+                                                   pa.array([[3.0]])]))
+    assert r.tolist() == [[1.0, 2.0], [], [3.0]]
+
+
+def test_root_file_layout():
+    n, dtypes = decode.root_file_layout('tests/sample_servicex_output.root')
+    assert n == 283458
+    assert dtypes == {b'JetPt': np.dtype('float64')}
+
+
+def test_read_root_file_into():
+    columns = {b'JetPt': np.zeros(283458 + 10)}
+    decode.read_root_file_into('tests/sample_servicex_output.root', columns, 10)
+    assert (columns[b'JetPt'][:10] == 0).all()
+    assert (columns[b'JetPt'][10:]
+            == decode.read_root_file('tests/sample_servicex_output.root', 'awkward')[b'JetPt']).all()
+
+
+def test_read_entry_range():
+    r = decode.read_file('tests/sample_servicex_output.root', 'pandas', entry_start=10,
+                         entry_stop=20)
+    assert len(r) == 10
+    full = decode.read_root_file('tests/sample_servicex_output.root', 'awkward')
+    assert (r.JetPt.values == full[b'JetPt'][10:20]).all()
+
+
+def test_root_file_schema():
+    assert decode.root_file_schema('tests/sample_servicex_output.root') \
+        == (283458, {'JetPt': 'float64'})
+
+
+def test_read_parquet_entry_range(tmp_path):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    path = str(tmp_path / 'sample.parquet')
+    pq.write_table(pa.table({'x': np.arange(100), 'y': pa.array([[1.0]] * 100)}), path,
+                   row_group_size=30)
+    assert decode.parquet_file_schema(path) == (100, {'x': 'int64', 'y': '[0, inf) -> float64'})
+    r = decode.read_file(path, 'pandas', 'parquet', columns=['x'], entry_start=25,
+                         entry_stop=65)
+    assert list(r.x) == list(range(25, 65))
+    assert len(decode.read_file(path, 'pandas', 'parquet', entry_start=200)) == 0
@@ -0,0 +1,94 @@
+import pytest
+
+from servicex.instrumentation import Instrumentation, opentelemetry_hook, QueryStats
+
+
+def test_no_hooks():
+    i = Instrumentation()
+    with i.timed('download', object_name='f1') as info:
+        info['size'] = 10
+    i.emit('object-found', object_name='f1', elapsed=1.0)
+
+
+def test_timed_event():
+    events = []
+    i = Instrumentation([lambda e, info: events.append((e, info)), None])
+    with i.timed('download', object_name='f1') as info:
+        info['size'] = 10
+
+    assert len(events) == 1
+    event, info = events[0]
+    assert event == 'download'
+    assert info['object_name'] == 'f1'
+    assert info['size'] == 10
+    assert info['concurrent'] == 1
+    assert info['end'] >= info['start']
+    assert info['duration'] == info['end'] - info['start']
+
+
+def test_timed_event_on_error():
+    events = []
+    i = Instrumentation([lambda e, info: events.append(e)])
+    with pytest.raises(ValueError):
+        with i.timed('decode'):
+            raise ValueError('bad file')
+    assert events == ['decode']
+
+
+def test_concurrent_count():
+    events = []
+    i = Instrumentation([lambda e, info: events.append(info['concurrent'])])
+    with i.timed('download'):
+        with i.timed('download'):
+            pass
+        with i.timed('decode'):
+            pass
+    with i.timed('download'):
+        pass
+    assert events == [2, 1, 1, 1]
+
+
+def test_stats():
+    s = QueryStats()
+    s('download', {'object_name': 'f1', 'size': 100, 'start': 10.0, 'end': 11.0,
+                   'duration': 1.0, 'concurrent': 1})
+    s('download', {'object_name': 'f2', 'size': 300, 'start': 10.5, 'end': 12.0,
+                   'duration': 1.5, 'concurrent': 2})
+    s('decode', {'object_name': 'f1', 'start': 11.0, 'end': 11.25, 'duration': 0.25,
+                 'concurrent': 1})
+    s('object-found', {'object_name': 'f1', 'elapsed': 3.0})
+
+    assert s.phases == {'download': 2.5, 'decode': 0.25}
+    assert s.max_concurrent == {'download': 2, 'decode': 1}
+    assert s.files['f1'] == {'size': 100, 'download_time': 1.0, 'decode_time': 0.25,
+                             'found_after': 3.0}
+    assert s.bytes_downloaded == 400
+    assert s.download_rate == 200.0
+
+
+def test_stats_nothing_downloaded():
+    s = QueryStats()
+    assert s.bytes_downloaded == 0
+    assert s.download_rate is None
+
+
+def test_opentelemetry_spans():
+    sdk_trace = pytest.importorskip('opentelemetry.sdk.trace')
+    from opentelemetry.sdk.trace.export import SimpleSpanProcessor
+    from opentelemetry.sdk.trace.export.in_memory_span_exporter import InMemorySpanExporter
+
+    exporter = InMemorySpanExporter()
+    provider = sdk_trace.TracerProvider()
+    provider.add_span_processor(SimpleSpanProcessor(exporter))
+    hook = opentelemetry_hook(provider.get_tracer('test'))
+
+    hook('download', {'object_name': 'f1', 'size': 100, 'start': 10.0, 'end': 11.5,
+                      'duration': 1.5, 'files_remaining': None})
+    hook('object-found', {'object_name': 'f1', 'elapsed': 3.0})
+
+    spans = exporter.get_finished_spans()
+    assert len(spans) == 1
+    assert spans[0].name == 'servicex.download'
+    assert spans[0].start_time == 10 * 10**9
+    assert spans[0].end_time == 11.5 * 10**9
+    assert dict(spans[0].attributes) == {'object_name': 'f1', 'size': 100}
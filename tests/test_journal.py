@@ -0,0 +1,171 @@
+import asyncio
+import os
+import shutil
+
+import pytest
+
+from servicex.journal import journal_key, JournaledDownloader, QueryJournal
+from servicex.minio_adaptor import ObjectStoreDownloader
+
+
+def test_key_stable():
+    k1 = journal_key('http://localhost:5000', {'did': 'ds1', 'selection': 'q'})
+    k2 = journal_key('http://localhost:5000', {'selection': 'q', 'did': 'ds1'})
+    assert k1 == k2
+
+
+def test_key_endpoint():
+    k1 = journal_key('http://localhost:5000', {'did': 'ds1'})
+    k2 = journal_key('http://servicex:5000', {'did': 'ds1'})
+    assert k1 != k2
+
+
+def test_start(tmp_path):
+    j = QueryJournal(str(tmp_path), keep_files=True)
+    assert j.request_id('1234') is None
+    j.start('1234', 'req-1')
+    assert j.request_id('1234') == 'req-1'
+    assert j.objects('1234') == []
+
+
+def test_add_object_data(tmp_path):
+    j = QueryJournal(str(tmp_path), keep_files=True)
+    j.start('1234', 'req-1')
+    j.add_object('1234', 'file1', bytearray(b'hi there'))
+    assert j.objects('1234') == ['file1']
+    with open(j.object_path('1234', 'file1'), 'rb') as f_in:
+        assert f_in.read() == b'hi there'
+
+
+def test_add_object_file(tmp_path):
+    j = QueryJournal(str(tmp_path / 'journal'), keep_files=True)
+    j.start('1234', 'req-1')
+    local_path = str(tmp_path / 'file1.root')
+    shutil.copy('tests/sample_servicex_output.root', local_path)
+    j.add_object('1234', 'file1', local_path)
+    os.remove(local_path)
+    assert os.path.getsize(j.object_path('1234', 'file1')) \
+        == os.path.getsize('tests/sample_servicex_output.root')
+
+
+def test_add_object_no_copies(tmp_path):
+    j = QueryJournal(str(tmp_path))
+    j.start('1234', 'req-1')
+    j.add_object('1234', 'file1', bytearray(b'hi there'))
+    assert j.objects('1234') == []
+    assert not os.path.exists(j.object_path('1234', 'file1'))
+
+
+def test_add_object_not_started(tmp_path):
+    j = QueryJournal(str(tmp_path), keep_files=True)
+    j.add_object('1234', 'file1', bytearray(b'hi there'))
+    assert j.objects('1234') == []
+
+
+def test_start_again_forgets(tmp_path):
+    j = QueryJournal(str(tmp_path), keep_files=True)
+    j.start('1234', 'req-1')
+    j.add_object('1234', 'file1', bytearray(b'hi there'))
+    j.start('1234', 'req-2')
+    assert j.request_id('1234') == 'req-2'
+    assert j.objects('1234') == []
+
+
+def test_remove(tmp_path):
+    j = QueryJournal(str(tmp_path), keep_files=True)
+    j.start('1234', 'req-1')
+    j.add_object('1234', 'file1', bytearray(b'hi there'))
+    j.remove('1234')
+    assert j.request_id('1234') is None
+    assert not os.path.exists(j.object_path('1234', 'file1'))
+
+
+class counting_downloader(ObjectStoreDownloader):
+    def __init__(self):
+        self.count = 0
+
+    async def download_file(self, bucket, object_name, local_path):
+        self.count += 1
+        shutil.copy('tests/sample_servicex_output.root', local_path)
+
+
+@pytest.mark.asyncio
+async def test_downloader_records(tmp_path):
+    j = QueryJournal(str(tmp_path), keep_files=True)
+    j.start('1234', 'req-1')
+    inner = counting_downloader()
+    d = JournaledDownloader(inner, j, '1234')
+    path = await d.download_data('req-1', 'file1', 0)
+    os.remove(path)
+    assert j.objects('1234') == ['file1']
+    assert os.path.exists(j.object_path('1234', 'file1'))
+
+
+@pytest.mark.asyncio
+async def test_downloader_uses_journal(tmp_path):
+    j = QueryJournal(str(tmp_path), keep_files=True)
+    j.start('1234', 'req-1')
+    j.add_object('1234', 'file1', bytearray(b'hi there'))
+    inner = counting_downloader()
+    d = JournaledDownloader(inner, j, '1234')
+
+    data = await d.download_data('req-1', 'file1', 1024)
+    assert data == bytearray(b'hi there')
+
+    path = await d.download_data('req-1', 'file1', 0)
+    with open(path, 'rb') as f_in:
+        assert f_in.read() == b'hi there'
+    os.remove(path)
+    assert os.path.exists(j.object_path('1234', 'file1'))
+
+    assert inner.count == 0
+
+
+def test_old_entries_removed(tmp_path):
+    j = QueryJournal(str(tmp_path), max_age=3600)
+    j.start('1234', 'req-1')
+    request_path = os.path.join(str(tmp_path), '1234', 'request.json')
+    os.utime(request_path, (0, 0))
+    j.start('5678', 'req-2')
+    assert j.request_id('1234') is None
+    assert j.request_id('5678') == 'req-2'
+
+
+@pytest.mark.skipif(not hasattr(os, 'getuid'), reason='No file owners on this platform')
+def test_not_read_if_others_can_write(tmp_path):
+    j = QueryJournal(str(tmp_path / 'journal'), keep_files=True)
+    j.start('1234', 'req-1')
+    os.chmod(str(tmp_path / 'journal'), 0o777)
+    assert j.request_id('1234') is None
+    with pytest.raises(PermissionError):
+        j.start('1234', 'req-1')
+
+
+@pytest.mark.asyncio
+async def test_downloader_journal_not_writable(tmp_path, mocker):
+    'A journal that can not be written to does not fail the download'
+    j = QueryJournal(str(tmp_path), keep_files=True)
+    j.start('1234', 'req-1')
+    mocker.patch.object(j, 'add_object', side_effect=PermissionError('not yours'))
+    d = JournaledDownloader(counting_downloader(), j, '1234')
+    path = await d.download_data('req-1', 'file1', 0)
+    assert os.path.getsize(path) == os.path.getsize('tests/sample_servicex_output.root')
+    os.remove(path)
+    assert j.objects('1234') == []
+
+
+class memory_downloader(ObjectStoreDownloader):
+    'Hand back small in-memory files'
+    async def download_data(self, bucket, object_name, max_in_memory_size):
+        return bytearray(object_name.encode('utf-8'))
+
+
+@pytest.mark.asyncio
+async def test_downloader_concurrent_records(tmp_path):
+    'Objects added from many threads at once are all recorded'
+    j = QueryJournal(str(tmp_path), keep_files=True)
+    j.start('1234', 'req-1')
+    d = JournaledDownloader(memory_downloader(), j, '1234')
+    names = [f'file{i}' for i in range(50)]
+    await asyncio.gather(*[d.download_data('req-1', n, 1024) for n in names])
+    assert sorted(j.objects('1234')) == sorted(names)
@@ -0,0 +1,131 @@
+import io
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from benchmarks.fake_servicex import FakeServiceX, Scenario
+import servicex as fe
+from servicex.lazy import _open_remote
+
+
+@pytest.fixture(scope='module')
+def fake_servicex():
+    with FakeServiceX(Scenario('lazy', files=3, entries_per_file=200000, columns=2,
+                               transform_delay=0.05)) as fake:
+        yield fake
+
+
+@pytest.fixture()
+def lazy_result(fake_servicex):
+    adaptor = fe.ServiceXAdaptor(fake_servicex.servicex_endpoint,
+                                 minio_endpoint=fake_servicex.minio_endpoint)
+    yield fe.get_data_lazy('(valid qastle string)', 'lazy_ds', servicex_adaptor=adaptor)
+    adaptor.close()
+
+
+def test_status_and_files(lazy_result):
+    files_remaining, files_processed = lazy_result.status()
+    assert files_processed <= 3
+    files = lazy_result.files(wait=True)
+    assert len(files) == 3
+    assert files == sorted(files)
+    assert lazy_result.status() == (0, 3)
+
+
+def test_schema_reads_part_of_file(lazy_result, fake_servicex):
+    sent = fake_servicex.bytes_sent
+    assert lazy_result.schema() == {'EventNumber': 'int64', 'col0': 'float64',
+                                    'col1': 'float64'}
+    assert fake_servicex.bytes_sent - sent < fake_servicex.file_size
+
+
+def test_head(lazy_result, fake_servicex):
+    sent = fake_servicex.bytes_sent
+    r = lazy_result.head(4, columns=['EventNumber'])
+    assert isinstance(r, pd.DataFrame)
+    assert list(r.columns) == ['EventNumber']
+    assert list(r.EventNumber) == [0, 1, 2, 3]
+    assert fake_servicex.bytes_sent - sent < fake_servicex.file_size
+
+
+def test_head_across_files(lazy_result):
+    r = lazy_result.head(200002)
+    assert len(r) == 200002
+    assert list(r.EventNumber[-2:]) == [0, 1]
+
+
+def test_read_file_range(lazy_result):
+    name = lazy_result.files(wait=True)[1]
+    r = lazy_result.read_file(name, columns=['EventNumber'], entry_start=100, entry_stop=110,
+                              data_type='awkward')
+    assert list(r[b'EventNumber']) == list(range(100, 110))
+
+
+def test_to_pandas(lazy_result, fake_servicex, clean_query_cache):
+    submitted = fake_servicex.transforms_submitted
+    r = lazy_result.to_pandas(columns=['col0'])
+    assert r.shape == (600000, 1)
+    assert fake_servicex.transforms_submitted == submitted
+
+    # The second time it comes from the cache.
+    assert clean_query_cache.hits == 0
+    lazy_result.to_pandas(columns=['col0'])
+    assert clean_query_cache.hits == 1
+
+
+def test_to_awkward(lazy_result):
+    r = lazy_result.to_awkward()
+    assert set(r.keys()) == {b'EventNumber', b'col0', b'col1'}
+    assert len(r[b'col1']) == 600000
+
+
+def test_iter_files(lazy_result):
+    assert [len(f) for f in lazy_result.iter_files()] == [200000] * 3
+
+
+def test_no_files(fake_servicex, mocker):
+    mocker.patch.object(fake_servicex.scenario, 'files', 0)
+    adaptor = fe.ServiceXAdaptor(fake_servicex.servicex_endpoint,
+                                 minio_endpoint=fake_servicex.minio_endpoint)
+    r = fe.get_data_lazy('(valid qastle string)', 'empty_ds', servicex_adaptor=adaptor)
+    assert r.files(wait=True) == []
+    with pytest.raises(fe.ServiceX_Exception):
+        r.schema()
+    adaptor.close()
+
+
+def test_lazy_one_dataset_only():
+    with pytest.raises(fe.ServiceX_Exception):
+        fe.get_data_lazy('(valid qastle string)', ['ds1', 'ds2'])
+
+
+class _PartialResponse:
+    def __init__(self, data):
+        self._data = data
+
+    def read(self):
+        return self._data
+
+    def release_conn(self):
+        pass
+
+
+def test_remote_parquet(mocker):
+    pa = pytest.importorskip('pyarrow')
+    import pyarrow.parquet as pq
+    from servicex.decode import parquet_file_schema, read_parquet_file
+
+    buffer = io.BytesIO()
+    pq.write_table(pa.table({'x': np.arange(1000)}), buffer, row_group_size=100)
+    data = buffer.getvalue()
+
+    client = mocker.MagicMock()
+    client.get_partial_object.side_effect = \
+        lambda bucket, name, offset, length: _PartialResponse(data[offset:offset + length])
+
+    assert parquet_file_schema(_open_remote(client, 'b', 'f', len(data), 'parquet')) \
+        == (1000, {'x': 'int64'})
+    r = read_parquet_file(_open_remote(client, 'b', 'f', len(data), 'parquet'), 'pandas',
+                          entry_start=250, entry_stop=260)
+    assert list(r.x) == list(range(250, 260))
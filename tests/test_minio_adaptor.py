@@ -0,0 +1,361 @@
+import asyncio
+import hashlib
+import os
+from unittest import mock
+
+import aiohttp
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+from minio import Minio
+from minio.error import NoSuchBucket
+import pytest
+
+from servicex.minio_adaptor import (_SpillBuffer, AioHttpDownloader, new_minio_client,
+                                    ObjectDiscovery, ObjectStoreDownloader, ResilientDownloader)
+
+sample_file = 'tests/sample_servicex_output.root'
+
+
+async def start_object_server():
+    'A web server that serves the sample file for any object, and honors range requests'
+    requests = []
+
+    async def get_object(request):
+        requests.append(request.headers.get('Range'))
+        return web.FileResponse(sample_file)
+
+    app = web.Application()
+    app.router.add_get('/{bucket}/{name}', get_object)
+    server = TestServer(app)
+    await server.start_server()
+    return server, requests
+
+
+def minio_for(server) -> Minio:
+    return Minio(f'{server.host}:{server.port}', access_key='miniouser', secret_key='leftfoot1',
+                 secure=False, region='us-east-1')
+
+
+def test_minio_client_endpoint():
+    c = new_minio_client('http://servicex.org:5000/servicex')
+    assert c._endpoint_url == 'http://servicex.org:9000'
+
+
+@pytest.mark.asyncio
+async def test_aiohttp_download_one_part(tmp_path):
+    server, requests = await start_object_server()
+    async with server, aiohttp.ClientSession() as client:
+        d = AioHttpDownloader(minio_for(server), client)
+        local = str(tmp_path / 'out.root')
+        await d.download_file('1234', 'file1', local)
+
+    assert len(requests) == 1
+    with open(local, 'rb') as f_in, open(sample_file, 'rb') as f_orig:
+        assert f_in.read() == f_orig.read()
+
+
+@pytest.mark.asyncio
+async def test_aiohttp_download_many_parts(tmp_path):
+    server, requests = await start_object_server()
+    size = os.path.getsize(sample_file)
+    async with server, aiohttp.ClientSession() as client:
+        d = AioHttpDownloader(minio_for(server), client, max_concurrent=3,
+                              part_size=100 * 1024)
+        local = str(tmp_path / 'out.root')
+        await d.download_file('1234', 'file1', local)
+
+    assert len(requests) == (size + 100 * 1024 - 1) // (100 * 1024)
+    with open(local, 'rb') as f_in, open(sample_file, 'rb') as f_orig:
+        assert f_in.read() == f_orig.read()
+
+
+@pytest.mark.asyncio
+async def test_aiohttp_download_missing(tmp_path):
+    server, _ = await start_object_server()
+    async with server, aiohttp.ClientSession() as client:
+        d = AioHttpDownloader(minio_for(server), client)
+        with pytest.raises(BaseException) as e:
+            await d.download_file('1234', 'dir/file1', str(tmp_path / 'out.root'))
+        assert '404' in str(e.value)
+
+
+@pytest.mark.asyncio
+async def test_aiohttp_download_in_memory(tmp_path):
+    server, requests = await start_object_server()
+    async with server, aiohttp.ClientSession() as client:
+        d = AioHttpDownloader(minio_for(server), client, part_size=100 * 1024)
+        data = await d.download_data('1234', 'file1', 10 * 1024 * 1024)
+
+    assert isinstance(data, bytearray)
+    with open(sample_file, 'rb') as f_orig:
+        assert data == f_orig.read()
+
+
+@pytest.mark.asyncio
+async def test_aiohttp_download_in_memory_too_big(tmp_path):
+    server, requests = await start_object_server()
+    async with server, aiohttp.ClientSession() as client:
+        d = AioHttpDownloader(minio_for(server), client, part_size=100 * 1024)
+        path = await d.download_data('1234', 'file1', 1024)
+
+    assert isinstance(path, str)
+    try:
+        with open(path, 'rb') as f_in, open(sample_file, 'rb') as f_orig:
+            assert f_in.read() == f_orig.read()
+    finally:
+        os.remove(path)
+
+
+def test_spill_buffer_in_memory():
+    b = _SpillBuffer(10)
+    b.write(b'12345')
+    b.write(b'67890')
+    assert b.close() == bytearray(b'1234567890')
+
+
+def test_spill_buffer_to_disk():
+    b = _SpillBuffer(10)
+    b.write(b'12345')
+    b.write(b'678901')
+    path = b.close()
+    try:
+        with open(path, 'rb') as f_in:
+            assert f_in.read() == b'12345678901'
+    finally:
+        os.remove(path)
+
+
+def test_spill_buffer_discard():
+    b = _SpillBuffer(1)
+    b.write(b'12345')
+    path = b._path
+    b.discard()
+    assert not os.path.exists(path)
+
+
+def make_minio_file(fname):
+    r = mock.MagicMock()
+    r.object_name = fname
+    return r
+
+
+class fake_bucket:
+    'Mock list_objects_v2 for a bucket with the given objects'
+    def __init__(self, names):
+        self.names = names
+        self.calls = []
+
+    def __call__(self, bucket, start_after=''):
+        self.calls.append(start_after)
+        return [make_minio_file(n) for n in sorted(self.names) if n > start_after]
+
+
+def test_discovery_incremental():
+    client = mock.MagicMock()
+    client.list_objects_v2 = fake_bucket(['a', 'b'])
+    d = ObjectDiscovery(client, '1234')
+    assert d.new_objects(2) == ['a', 'b']
+
+    client.list_objects_v2.names += ['c']
+    assert d.new_objects(3) == ['c']
+    assert d.new_objects(3) == []
+    assert client.list_objects_v2.calls == ['', 'b', 'c']
+    assert d.count == 3
+
+
+def test_discovery_out_of_order():
+    'A new object that sorts before ones we have seen is found with a full listing'
+    client = mock.MagicMock()
+    client.list_objects_v2 = fake_bucket(['b', 'c'])
+    d = ObjectDiscovery(client, '1234')
+    assert d.new_objects(2) == ['b', 'c']
+
+    client.list_objects_v2.names += ['a']
+    assert d.new_objects(3) == ['a']
+    assert client.list_objects_v2.calls == ['', 'c', '']
+
+
+def test_discovery_no_full_listing_when_all_found():
+    client = mock.MagicMock()
+    client.list_objects_v2 = fake_bucket(['b', 'c'])
+    d = ObjectDiscovery(client, '1234')
+    d.new_objects(2)
+    d.new_objects(2)
+    assert client.list_objects_v2.calls == ['', 'c']
+
+
+def test_discovery_no_bucket_yet():
+    client = mock.MagicMock()
+    response = mock.MagicMock()
+    response.data = '<xml></xml>'
+    client.list_objects_v2 = mock.MagicMock(side_effect=NoSuchBucket(response))
+    d = ObjectDiscovery(client, '1234')
+    assert d.new_objects() == []
+
+
+def test_discovery_seen():
+    client = mock.MagicMock()
+    client.list_objects_v2 = fake_bucket(['a', 'b'])
+    d = ObjectDiscovery(client, '1234', seen=['a'])
+    assert d.new_objects(2) == ['b']
+
+
+def test_discovery_object_info():
+    client = mock.MagicMock()
+    o = make_minio_file('a')
+    o.size = 10
+    o.etag = '1234'
+    client.list_objects_v2 = mock.MagicMock(return_value=[o, make_minio_file('b')])
+    d = ObjectDiscovery(client, '1234')
+    d.new_objects()
+    assert d.object_info('a') == (10, '1234')
+    assert d.object_info('b') == (None, None)
+    assert d.object_info('c') == (None, None)
+
+
+with open(sample_file, 'rb') as f_sample:
+    sample_data = bytearray(f_sample.read())
+sample_info = (len(sample_data), hashlib.md5(sample_data).hexdigest())
+
+
+class flaky_downloader(ObjectStoreDownloader):
+    'Return the contents of the sample file, after failing, returning junk, or being slow'
+    def __init__(self, results, delays=None):
+        self.results = list(results)
+        self.delays = list(delays or [])
+        self.calls = 0
+
+    async def download_data(self, bucket, object_name, max_in_memory_size):
+        self.calls += 1
+        if len(self.delays) > 0:
+            await asyncio.sleep(self.delays.pop(0))
+        r = self.results.pop(0) if len(self.results) > 0 else 'good'
+        if r == 'fail':
+            raise BaseException('Download failed')
+        if r == 'short':
+            return sample_data[:100]
+        if r == 'corrupt':
+            return bytearray(len(sample_data))
+        return bytearray(sample_data)
+
+
+@pytest.mark.asyncio
+async def test_resilient_retries():
+    inner = flaky_downloader(['fail', 'fail'])
+    d = ResilientDownloader(inner, lambda _: sample_info, tries=3, retry_delay=0)
+    assert await d.download_data('1234', 'a', 0) == sample_data
+    assert inner.calls == 3
+
+
+@pytest.mark.asyncio
+async def test_resilient_gives_up():
+    inner = flaky_downloader(['fail', 'fail', 'fail'])
+    d = ResilientDownloader(inner, lambda _: sample_info, tries=3, retry_delay=0)
+    with pytest.raises(BaseException):
+        await d.download_data('1234', 'a', 0)
+    assert inner.calls == 3
+
+
+@pytest.mark.asyncio
+async def test_resilient_size_mismatch():
+    inner = flaky_downloader(['short'])
+    d = ResilientDownloader(inner, lambda _: sample_info, tries=2, retry_delay=0)
+    assert await d.download_data('1234', 'a', 0) == sample_data
+    assert inner.calls == 2
+
+
+@pytest.mark.asyncio
+async def test_resilient_size_not_known():
+    inner = flaky_downloader(['short'])
+    d = ResilientDownloader(inner, lambda _: (None, None), tries=2, retry_delay=0)
+    assert len(await d.download_data('1234', 'a', 0)) == 100
+
+
+@pytest.mark.asyncio
+async def test_resilient_etag():
+    inner = flaky_downloader(['corrupt'])
+    d = ResilientDownloader(inner, lambda _: sample_info, tries=2, retry_delay=0, verify='etag')
+    assert await d.download_data('1234', 'a', 0) == sample_data
+    assert inner.calls == 2
+
+
+@pytest.mark.asyncio
+async def test_resilient_etag_not_checked_by_default():
+    inner = flaky_downloader(['corrupt'])
+    d = ResilientDownloader(inner, lambda _: sample_info, tries=2, retry_delay=0)
+    await d.download_data('1234', 'a', 0)
+    assert inner.calls == 1
+
+
+@pytest.mark.asyncio
+async def test_resilient_multipart_etag():
+    inner = flaky_downloader(['corrupt'])
+    d = ResilientDownloader(inner, lambda _: (len(sample_data), '1234-2'), verify='etag')
+    await d.download_data('1234', 'a', 0)
+    assert inner.calls == 1
+
+
+@pytest.mark.asyncio
+async def test_resilient_etag_file(tmp_path):
+    path = str(tmp_path / 'a.root')
+    with open(path, 'wb') as f_out:
+        f_out.write(sample_data)
+
+    class file_downloader(ObjectStoreDownloader):
+        async def download_data(self, bucket, object_name, max_in_memory_size):
+            return path
+
+    d = ResilientDownloader(file_downloader(), lambda _: sample_info, verify='etag')
+    assert await d.download_data('1234', 'a', 0) == path
+
+
+@pytest.mark.asyncio
+async def test_resilient_bad_file_removed(tmp_path):
+    paths = []
+
+    class file_downloader(ObjectStoreDownloader):
+        async def download_data(self, bucket, object_name, max_in_memory_size):
+            path = str(tmp_path / f'a{len(paths)}.root')
+            with open(path, 'wb') as f_out:
+                f_out.write(sample_data[:100])
+            paths.append(path)
+            return path
+
+    d = ResilientDownloader(file_downloader(), lambda _: sample_info, tries=2, retry_delay=0)
+    with pytest.raises(BaseException):
+        await d.download_data('1234', 'a', 0)
+    assert len(paths) == 2
+    assert not any(os.path.exists(p) for p in paths)
+
+
+@pytest.mark.asyncio
+async def test_resilient_hedge():
+    'Once we know how long downloads take, a slow one is started again'
+    inner = flaky_downloader([], delays=[0.0] * 5 + [10.0, 0.0])
+    d = ResilientDownloader(inner, lambda _: sample_info, hedge_percentile=90)
+    for _ in range(5):
+        await d.download_data('1234', 'a', 0)
+
+    r = await asyncio.wait_for(d.download_data('1234', 'a', 0), 5.0)
+    assert r == sample_data
+    assert inner.calls == 7
+
+
+@pytest.mark.asyncio
+async def test_resilient_no_hedge_too_few_samples():
+    inner = flaky_downloader([], delays=[0.0, 0.2])
+    d = ResilientDownloader(inner, lambda _: sample_info, hedge_percentile=90)
+    await d.download_data('1234', 'a', 0)
+    await d.download_data('1234', 'a', 0)
+    assert inner.calls == 2
+
+
+@pytest.mark.asyncio
+async def test_resilient_hedge_first_fails():
+    'If the hedged copy fails, the original is still used'
+    inner = flaky_downloader(['good'] * 5 + ['good', 'fail'], delays=[0.0] * 5 + [0.2, 0.0])
+    d = ResilientDownloader(inner, lambda _: sample_info, tries=1, hedge_percentile=90)
+    for _ in range(5):
+        await d.download_data('1234', 'a', 0)
+    assert await d.download_data('1234', 'a', 0) == sample_data
+    assert inner.calls == 7
@@ -1,12 +1,16 @@
 import asyncio
 from json import dumps, loads
+import os
 import queue
 import re
 import shutil
+import threading
+import time
 from unittest import mock
 from unittest.mock import MagicMock
 
 from minio.error import ResponseError
+import numpy as np
 import pandas as pd
 import pytest
 
@@ -58,7 +62,7 @@ def files_back_1(mocker):
     # mocker.patch('minio.Minio', return_value=mock_minio)
     # mock_minio.list_objects = MagicMock(return_value=[make_minio_file('root:::dcache-atlas-xrootd-wan.desy.de:1094::pnfs:desy.de:atlas:dq2:atlaslocalgroupdisk:rucio:mc15_13TeV:8a:f1:DAOD_STDM3.05630052._000001.pool.root.198fbd841d0a28cb0d9dfa6340c890273-1.part.minio')])
     # mock_minio.fget_object = MagicMock(side_effect=good_copy)
-    mocker.patch('minio.api.Minio.list_objects', return_value=[make_minio_file('root:::dcache-atlas-xrootd-wan.desy.de:1094::pnfs:desy.de:atlas:dq2:atlaslocalgroupdisk:rucio:mc15_13TeV:8a:f1:DAOD_STDM3.05630052._000001.pool.root.198fbd841d0a28cb0d9dfa6340c890273-1.part.minio')])
+    mocker.patch('minio.api.Minio.list_objects_v2', return_value=[make_minio_file('root:::dcache-atlas-xrootd-wan.desy.de:1094::pnfs:desy.de:atlas:dq2:atlaslocalgroupdisk:rucio:mc15_13TeV:8a:f1:DAOD_STDM3.05630052._000001.pool.root.198fbd841d0a28cb0d9dfa6340c890273-1.part.minio')])
     mocker.patch('minio.api.Minio.fget_object', side_effect=good_copy)
     return None
 
@@ -68,14 +72,14 @@ def files_back_1_fail_initally(mocker):
     'Throw a response error - so the bucket doesn not get created right away'
     response = MagicMock()
     response.data = '<xml></xml>'
-    mocker.patch('minio.api.Minio.list_objects', side_effect=[ResponseError(response, 'POST', 'Dude'), [make_minio_file('root:::dcache-atlas-xrootd-wan.desy.de:1094::pnfs:desy.de:atlas:dq2:atlaslocalgroupdisk:rucio:mc15_13TeV:8a:f1:DAOD_STDM3.05630052._000001.pool.root.198fbd841d0a28cb0d9dfa6340c890273-1.part.minio')]])
+    mocker.patch('minio.api.Minio.list_objects_v2', side_effect=[ResponseError(response, 'POST', 'Dude'), [make_minio_file('root:::dcache-atlas-xrootd-wan.desy.de:1094::pnfs:desy.de:atlas:dq2:atlaslocalgroupdisk:rucio:mc15_13TeV:8a:f1:DAOD_STDM3.05630052._000001.pool.root.198fbd841d0a28cb0d9dfa6340c890273-1.part.minio')]])
     mocker.patch('minio.api.Minio.fget_object', side_effect=good_copy)
     return None
 
 
 @pytest.fixture()
 def files_back_2(mocker):
-    mocker.patch('minio.api.Minio.list_objects', return_value=[make_minio_file('root:::dcache-atlas-xrootd-wan.desy.de:1094::pnfs:desy.de:atlas:dq2:atlaslocalgroupdisk:rucio:mc15_13TeV:8a:f1:DAOD_STDM3.05630052._000001.pool.root.198fbd841d0a28cb0d9dfa6340c890273-1.part.minio'),
+    mocker.patch('minio.api.Minio.list_objects_v2', return_value=[make_minio_file('root:::dcache-atlas-xrootd-wan.desy.de:1094::pnfs:desy.de:atlas:dq2:atlaslocalgroupdisk:rucio:mc15_13TeV:8a:f1:DAOD_STDM3.05630052._000001.pool.root.198fbd841d0a28cb0d9dfa6340c890273-1.part.minio'),
                                                                make_minio_file('root:::dcache-atlas-xrootd-wan.desy.de:1094::pnfs:desy.de:atlas:dq2:atlaslocalgroupdisk:rucio:mc15_13TeV:8a:f1:DAOD_STDM3.05630052._000002.pool.root.198fbd841d0a28cb0d9dfa6340c890273-1.part.minio')])
     mocker.patch('minio.api.Minio.fget_object', side_effect=good_copy)
     return None
@@ -88,7 +92,7 @@ def files_back_2_one_at_a_time(mocker):
     f1 = make_minio_file('root:::dcache-atlas-xrootd-wan.desy.de:1094::pnfs:desy.de:atlas:dq2:atlaslocalgroupdisk:rucio:mc15_13TeV:8a:f1:DAOD_STDM3.05630052._000001.pool.root.198fbd841d0a28cb0d9dfa6340c890273-1.part.minio')
     f2 = make_minio_file('root:::dcache-atlas-xrootd-wan.desy.de:1094::pnfs:desy.de:atlas:dq2:atlaslocalgroupdisk:rucio:mc15_13TeV:8a:f1:DAOD_STDM3.05630052._000002.pool.root.198fbd841d0a28cb0d9dfa6340c890273-1.part.minio')
 
-    def return_files(req_id):
+    def return_files(req_id, **kwargs):
         if len(d) == 0:
             q.put("get-file-list 0")
             d['flag'] = True
@@ -101,7 +105,7 @@ def files_back_2_one_at_a_time(mocker):
         q.put(f'copy-a-file {c}')
         good_copy(a, b, c)
 
-    mocker.patch('minio.api.Minio.list_objects', side_effect=return_files)
+    mocker.patch('minio.api.Minio.list_objects_v2', side_effect=return_files)
     mocker.patch('minio.api.Minio.fget_object', side_effect=copy_files)
     return q
 
@@ -122,7 +126,7 @@ class list_objects_callable(mock.MagicMock):
 @pytest.fixture()
 def indexed_files_back(mocker):
     'Use the request id formatting to figure out how many files to deliver back'
-    mocker.patch('minio.api.Minio.list_objects', new_callable=list_objects_callable)
+    mocker.patch('minio.api.Minio.list_objects_v2', new_callable=list_objects_callable)
     mocker.patch('minio.api.Minio.fget_object', side_effect=good_copy)
 
 
@@ -283,10 +287,12 @@ def test_good_run_single_ds_1file_noasync(good_transform_request, reduce_wait_ti
 
 def test_good_run_single_ds_1file_noasync_with_loop(good_transform_request, reduce_wait_time, files_back_1):
     'Async loop has been created for other reasons, and the non-async version still needs to work.'
-    _ = asyncio.get_event_loop()
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
     r = fe.get_data('(valid qastle string)', 'one_ds')
     assert isinstance(r, pd.DataFrame)
     assert len(r) == 283458
+    loop.close()
 
 
 def test_run_with_running_event_loop(good_transform_request, reduce_wait_time, files_back_1):
@@ -294,8 +300,42 @@ def test_run_with_running_event_loop(good_transform_request, reduce_wait_time, f
         r = fe.get_data('(valid qastle string)', 'one_ds')
         assert isinstance(r, pd.DataFrame)
         assert len(r) == 283458
-    loop = asyncio.get_event_loop()
+    loop = asyncio.new_event_loop()
     loop.run_until_complete(doit())
+    loop.close()
+
+
+def test_get_data_from_threads(good_transform_request, reduce_wait_time, files_back_1):
+    'Many threads can run queries at once, on the one background event loop'
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        results = list(pool.map(lambda i: fe.get_data('(valid qastle string)', f'ds_{i}', use_cache=False),
+                                range(8)))
+    assert all(len(r) == 283458 for r in results)
+
+
+def test_get_data_from_event_hook(good_transform_request, reduce_wait_time, files_back_1):
+    'The sync API can not be used from code the library runs on its event loop'
+    errors = []
+
+    def hook(event, info):
+        if event == 'submit':
+            try:
+                fe.get_data('(valid qastle string)', 'other_ds')
+            except fe.ServiceX_Exception as e:
+                errors.append(e)
+
+    fe.get_data('(valid qastle string)', 'one_ds', event_hook=hook)
+    assert len(errors) == 1
+
+
+def test_get_data_stream_from_threads(good_transform_request, reduce_wait_time, files_back_2):
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        counts = list(pool.map(lambda i: len(list(fe.get_data_stream('(valid qastle string)', f'ds_{i}',
+                                                                     use_cache=False))),
+                               range(4)))
+    assert counts == [2, 2, 2, 2]
 
 
 @pytest.mark.asyncio
@@ -312,6 +352,17 @@ async def test_run_with_four_queries(good_requests_indexed, reduce_wait_time, in
         assert len(r) == 283458*(cnt+1)
 
 
+@pytest.mark.asyncio
+async def test_many_queries_share_status_tracker(good_requests_indexed, reduce_wait_time, indexed_files_back, mocker):
+    'Status polls for transforms running at once go through one tracker, which goes away after'
+    trackers = mocker.spy(fe.servicex, 'StatusTracker')
+    all_wait = await asyncio.gather(*[fe.get_data_async('(valid qastle string)', f'ds_{i}_1', use_cache=False)
+                                      for i in range(10)])
+    assert len(all_wait) == 10
+    assert trackers.call_count == 1
+    assert fe.servicex._status_trackers == {}
+
+
 @pytest.mark.asyncio
 async def test_run_with_onehundred_queries(good_requests_indexed, reduce_wait_time, indexed_files_back):
     'Try to run four transform requests at same time. Make sure each retursn what we expect.'
@@ -337,9 +388,11 @@ async def test_files_downloaded_ready_in_sequence(good_transform_request_delayed
 
 
 @pytest.mark.asyncio
-async def test_files_downloading_is_interleaved(good_transform_request_delayed_finish, reduce_wait_time, files_back_2_one_at_a_time):
+async def test_files_downloading_is_interleaved(good_transform_request_delayed_finish, files_back_2_one_at_a_time, mocker):
     'Make sure files start the download before the transform is done'
-    #  fe.servicex.servicex_status_poll_time = 1.0
+    # Leave the download thread time to get going before the next status poll.
+    mocker.patch('servicex.servicex.servicex_status_poll_min_time', 0.2)
+    mocker.patch('servicex.servicex.servicex_status_poll_time', 0.2)
 
     r1 = fe.get_data_async('(valid qastle string)', 'ds_0_2')
     await r1
@@ -356,6 +409,1261 @@ async def test_files_downloading_is_interleaved(good_transform_request_delayed_f
     assert ordering[0] == 'get-file-list 0'
     assert ordering[1].startswith('copy-a-file')
 
+
+@pytest.mark.asyncio
+async def test_cache_hit_no_network(good_transform_request, reduce_wait_time, files_back_1):
+    'Second identical query should come back from the cache without talking to ServiceX'
+    import aiohttp
+    r1 = await fe.get_data_async('(valid qastle string)', 'one_ds')
+    r2 = await fe.get_data_async('(valid qastle string)', 'one_ds')
+    assert aiohttp.ClientSession.post.call_count == 1
+    assert len(r2) == len(r1)
+    assert fe.servicex.query_cache.hits == 1
+
+
+@pytest.mark.asyncio
+async def test_cache_ignored(good_transform_request, reduce_wait_time, files_back_1):
+    import aiohttp
+    await fe.get_data_async('(valid qastle string)', 'one_ds', use_cache=False)
+    await fe.get_data_async('(valid qastle string)', 'one_ds', use_cache=False)
+    assert aiohttp.ClientSession.post.call_count == 2
+
+
+@pytest.mark.asyncio
+async def test_cache_different_data_type(good_transform_request, reduce_wait_time, files_back_1):
+    import aiohttp
+    await fe.get_data_async('(valid qastle string)', 'one_ds')
+    r = await fe.get_data_async('(valid qastle string)', 'one_ds', data_type='awkward')
+    assert isinstance(r, dict)
+    assert aiohttp.ClientSession.post.call_count == 2
+
+
+@pytest.mark.asyncio
+async def test_cache_invalidate(good_transform_request, reduce_wait_time, files_back_1):
+    import aiohttp
+    await fe.get_data_async('(valid qastle string)', 'one_ds')
+    fe.invalidate_cache('(valid qastle string)', 'one_ds')
+    await fe.get_data_async('(valid qastle string)', 'one_ds')
+    assert aiohttp.ClientSession.post.call_count == 2
+
+
+@pytest.mark.asyncio
+async def test_stream_two_files(good_transform_request, reduce_wait_time, files_back_2):
+    'Each file comes back as its own chunk'
+    chunks = [c async for c in fe.get_data_stream_async('(valid qastle string)', 'one_ds')]
+    assert len(chunks) == 2
+    for c in chunks:
+        assert isinstance(c, pd.DataFrame)
+        assert len(c) == 283458
+
+
+@pytest.mark.asyncio
+async def test_stream_awkward(good_transform_request, reduce_wait_time, files_back_2):
+    chunks = [c async for c in fe.get_data_stream_async('(valid qastle string)', 'one_ds', data_type='awkward')]
+    assert len(chunks) == 2
+    assert all(len(c[b'JetPt']) == 283458 for c in chunks)
+
+
+@pytest.mark.asyncio
+async def test_stream_in_flight_window(good_transform_request, reduce_wait_time, indexed_files_back, mocker):
+    'With a window of one, never more than one download should be running'
+    mocker.patch('aiohttp.ClientSession.post', return_value=ClientSessionMocker(dumps({"request_id": "3"}), 200))
+    started = mocker.spy(fe.servicex, '_start_download')
+    count = 0
+    async for c in fe.get_data_stream_async('(valid qastle string)', 'one_ds', max_in_flight=1):
+        count += 1
+        assert started.call_count == count
+    assert count == 3
+
+
+@pytest.mark.asyncio
+async def test_stream_from_cache(good_transform_request, reduce_wait_time, files_back_2):
+    await fe.get_data_async('(valid qastle string)', 'one_ds')
+    chunks = [c async for c in fe.get_data_stream_async('(valid qastle string)', 'one_ds')]
+    assert len(chunks) == 1
+    assert len(chunks[0]) == 283458*2
+
+
+def test_stream_noasync(good_transform_request, reduce_wait_time, files_back_2):
+    chunks = list(fe.get_data_stream('(valid qastle string)', 'one_ds'))
+    assert len(chunks) == 2
+    assert all(len(c) == 283458 for c in chunks)
+
+
+def test_stream_noasync_abandoned(good_transform_request, reduce_wait_time, files_back_2):
+    'Stop after the first chunk - nothing should be left behind'
+    s = fe.get_data_stream('(valid qastle string)', 'one_ds')
+    first = next(s)
+    s.close()
+    assert len(first) == 283458
+
+
+@pytest.mark.asyncio
+async def test_custom_downloader(good_transform_request, reduce_wait_time, files_back_1, mocker):
+    'A user supplied downloader is used instead of minio'
+    class my_downloader(fe.servicex.ObjectStoreDownloader):
+        def __init__(self):
+            self.objects = []
+
+        async def download_file(self, bucket, object_name, local_path):
+            self.objects.append((bucket, object_name))
+            shutil.copy('tests/sample_servicex_output.root', local_path)
+
+    d = my_downloader()
+    mocker.patch('servicex.servicex.servicex_download_method', d)
+    r = await fe.get_data_async('(valid qastle string)', 'one_ds')
+    assert len(r) == 283458
+    assert len(d.objects) == 1
+    assert d.objects[0][0] == '1234-4433-111-34-22-444'
+
+
+@pytest.mark.asyncio
+async def test_unknown_downloader(good_transform_request, reduce_wait_time, files_back_1, mocker):
+    mocker.patch('servicex.servicex.servicex_download_method', 'carrier-pigeon')
+    with pytest.raises(fe.ServiceX_Exception):
+        await fe.get_data_async('(valid qastle string)', 'one_ds')
+
+
+@pytest.mark.asyncio
+async def test_multiple_datasets(good_requests_indexed, reduce_wait_time, indexed_files_back):
+    'A list of datasets comes back as a dictionary'
+    r = await fe.get_data_async('(valid qastle string)', ['ds_0_1', 'ds_1_2', 'ds_2_3'])
+    assert isinstance(r, dict)
+    assert set(r.keys()) == {'ds_0_1', 'ds_1_2', 'ds_2_3'}
+    for ds, n in [('ds_0_1', 1), ('ds_1_2', 2), ('ds_2_3', 3)]:
+        assert isinstance(r[ds], pd.DataFrame)
+        assert len(r[ds]) == 283458*n
+
+
+@pytest.mark.asyncio
+async def test_multiple_datasets_list_of_one(good_requests_indexed, reduce_wait_time, indexed_files_back):
+    r = await fe.get_data_async('(valid qastle string)', ['ds_0_1'])
+    assert isinstance(r, dict)
+    assert len(r['ds_0_1']) == 283458
+
+
+@pytest.mark.asyncio
+async def test_multiple_datasets_combined(good_requests_indexed, reduce_wait_time, indexed_files_back):
+    r = await fe.get_data_async('(valid qastle string)', ['ds_0_1', 'ds_1_2'], combine_datasets=True)
+    assert isinstance(r, pd.DataFrame)
+    assert len(r) == 283458*3
+    assert list(r.columns) == ['JetPt', 'dataset']
+    assert (r.dataset == 'ds_0_1').sum() == 283458
+    assert (r.dataset == 'ds_1_2').sum() == 283458*2
+
+
+@pytest.mark.asyncio
+async def test_multiple_datasets_combined_awkward(good_requests_indexed, reduce_wait_time, indexed_files_back):
+    r = await fe.get_data_async('(valid qastle string)', ['ds_0_1', 'ds_1_2'], data_type='awkward', combine_datasets=True)
+    assert isinstance(r, dict)
+    assert len(r[b'JetPt']) == 283458*3
+    assert len(r[b'dataset']) == 283458*3
+    assert r[b'dataset'][0] == 'ds_0_1'
+    assert r[b'dataset'][-1] == 'ds_1_2'
+
+
+@pytest.mark.asyncio
+async def test_multiple_datasets_some_cached(good_requests_indexed, reduce_wait_time, indexed_files_back):
+    'Only the datasets not already in the cache should be sent to ServiceX'
+    import aiohttp
+    await fe.get_data_async('(valid qastle string)', 'ds_0_1')
+    r = await fe.get_data_async('(valid qastle string)', ['ds_0_1', 'ds_1_2'])
+    assert aiohttp.ClientSession.post.call_count == 2
+    assert len(r['ds_1_2']) == 283458*2
+
+
+def test_multiple_datasets_noasync(good_requests_indexed, reduce_wait_time, indexed_files_back):
+    r = fe.get_data('(valid qastle string)', ['ds_0_1', 'ds_1_2'], combine_datasets=True)
+    assert len(r) == 283458*3
+
+
+@pytest.mark.asyncio
+async def test_no_datasets(good_requests_indexed, reduce_wait_time, indexed_files_back):
+    with pytest.raises(fe.ServiceX_Exception):
+        await fe.get_data_async('(valid qastle string)', [])
+
+
+@pytest.mark.asyncio
+async def test_stream_multiple_datasets(good_requests_indexed, reduce_wait_time, indexed_files_back):
+    with pytest.raises(fe.ServiceX_Exception):
+        async for _ in fe.get_data_stream_async('(valid qastle string)', ['ds_0_1', 'ds_1_2']):
+            pass
+
+
+class minio_object_response:
+    'Mock the response from minio get_object by streaming our test file'
+    def __init__(self):
+        self.released = False
+
+    def stream(self, amt):
+        with open('tests/sample_servicex_output.root', 'rb') as f_in:
+            while True:
+                data = f_in.read(amt)
+                if len(data) == 0:
+                    return
+                yield data
+
+    def release_conn(self):
+        self.released = True
+
+
+@pytest.mark.asyncio
+async def test_temp_files_removed(good_transform_request, reduce_wait_time, files_back_2, mocker):
+    'Files written to disk must be cleaned up after they are loaded'
+    paths = []
+
+    def copy_and_record(a, b, c):
+        paths.append(c)
+        good_copy(a, b, c)
+
+    mocker.patch('minio.api.Minio.fget_object', side_effect=copy_and_record)
+    r = await fe.get_data_async('(valid qastle string)', 'one_ds')
+    assert len(r) == 283458*2
+    assert len(paths) == 2
+    assert paths[0] != paths[1]
+    for p in paths:
+        assert not os.path.exists(p)
+
+
+@pytest.mark.asyncio
+async def test_in_memory_download(good_transform_request, reduce_wait_time, files_back_2, mocker):
+    mocker.patch('servicex.servicex.servicex_in_memory_max_size', 10*1024*1024)
+    response = minio_object_response()
+    mocker.patch('minio.api.Minio.get_object', return_value=response)
+    r = await fe.get_data_async('(valid qastle string)', 'one_ds')
+    assert len(r) == 283458*2
+    assert response.released
+    import minio
+    assert minio.api.Minio.fget_object.call_count == 0
+
+
+@pytest.mark.asyncio
+async def test_in_memory_download_too_big(good_transform_request, reduce_wait_time, files_back_1, mocker):
+    'A file that is too large is spilled to a temp file, which is removed when done'
+    mocker.patch('servicex.servicex.servicex_in_memory_max_size', 10*1024)
+    mocker.patch('minio.api.Minio.get_object', return_value=minio_object_response())
+    spill = mocker.spy(fe.minio_adaptor._SpillBuffer, 'close')
+    r = await fe.get_data_async('(valid qastle string)', 'one_ds')
+    assert len(r) == 283458
+    assert isinstance(spill.spy_return, str)
+    assert not os.path.exists(spill.spy_return)
+
+
+@pytest.mark.asyncio
+async def test_in_memory_download_awkward(good_transform_request, reduce_wait_time, files_back_1, mocker):
+    mocker.patch('servicex.servicex.servicex_in_memory_max_size', 10*1024*1024)
+    mocker.patch('minio.api.Minio.get_object', return_value=minio_object_response())
+    r = await fe.get_data_async('(valid qastle string)', 'one_ds', data_type='awkward')
+    assert len(r[b'JetPt']) == 283458
+
+
+@pytest.mark.asyncio
+async def test_adaptive_poll_delays(good_transform_request_delayed_finish, files_back_2_one_at_a_time, mocker):
+    'First poll is quick, and is not slowed down when files are processed'
+    mocker.patch('servicex.servicex.servicex_status_poll_min_time', 0.01)
+    mocker.patch('servicex.servicex.servicex_status_poll_time', 100.0)
+    poll = mocker.spy(fe.servicex, '_tracked_status')
+    r = await fe.get_data_async('(valid qastle string)', 'ds_0_2')
+    assert len(r) == 283458*2
+    delays = [c[0][3] for c in poll.call_args_list]
+    assert delays == [0.01, 0.01]
+
+
+@pytest.mark.asyncio
+async def test_status_channel(good_transform_request_delayed_finish, reduce_wait_time, files_back_2_one_at_a_time, mocker):
+    'A status channel that pushes updates is used instead of the http status call'
+    class my_channel(fe.TransformStatusChannel):
+        def __init__(self):
+            self.updates = [(1, 1), (0, 2)]
+
+        async def wait_for_status(self, endpoint, request_id, timeout):
+            return self.updates.pop(0)
+
+    mocker.patch('servicex.servicex.servicex_status_channel', my_channel())
+    r = await fe.get_data_async('(valid qastle string)', 'ds_0_2')
+    assert len(r) == 283458*2
+    import aiohttp
+    assert aiohttp.ClientSession.get.call_count == 0
+
+
+@pytest.mark.asyncio
+async def test_status_channel_falls_back(good_transform_request_delayed_finish, reduce_wait_time, files_back_2_one_at_a_time, mocker):
+    'If the channel has nothing, we poll over http'
+    class my_channel(fe.TransformStatusChannel):
+        async def wait_for_status(self, endpoint, request_id, timeout):
+            return None
+
+    mocker.patch('servicex.servicex.servicex_status_channel', my_channel())
+    r = await fe.get_data_async('(valid qastle string)', 'ds_0_2')
+    assert len(r) == 283458*2
+    import aiohttp
+    assert aiohttp.ClientSession.get.call_count == 2
+
+
+@pytest.mark.asyncio
+async def test_download_before_status_counter(reduce_wait_time, mocker):
+    'Files are downloaded as soon as they show up, even if the status has not caught up'
+    q = queue.Queue()
+    mocker.patch('aiohttp.ClientSession.post', return_value=ClientSessionMocker(dumps({"request_id": "1234"}), 200))
+
+    statuses = [dumps({"files-remaining": "1", "files-processed": "0"}),
+                dumps({"files-remaining": "0", "files-processed": "1"})]
+
+    def get_status(*args, **kwargs):
+        q.put('status')
+        return ClientSessionMocker(statuses.pop(0), 200)
+    mocker.patch('aiohttp.ClientSession.get', side_effect=get_status)
+
+    def copy_files(a, b, c):
+        q.put('copy-a-file')
+        good_copy(a, b, c)
+    mocker.patch('minio.api.Minio.list_objects_v2', return_value=[make_minio_file('file1')])
+    mocker.patch('minio.api.Minio.fget_object', side_effect=copy_files)
+    mocker.patch('servicex.servicex.servicex_status_poll_min_time', 0.5)
+    mocker.patch('servicex.servicex.servicex_status_poll_time', 0.5)
+
+    r = await fe.get_data_async('(valid qastle string)', 'one_ds')
+    assert len(r) == 283458
+    ordering = [q.get(False) for _ in range(q.qsize())]
+    assert ordering == ['status', 'copy-a-file', 'status']
+
+
+@pytest.mark.asyncio
+async def test_adaptor_shared_between_queries(good_transform_request, reduce_wait_time, files_back_1):
+    'All queries with the same adaptor go over the same session'
+    a = fe.ServiceXAdaptor('http://localhost:5000/servicex')
+    await fe.get_data_async('(valid qastle string)', 'one_ds', use_cache=False, servicex_adaptor=a)
+    await fe.get_data_async('(valid qastle string)', 'one_ds', use_cache=False, servicex_adaptor=a)
+    assert len(a._sessions) == 1
+    await a.close_async()
+
+
+@pytest.mark.asyncio
+async def test_adaptor_endpoint_used(good_transform_request, reduce_wait_time, files_back_1):
+    import aiohttp
+    a = fe.ServiceXAdaptor('http://servicex.org:5000/servicex')
+    await fe.get_data_async('(valid qastle string)', 'one_ds', servicex_adaptor=a)
+    assert aiohttp.ClientSession.post.call_args[0][0] == 'http://servicex.org:5000/servicex/transformation'
+    await a.close_async()
+
+
+def test_default_adaptor_shared():
+    assert fe.servicex._default_adaptor('http://localhost:5000/servicex') is fe.servicex._default_adaptor('http://localhost:5000/servicex')
+    assert fe.servicex._default_adaptor('http://localhost:5000/servicex') is not fe.servicex._default_adaptor('http://servicex.org:5000/servicex')
+
+
+@pytest.mark.asyncio
+async def test_decode_in_processes(good_transform_request, reduce_wait_time, files_back_2, mocker):
+    mocker.patch('servicex.servicex.servicex_decode_processes', 2)
+    r = await fe.get_data_async('(valid qastle string)', 'one_ds')
+    assert isinstance(r, pd.DataFrame)
+    assert len(r) == 283458*2
+
+
+@pytest.mark.asyncio
+async def test_decode_in_processes_awkward(good_transform_request, reduce_wait_time, files_back_1, mocker):
+    mocker.patch('servicex.servicex.servicex_decode_processes', 2)
+    r = await fe.get_data_async('(valid qastle string)', 'one_ds', data_type='awkward')
+    assert len(r[b'JetPt']) == 283458
+
+
+@pytest.mark.asyncio
+async def test_decode_in_processes_from_memory(good_transform_request, reduce_wait_time, files_back_1, mocker):
+    mocker.patch('servicex.servicex.servicex_decode_processes', 2)
+    mocker.patch('servicex.servicex.servicex_in_memory_max_size', 10*1024*1024)
+    mocker.patch('minio.api.Minio.get_object', return_value=minio_object_response())
+    r = await fe.get_data_async('(valid qastle string)', 'one_ds')
+    assert len(r) == 283458
+
+
+@pytest.fixture()
+def parquet_files_back_2(mocker, tmp_path):
+    'Deliver two parquet files with the same contents as the sample ROOT file'
+    import pyarrow.parquet as pq
+    from servicex.decode import read_root_file
+    parquet_path = str(tmp_path / 'sample.parquet')
+    pq.write_table(read_root_file('tests/sample_servicex_output.root', 'arrow'), parquet_path)
+
+    mocker.patch('minio.api.Minio.list_objects_v2', return_value=[make_minio_file('file_000001.parquet'),
+                                                               make_minio_file('file_000002.parquet')])
+    mocker.patch('minio.api.Minio.fget_object', side_effect=lambda a, b, c: shutil.copy(parquet_path, c))
+
+
+@pytest.mark.asyncio
+async def test_arrow_1file(good_transform_request, reduce_wait_time, files_back_1):
+    import pyarrow as pa
+    r = await fe.get_data_async('(valid qastle string)', 'one_ds', data_type='arrow')
+    assert isinstance(r, pa.Table)
+    assert r.num_rows == 283458
+    assert r.column_names == ['JetPt']
+
+
+@pytest.mark.asyncio
+async def test_arrow_2file_not_copied(good_transform_request, reduce_wait_time, files_back_2):
+    r = await fe.get_data_async('(valid qastle string)', 'one_ds', data_type='arrow')
+    assert r.num_rows == 283458*2
+    assert r.column('JetPt').num_chunks == 2
+    assert len(r.to_pandas()) == 283458*2
+
+
+@pytest.mark.asyncio
+async def test_arrow_combined_datasets(good_requests_indexed, reduce_wait_time, indexed_files_back):
+    r = await fe.get_data_async('(valid qastle string)', ['ds_1_1', 'ds_2_2'], data_type='arrow',
+                                combine_datasets=True)
+    assert r.num_rows == 283458*3
+    df = r.to_pandas()
+    assert list(df['dataset'].value_counts().sort_index()) == [283458, 283458*2]
+
+
+@pytest.mark.asyncio
+async def test_arrow_decode_in_processes(good_transform_request, reduce_wait_time, files_back_2, mocker):
+    mocker.patch('servicex.servicex.servicex_decode_processes', 2)
+    r = await fe.get_data_async('(valid qastle string)', 'one_ds', data_type='arrow')
+    assert r.num_rows == 283458*2
+
+
+@pytest.mark.asyncio
+async def test_arrow_not_installed(good_transform_request, reduce_wait_time, files_back_1, mocker):
+    mocker.patch('servicex.servicex.pa', None)
+    with pytest.raises(fe.ServiceX_Exception) as e:
+        await fe.get_data_async('(valid qastle string)', 'one_ds', data_type='arrow')
+    assert 'pyarrow' in str(e.value)
+
+
+@pytest.mark.asyncio
+async def test_parquet_requested(good_transform_request, reduce_wait_time, parquet_files_back_2):
+    r = await fe.get_data_async('(valid qastle string)', 'one_ds', result_format='parquet')
+    assert good_transform_request['result-format'] == 'parquet'
+    assert isinstance(r, pd.DataFrame)
+    assert len(r) == 283458*2
+
+
+@pytest.mark.asyncio
+async def test_parquet_arrow(good_transform_request, reduce_wait_time, parquet_files_back_2):
+    r = await fe.get_data_async('(valid qastle string)', 'one_ds', data_type='arrow',
+                                result_format='parquet')
+    assert r.num_rows == 283458*2
+
+
+@pytest.mark.asyncio
+async def test_parquet_awkward(good_transform_request, reduce_wait_time, parquet_files_back_2):
+    r = await fe.get_data_async('(valid qastle string)', 'one_ds', data_type='awkward',
+                                result_format='parquet')
+    assert len(r[b'JetPt']) == 283458*2
+
+
+@pytest.mark.asyncio
+async def test_parquet_cached_separately(good_transform_request, reduce_wait_time, files_back_1):
+    await fe.get_data_async('(valid qastle string)', 'one_ds')
+    assert fe.servicex.query_cache.lookup(fe.servicex.query_cache_key(
+        fe.servicex._build_json_query('(valid qastle string)', 'one_ds',
+                                      'sslhep/servicex_xaod_cpp_transformer:v0.2', 'parquet'),
+        'pandas')) is None
+
+
+@pytest.mark.asyncio
+async def test_unknown_result_format(good_transform_request, reduce_wait_time, files_back_1):
+    with pytest.raises(fe.ServiceX_Exception):
+        await fe.get_data_async('(valid qastle string)', 'one_ds', result_format='csv')
+
+
+@pytest.mark.asyncio
+async def test_preallocated_pandas(good_transform_request, reduce_wait_time, files_back_2, mocker):
+    expected = await fe.get_data_async('(valid qastle string)', 'one_ds', use_cache=False)
+    mocker.patch('servicex.servicex.servicex_preallocate_results', True)
+    fill = mocker.spy(fe.servicex, 'read_root_file_into')
+    r = await fe.get_data_async('(valid qastle string)', 'one_ds', use_cache=False)
+    assert fill.call_count == 2
+    pd.testing.assert_frame_equal(r, expected)
+
+
+@pytest.mark.asyncio
+async def test_preallocated_pandas_1file(good_transform_request, reduce_wait_time, files_back_1, mocker):
+    expected = await fe.get_data_async('(valid qastle string)', 'one_ds', use_cache=False)
+    mocker.patch('servicex.servicex.servicex_preallocate_results', True)
+    r = await fe.get_data_async('(valid qastle string)', 'one_ds', use_cache=False)
+    pd.testing.assert_frame_equal(r, expected)
+
+
+@pytest.mark.asyncio
+async def test_preallocated_awkward(good_transform_request, reduce_wait_time, files_back_2, mocker):
+    mocker.patch('servicex.servicex.servicex_preallocate_results', True)
+    r = await fe.get_data_async('(valid qastle string)', 'one_ds', data_type='awkward')
+    assert len(r[b'JetPt']) == 283458*2
+    assert (r[b'JetPt'][:283458] == r[b'JetPt'][283458:]).all()
+
+
+@pytest.mark.asyncio
+async def test_preallocated_temp_files_removed(good_transform_request, reduce_wait_time, files_back_2, mocker):
+    mocker.patch('servicex.servicex.servicex_preallocate_results', True)
+    paths = []
+
+    def copy_and_record(a, b, c):
+        paths.append(c)
+        good_copy(a, b, c)
+
+    mocker.patch('minio.api.Minio.fget_object', side_effect=copy_and_record)
+    await fe.get_data_async('(valid qastle string)', 'one_ds')
+    assert len(paths) == 2
+    for p in paths:
+        assert not os.path.exists(p)
+
+
+@pytest.mark.asyncio
+async def test_preallocated_in_memory(good_transform_request, reduce_wait_time, files_back_2, mocker):
+    mocker.patch('servicex.servicex.servicex_preallocate_results', True)
+    mocker.patch('servicex.servicex.servicex_in_memory_max_size', 10*1024*1024)
+    mocker.patch('minio.api.Minio.get_object', return_value=minio_object_response())
+    r = await fe.get_data_async('(valid qastle string)', 'one_ds')
+    assert len(r) == 283458*2
+
+
+@pytest.mark.asyncio
+async def test_preallocated_falls_back(good_transform_request, reduce_wait_time, files_back_2, mocker):
+    'If a file can not be read in place, the files are loaded and concatenated as usual'
+    mocker.patch('servicex.servicex.servicex_preallocate_results', True)
+    mocker.patch('servicex.servicex.root_file_layout', return_value=None)
+    fill = mocker.spy(fe.servicex, 'read_root_file_into')
+    r = await fe.get_data_async('(valid qastle string)', 'one_ds')
+    assert len(r) == 283458*2
+    assert fill.call_count == 0
+
+
+@pytest.mark.asyncio
+async def test_columns_selected(good_transform_request, reduce_wait_time, files_back_2):
+    r = await fe.get_data_async('(valid qastle string)', 'one_ds', columns=['JetPt'])
+    assert list(r.columns) == ['JetPt']
+    assert len(r) == 283458*2
+
+
+@pytest.mark.asyncio
+async def test_columns_missing(good_transform_request, reduce_wait_time, files_back_1):
+    with pytest.raises(BaseException) as e:
+        await fe.get_data_async('(valid qastle string)', 'one_ds', columns=['JetEta'])
+    assert 'JetEta' in str(e.value)
+
+
+@pytest.mark.asyncio
+async def test_columns_not_a_list(good_transform_request, reduce_wait_time, files_back_1):
+    with pytest.raises(fe.ServiceX_Exception):
+        await fe.get_data_async('(valid qastle string)', 'one_ds', columns='JetPt')
+
+
+@pytest.mark.asyncio
+async def test_dtypes_pandas(good_transform_request, reduce_wait_time, files_back_2):
+    r = await fe.get_data_async('(valid qastle string)', 'one_ds', dtypes={'JetPt': 'float32'})
+    assert r['JetPt'].dtype == np.float32
+    assert len(r) == 283458*2
+
+
+@pytest.mark.asyncio
+async def test_dtypes_awkward(good_transform_request, reduce_wait_time, files_back_1):
+    r = await fe.get_data_async('(valid qastle string)', 'one_ds', data_type='awkward',
+                                dtypes={'JetPt': np.float32})
+    assert r[b'JetPt'].dtype == np.float32
+
+
+@pytest.mark.asyncio
+async def test_dtypes_bad(good_transform_request, reduce_wait_time, files_back_1):
+    with pytest.raises(fe.ServiceX_Exception):
+        await fe.get_data_async('(valid qastle string)', 'one_ds', dtypes={'JetPt': 'float33'})
+
+
+@pytest.mark.asyncio
+async def test_dtypes_in_processes(good_transform_request, reduce_wait_time, files_back_1, mocker):
+    mocker.patch('servicex.servicex.servicex_decode_processes', 2)
+    r = await fe.get_data_async('(valid qastle string)', 'one_ds', columns=['JetPt'],
+                                dtypes={'JetPt': 'float32'})
+    assert r['JetPt'].dtype == np.float32
+
+
+@pytest.mark.asyncio
+async def test_dtypes_preallocated(good_transform_request, reduce_wait_time, files_back_2, mocker):
+    mocker.patch('servicex.servicex.servicex_preallocate_results', True)
+    fill = mocker.spy(fe.servicex, 'read_root_file_into')
+    r = await fe.get_data_async('(valid qastle string)', 'one_ds', dtypes={'JetPt': 'float32'})
+    assert fill.call_count == 2
+    assert r['JetPt'].dtype == np.float32
+    assert len(r) == 283458*2
+
+
+@pytest.mark.asyncio
+async def test_dtypes_parquet(good_transform_request, reduce_wait_time, parquet_files_back_2):
+    r = await fe.get_data_async('(valid qastle string)', 'one_ds', data_type='arrow',
+                                result_format='parquet', columns=['JetPt'],
+                                dtypes={'JetPt': 'float32'})
+    assert str(r.schema.field('JetPt').type) == 'float'
+
+
+@pytest.mark.asyncio
+async def test_columns_cached_separately(good_transform_request, reduce_wait_time, files_back_1):
+    await fe.get_data_async('(valid qastle string)', 'one_ds', dtypes={'JetPt': 'float32'})
+    r = await fe.get_data_async('(valid qastle string)', 'one_ds')
+    assert r['JetPt'].dtype == np.float64
+    assert fe.servicex.query_cache.hits == 0
+
+
+def make_crashed_journal(journal, json_query, request_id, object_names):
+    'Record a transform as a run that died part way through would have'
+    key = fe.servicex.journal_key('http://localhost:5000/servicex', json_query)
+    journal.start(key, request_id)
+    for name in object_names:
+        journal.add_object(key, name, 'tests/sample_servicex_output.root')
+    return key
+
+
+@pytest.mark.asyncio
+async def test_journal_removed_when_done(good_transform_request, reduce_wait_time, files_back_2, clean_query_journal):
+    await fe.get_data_async('(valid qastle string)', 'one_ds')
+    assert os.listdir(clean_query_journal.path) == []
+
+
+@pytest.mark.asyncio
+async def test_journal_kept_on_failure(good_transform_request, reduce_wait_time, files_back_2, clean_query_journal, mocker):
+    clean_query_journal.keep_files = True
+    key = fe.servicex.journal_key('http://localhost:5000/servicex',
+                                  fe.servicex._build_json_query('(valid qastle string)', 'one_ds',
+                                                                'sslhep/servicex_xaod_cpp_transformer:v0.2'))
+    calls = []
+
+    def copy_then_fail(a, b, c):
+        calls.append(b)
+        if len(calls) > 1:
+            # Fail once the first file is in the journal - failing sooner would cancel it.
+            for _ in range(500):
+                if len(clean_query_journal.objects(key)) > 0:
+                    break
+                time.sleep(0.01)
+            raise BaseException('lost connection')
+        good_copy(a, b, c)
+
+    mocker.patch('minio.api.Minio.fget_object', side_effect=copy_then_fail)
+    mocker.patch('servicex.servicex.servicex_download_retry_delay', 0)
+    with pytest.raises(BaseException):
+        await fe.get_data_async('(valid qastle string)', 'one_ds')
+
+    assert clean_query_journal.request_id(key) == '1234-4433-111-34-22-444'
+    assert clean_query_journal.objects(key) == calls[:1]
+
+
+@pytest.mark.asyncio
+async def test_journal_resumes(good_transform_request, reduce_wait_time, files_back_2, clean_query_journal):
+    'A rerun picks up the transform and only downloads the files it is missing'
+    clean_query_journal.keep_files = True
+    json_query = fe.servicex._build_json_query('(valid qastle string)', 'one_ds',
+                                               'sslhep/servicex_xaod_cpp_transformer:v0.2')
+    first_file = 'root:::dcache-atlas-xrootd-wan.desy.de:1094::pnfs:desy.de:atlas:dq2:atlaslocalgroupdisk:rucio:mc15_13TeV:8a:f1:DAOD_STDM3.05630052._000001.pool.root.198fbd841d0a28cb0d9dfa6340c890273-1.part.minio'
+    make_crashed_journal(clean_query_journal, json_query, 'old-request', [first_file])
+
+    r = await fe.get_data_async('(valid qastle string)', 'one_ds')
+    assert len(r) == 283458*2
+
+    import aiohttp
+    import minio
+    assert aiohttp.ClientSession.post.call_count == 0
+    assert minio.api.Minio.fget_object.call_count == 1
+    assert minio.api.Minio.fget_object.call_args[0][0] == 'old-request'
+    assert os.listdir(clean_query_journal.path) == []
+
+
+@pytest.mark.asyncio
+async def test_journal_resumes_without_files(good_transform_request, reduce_wait_time, files_back_2, clean_query_journal, mocker):
+    'By default no copies are kept - a rerun picks up the transform, and downloads everything'
+    add_object = mocker.spy(clean_query_journal, 'add_object')
+    json_query = fe.servicex._build_json_query('(valid qastle string)', 'one_ds',
+                                               'sslhep/servicex_xaod_cpp_transformer:v0.2')
+    make_crashed_journal(clean_query_journal, json_query, 'old-request', [])
+
+    r = await fe.get_data_async('(valid qastle string)', 'one_ds')
+    assert len(r) == 283458*2
+
+    import aiohttp
+    import minio
+    assert aiohttp.ClientSession.post.call_count == 0
+    assert minio.api.Minio.fget_object.call_count == 2
+    assert minio.api.Minio.fget_object.call_args[0][0] == 'old-request'
+    assert add_object.call_count == 0
+
+
+@pytest.mark.asyncio
+async def test_journal_unknown_request(good_transform_request, reduce_wait_time, files_back_1, clean_query_journal, mocker):
+    'If ServiceX has forgotten the transform, a new one is submitted'
+    json_query = fe.servicex._build_json_query('(valid qastle string)', 'one_ds',
+                                               'sslhep/servicex_xaod_cpp_transformer:v0.2')
+    make_crashed_journal(clean_query_journal, json_query, 'old-request', ['old-file'])
+
+    not_found = ClientSessionMocker(dumps({"message": "not found"}), 404)
+    status = ClientSessionMocker(dumps({"files-remaining": "0", "files-processed": "1"}), 200)
+    mocker.patch('aiohttp.ClientSession.get', side_effect=[not_found, status, status])
+
+    r = await fe.get_data_async('(valid qastle string)', 'one_ds')
+    assert len(r) == 283458
+
+    import aiohttp
+    assert aiohttp.ClientSession.post.call_count == 1
+
+
+@pytest.mark.asyncio
+async def test_journal_off(good_transform_request, reduce_wait_time, files_back_2, mocker):
+    mocker.patch('servicex.servicex.query_journal', None)
+    r = await fe.get_data_async('(valid qastle string)', 'one_ds')
+    assert len(r) == 283458*2
+
+
+@pytest.mark.asyncio
+async def test_download_retried(good_transform_request, reduce_wait_time, files_back_1, mocker):
+    calls = []
+
+    def fail_then_copy(a, b, c):
+        calls.append(c)
+        if len(calls) == 1:
+            raise BaseException('lost connection')
+        good_copy(a, b, c)
+
+    mocker.patch('minio.api.Minio.fget_object', side_effect=fail_then_copy)
+    mocker.patch('servicex.servicex.servicex_download_retry_delay', 0)
+    r = await fe.get_data_async('(valid qastle string)', 'one_ds')
+    assert len(r) == 283458
+    assert len(calls) == 2
+
+
+@pytest.mark.asyncio
+async def test_download_size_checked(good_transform_request, reduce_wait_time, mocker):
+    'A file that is not the size the object store listed is downloaded again'
+    f = make_minio_file('file1.root')
+    f.size = os.path.getsize('tests/sample_servicex_output.root')
+    mocker.patch('minio.api.Minio.list_objects_v2', return_value=[f])
+    calls = []
+
+    def truncated_then_copy(a, b, c):
+        calls.append(c)
+        good_copy(a, b, c)
+        if len(calls) == 1:
+            with open(c, 'r+b') as f_out:
+                f_out.truncate(100)
+
+    mocker.patch('minio.api.Minio.fget_object', side_effect=truncated_then_copy)
+    mocker.patch('servicex.servicex.servicex_download_retry_delay', 0)
+    r = await fe.get_data_async('(valid qastle string)', 'one_ds')
+    assert len(r) == 283458
+    assert len(calls) == 2
+
+
+@pytest.mark.asyncio
+async def test_query_stats(good_transform_request, reduce_wait_time, files_back_2):
+    stats = fe.QueryStats()
+    events = []
+    await fe.get_data_async('(valid qastle string)', 'one_ds', stats=stats,
+                            event_hook=lambda e, info: events.append(e))
+
+    assert sorted(set(events)) == ['concat', 'decode', 'download', 'listing', 'object-found',
+                                   'poll', 'query', 'queue-wait', 'submit']
+    assert len(stats.files) == 2
+    size = os.path.getsize('tests/sample_servicex_output.root')
+    assert all(f['size'] == size for f in stats.files.values())
+    assert all('decode_time' in f and 'found_after' in f for f in stats.files.values())
+    assert stats.bytes_downloaded == 2 * size
+    assert stats.phases['download'] > 0
+    assert stats.max_concurrent['download'] >= 1
+
+
+@pytest.mark.asyncio
+async def test_query_stats_preallocated(good_transform_request, reduce_wait_time, files_back_2,
+                                        mocker):
+    mocker.patch('servicex.servicex.servicex_preallocate_results', True)
+    stats = fe.QueryStats()
+    await fe.get_data_async('(valid qastle string)', 'one_ds', stats=stats)
+    assert len(stats.files) == 2
+    assert all('decode_time' in f for f in stats.files.values())
+
+
+@pytest.mark.asyncio
+async def test_query_stats_not_filled_from_cache(good_transform_request, reduce_wait_time,
+                                                 files_back_1):
+    await fe.get_data_async('(valid qastle string)', 'one_ds')
+    stats = fe.QueryStats()
+    await fe.get_data_async('(valid qastle string)', 'one_ds', stats=stats)
+    assert stats.phases == {}
+
+
+@pytest.mark.asyncio
+async def test_stream_event_hook(good_transform_request, reduce_wait_time, files_back_2):
+    events = []
+    async for _ in fe.get_data_stream_async('(valid qastle string)', 'one_ds',
+                                            event_hook=lambda e, info: events.append(e)):
+        pass
+    assert events.count('download') == 2
+    assert events.count('decode') == 2
+    assert 'concat' not in events
+
+
+@pytest.mark.asyncio
+async def test_concurrent_identical_queries_coalesced(good_transform_request, reduce_wait_time,
+                                                      files_back_1):
+    import aiohttp
+    import minio
+    r1, r2 = await asyncio.gather(fe.get_data_async('(valid qastle string)', 'one_ds'),
+                                  fe.get_data_async('(valid qastle string)', 'one_ds'))
+    assert r1 is r2
+    assert len(r1) == 283458
+    assert aiohttp.ClientSession.post.call_count == 1
+    assert minio.api.Minio.fget_object.call_count == 1
+    assert len(fe.servicex._running_queries) == 0
+
+
+@pytest.mark.asyncio
+async def test_different_queries_not_coalesced(good_transform_request, reduce_wait_time,
+                                               files_back_1):
+    import aiohttp
+    r1, r2 = await asyncio.gather(fe.get_data_async('(valid qastle string)', 'one_ds'),
+                                  fe.get_data_async('(valid qastle string)', 'two_ds'))
+    assert r1 is not r2
+    assert aiohttp.ClientSession.post.call_count == 2
+
+
+@pytest.mark.asyncio
+async def test_incremental_not_coalesced_with_full(good_transform_request, reduce_wait_time,
+                                                   files_back_1, clean_incremental_results):
+    'An incremental run fetches a different set of files, so it runs on its own'
+    r1, r2 = await asyncio.gather(fe.get_data_async('(valid qastle string)', 'one_ds'),
+                                  fe.get_data_async('(valid qastle string)', 'one_ds',
+                                                    incremental=True))
+    assert r1 is not r2
+    assert len(r1) == len(r2) == 283458
+    assert len(clean_incremental_results._entries()) == 2
+
+
+@pytest.mark.asyncio
+async def test_coalesced_query_saved_once(good_transform_request, reduce_wait_time, files_back_1,
+                                          clean_query_cache, mocker):
+    save = mocker.spy(clean_query_cache, 'save')
+    await asyncio.gather(fe.get_data_async('(valid qastle string)', 'one_ds', use_cache=False),
+                         fe.get_data_async('(valid qastle string)', 'one_ds'))
+    # Saved because the second caller wanted it cached, even though the first did not.
+    assert save.call_count == 1
+
+
+@pytest.mark.asyncio
+async def test_coalesced_query_failure_seen_by_all(bad_transform_request, reduce_wait_time):
+    r = await asyncio.gather(fe.get_data_async('(valid qastle string)', 'one_ds'),
+                             fe.get_data_async('(valid qastle string)', 'one_ds'),
+                             return_exceptions=True)
+    assert all(isinstance(e, fe.ServiceX_Exception) for e in r)
+    assert len(fe.servicex._running_queries) == 0
+
+
+@pytest.mark.asyncio
+async def test_coalesced_query_one_caller_cancelled(good_transform_request_delayed_finish,
+                                                    reduce_wait_time, files_back_1):
+    t1 = asyncio.ensure_future(fe.get_data_async('(valid qastle string)', 'one_ds'))
+    t2 = asyncio.ensure_future(fe.get_data_async('(valid qastle string)', 'one_ds'))
+    await asyncio.sleep(0.01)
+    t1.cancel()
+    r = await t2
+    assert len(r) == 283458
+    assert t1.cancelled()
+
+
+@pytest.mark.asyncio
+async def test_coalesced_query_all_callers_cancelled(good_transform_request_delayed_finish,
+                                                     reduce_wait_time, files_back_1):
+    t1 = asyncio.ensure_future(fe.get_data_async('(valid qastle string)', 'one_ds'))
+    await asyncio.sleep(0.01)
+    running = list(fe.servicex._running_queries.values())
+    assert len(running) == 1
+    t1.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await t1
+    await asyncio.sleep(0)
+    assert running[0].future.cancelled()
+    assert len(fe.servicex._running_queries) == 0
+
+
+@pytest.mark.asyncio
+async def test_stream_in_flight_bytes(good_transform_request, reduce_wait_time, indexed_files_back, mocker):
+    'With room for one and a half files in flight they should be downloaded one at a time'
+    mocker.patch('aiohttp.ClientSession.post', return_value=ClientSessionMocker(dumps({"request_id": "3"}), 200))
+    size = os.path.getsize('tests/sample_servicex_output.root')
+    mocker.patch('servicex.minio_adaptor.ObjectDiscovery.object_info', return_value=(size, None))
+    mocker.patch('servicex.servicex.servicex_max_in_flight_bytes', int(size * 1.5))
+    started = mocker.spy(fe.servicex, '_start_download')
+    count = 0
+    async for c in fe.get_data_stream_async('(valid qastle string)', 'one_ds'):
+        count += 1
+        assert started.call_count == count
+    assert count == 3
+
+
+@pytest.mark.asyncio
+async def test_in_flight_bytes_one_large_file(good_transform_request, reduce_wait_time, files_back_1, mocker):
+    'A file larger than the limit should still be downloaded'
+    size = os.path.getsize('tests/sample_servicex_output.root')
+    mocker.patch('servicex.minio_adaptor.ObjectDiscovery.object_info', return_value=(size, None))
+    mocker.patch('servicex.servicex.servicex_max_in_flight_bytes', 10)
+    r = await fe.get_data_async('(valid qastle string)', 'one_ds')
+    assert len(r) == 283458
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize('data_type', ['pandas', 'awkward', 'arrow'])
+async def test_spill_decoded(good_transform_request, reduce_wait_time, files_back_2, mocker, tmp_path, data_type):
+    'Past the decoded memory limit files are spilled, and put back together the same'
+    expected = await fe.get_data_async('(valid qastle string)', 'one_ds', data_type=data_type, use_cache=False)
+
+    mocker.patch('servicex.servicex.servicex_max_decoded_bytes', 1)
+    mocker.patch('servicex.servicex.servicex_spill_directory', str(tmp_path / 'spill'))
+    (tmp_path / 'spill').mkdir()
+    events = []
+    r = await fe.get_data_async('(valid qastle string)', 'one_ds', data_type=data_type, use_cache=False,
+                                event_hook=lambda e, info: events.append(e))
+
+    assert events.count('spill') == 2
+    if data_type == 'pandas':
+        pd.testing.assert_frame_equal(r, expected)
+    elif data_type == 'awkward':
+        assert r.keys() == expected.keys()
+        assert all((r[k] == expected[k]).all() for k in r)
+    else:
+        assert r.equals(expected)
+    assert list((tmp_path / 'spill').iterdir()) == []
+
+
+@pytest.mark.asyncio
+async def test_spill_decoded_not_needed(good_transform_request, reduce_wait_time, files_back_2, mocker, tmp_path):
+    mocker.patch('servicex.servicex.servicex_max_decoded_bytes', 1e12)
+    mocker.patch('servicex.servicex.servicex_spill_directory', str(tmp_path / 'spill'))
+    (tmp_path / 'spill').mkdir()
+    spill = mocker.spy(fe.servicex, 'spill')
+    r = await fe.get_data_async('(valid qastle string)', 'one_ds')
+    assert len(r) == 283458 * 2
+    spill.assert_not_called()
+
+
+@pytest.fixture()
+def shared_cache(mocker, tmp_path):
+    cache = fe.SharedFileCache(str(tmp_path / 'shared'))
+    mocker.patch('servicex.servicex.servicex_shared_cache', cache)
+    return cache
+
+
+@pytest.mark.asyncio
+async def test_shared_cache_files_reused(good_transform_request, reduce_wait_time, files_back_2, shared_cache):
+    'Once a query has finished, the same query does not go to ServiceX or download anything'
+    import aiohttp
+    import minio
+    r1 = await fe.get_data_async('(valid qastle string)', 'one_ds', use_cache=False)
+    r2 = await fe.get_data_async('(valid qastle string)', 'one_ds', use_cache=False)
+    pd.testing.assert_frame_equal(r1, r2)
+    assert aiohttp.ClientSession.post.call_count == 1
+    assert minio.api.Minio.fget_object.call_count == 2
+    assert shared_cache.hits == 2
+
+
+@pytest.mark.asyncio
+async def test_shared_cache_partial(good_transform_request, reduce_wait_time, files_back_2, shared_cache):
+    'If only some of the files are in the shared cache, only the missing ones are downloaded'
+    import minio
+    r1 = await fe.get_data_async('(valid qastle string)', 'one_ds', use_cache=False)
+    key = fe.servicex.query_cache_key(fe.servicex._build_json_query('(valid qastle string)', 'one_ds',
+                                                                   'sslhep/servicex_xaod_cpp_transformer:v0.2'),
+                                      'pandas')
+    first = shared_cache.objects(key)[0]
+    shutil.rmtree(shared_cache._entry_dir(key, first))
+
+    r2 = await fe.get_data_async('(valid qastle string)', 'one_ds', use_cache=False)
+    pd.testing.assert_frame_equal(r1, r2)
+    assert minio.api.Minio.fget_object.call_count == 3
+
+
+@pytest.mark.asyncio
+async def test_shared_cache_waits_for_lock(good_transform_request, reduce_wait_time, files_back_1, shared_cache, mocker):
+    'While another process holds the lock on a file, wait for it and use its copy'
+    import minio
+    mocker.patch('servicex.servicex._shared_cache_lock_poll', 0.01)
+    json_query = fe.servicex._build_json_query('(valid qastle string)', 'one_ds',
+                                               'sslhep/servicex_xaod_cpp_transformer:v0.2')
+    key = fe.servicex.query_cache_key(json_query, 'pandas')
+    fname = 'root:::dcache-atlas-xrootd-wan.desy.de:1094::pnfs:desy.de:atlas:dq2:atlaslocalgroupdisk:rucio:mc15_13TeV:8a:f1:DAOD_STDM3.05630052._000001.pool.root.198fbd841d0a28cb0d9dfa6340c890273-1.part.minio'
+    lock = shared_cache.try_lock(key, fname)
+
+    async def other_process():
+        await asyncio.sleep(0.1)
+        shared_cache.save(key, fname, pd.DataFrame({'JetPt': [1.0, 2.0]}))
+        lock.release()
+
+    other = asyncio.ensure_future(other_process())
+    r = await fe.get_data_async('(valid qastle string)', 'one_ds', use_cache=False)
+    await other
+    assert len(r) == 2
+    assert minio.api.Minio.fget_object.call_count == 0
+
+
+@pytest.mark.asyncio
+async def test_shared_cache_stream(good_transform_request, reduce_wait_time, files_back_2, shared_cache):
+    import aiohttp
+    await fe.get_data_async('(valid qastle string)', 'one_ds', use_cache=False)
+    chunks = [c async for c in fe.get_data_stream_async('(valid qastle string)', 'one_ds', use_cache=False)]
+    assert len(chunks) == 2
+    assert aiohttp.ClientSession.post.call_count == 1
+
+
+@pytest.mark.asyncio
+async def test_transform_size_default(good_transform_request, reduce_wait_time, files_back_1):
+    await fe.get_data_async('(valid qastle string)', 'one_ds')
+    assert good_transform_request['workers'] == 5
+    assert good_transform_request['chunk-size'] == 1000
+
+
+@pytest.mark.asyncio
+async def test_transform_size_explicit(good_transform_request, reduce_wait_time, files_back_1):
+    await fe.get_data_async('(valid qastle string)', 'one_ds', workers=17, chunk_size=5000)
+    assert good_transform_request['workers'] == 17
+    assert good_transform_request['chunk-size'] == 5000
+
+
+@pytest.mark.asyncio
+async def test_transform_size_not_in_cache_key(good_transform_request, reduce_wait_time, files_back_1):
+    'The same query run on a different number of workers gets the same result'
+    import aiohttp
+    await fe.get_data_async('(valid qastle string)', 'one_ds', workers=2)
+    await fe.get_data_async('(valid qastle string)', 'one_ds', workers=20)
+    assert aiohttp.ClientSession.post.call_count == 1
+
+
+@pytest.mark.asyncio
+async def test_transform_size_auto_hint(good_transform_request, reduce_wait_time, files_back_1, mocker):
+    mocker.patch('servicex.servicex.servicex_transform_sizing', 'auto')
+    await fe.get_data_async('(valid qastle string)', 'one_ds', size_hint=10 * 1024 ** 3)
+    assert good_transform_request['workers'] == 40
+
+
+@pytest.mark.asyncio
+async def test_transform_size_auto_history(good_transform_request, reduce_wait_time, files_back_2, mocker):
+    'The second time a query is run, the transform is sized from what it produced the first time'
+    mocker.patch('servicex.servicex.servicex_transform_sizing', 'auto')
+    size = os.path.getsize('tests/sample_servicex_output.root')
+    mocker.patch('servicex.minio_adaptor.ObjectDiscovery.object_info', return_value=(size, None))
+    new_downloader = mocker.spy(fe.servicex, '_new_downloader')
+
+    await fe.get_data_async('(valid qastle string)', 'one_ds', use_cache=False)
+    assert good_transform_request['workers'] == 5
+
+    await fe.get_data_async('(valid qastle string)', 'one_ds', use_cache=False)
+    assert good_transform_request['workers'] == 2
+    assert new_downloader.call_args[0][2] == 5
+
+
+@pytest.mark.asyncio
+async def test_transform_size_auto_explicit_wins(good_transform_request, reduce_wait_time, files_back_1, mocker):
+    mocker.patch('servicex.servicex.servicex_transform_sizing', 'auto')
+    await fe.get_data_async('(valid qastle string)', 'one_ds', size_hint=10 * 1024 ** 3, workers=3)
+    assert good_transform_request['workers'] == 3
+
+
+@pytest.mark.asyncio
+async def test_transform_size_bad_sizing(good_transform_request, reduce_wait_time, files_back_1, mocker):
+    mocker.patch('servicex.servicex.servicex_transform_sizing', 'guess')
+    with pytest.raises(fe.ServiceX_Exception):
+        await fe.get_data_async('(valid qastle string)', 'one_ds')
+
+
+@pytest.mark.asyncio
+async def test_incremental_fetches_only_new_files(good_transform_request, reduce_wait_time, mocker):
+    'A second incremental run only downloads the file that is new, and appends it'
+    listing = mocker.patch('minio.api.Minio.list_objects_v2', return_value=[make_minio_file('file1')])
+    copy = mocker.patch('minio.api.Minio.fget_object', side_effect=good_copy)
+
+    r = await fe.get_data_async('(valid qastle string)', 'one_ds', incremental=True)
+    assert len(r) == 283458
+    assert copy.call_count == 1
+
+    listing.return_value = [make_minio_file('file1'), make_minio_file('file2')]
+    r = await fe.get_data_async('(valid qastle string)', 'one_ds', incremental=True)
+    assert len(r) == 283458*2
+    assert copy.call_count == 2
+    assert [c[0][1] for c in copy.call_args_list] == ['file1', 'file2']
+
+
+@pytest.mark.asyncio
+async def test_incremental_drops_removed_files(good_transform_request, reduce_wait_time, mocker,
+                                               clean_incremental_results):
+    'A file that is no longer written is dropped from the result'
+    listing = mocker.patch('minio.api.Minio.list_objects_v2',
+                           return_value=[make_minio_file('file1'), make_minio_file('file2')])
+    copy = mocker.patch('minio.api.Minio.fget_object', side_effect=good_copy)
+
+    r = await fe.get_data_async('(valid qastle string)', 'one_ds', data_type='awkward',
+                                incremental=True)
+    assert len(r[b'JetPt']) == 283458*2
+
+    listing.return_value = [make_minio_file('file2')]
+    r = await fe.get_data_async('(valid qastle string)', 'one_ds', data_type='awkward',
+                                incremental=True)
+    assert len(r[b'JetPt']) == 283458
+    assert copy.call_count == 2
+
+    key = fe.servicex.query_cache_key(fe.servicex._build_json_query('(valid qastle string)', 'one_ds',
+                                                                    'sslhep/servicex_xaod_cpp_transformer:v0.2'),
+                                      'awkward')
+    assert clean_incremental_results.lookup(key) == ['file2']
+    assert len(clean_incremental_results._entries()) == 2
+
+
+@pytest.mark.asyncio
+async def test_incremental_goes_to_servicex(good_transform_request, reduce_wait_time, files_back_1,
+                                            clean_query_cache):
+    'An incremental run submits the transform even if the result is in the query cache'
+    await fe.get_data_async('(valid qastle string)', 'one_ds')
+    good_transform_request.clear()
+    r = await fe.get_data_async('(valid qastle string)', 'one_ds', incremental=True)
+    assert len(r) == 283458
+    assert good_transform_request['did'] == 'one_ds'
+
+
+@pytest.mark.asyncio
+async def test_incremental_invalidate(good_transform_request, reduce_wait_time, files_back_1,
+                                      clean_incremental_results):
+    'Invalidating the cache also forgets the incremental result'
+    await fe.get_data_async('(valid qastle string)', 'one_ds', incremental=True)
+    assert len(clean_incremental_results._entries()) == 2
+    fe.invalidate_cache('(valid qastle string)', 'one_ds')
+    assert len(clean_incremental_results._entries()) == 0
+
+
+@pytest.mark.asyncio
+async def test_cache_save_fails(good_transform_request, reduce_wait_time, files_back_1, mocker):
+    'A cache that can not be written to does not fail the query'
+    mocker.patch.object(fe.servicex.query_cache, 'save', side_effect=PermissionError('not yours'))
+    r = await fe.get_data_async('(valid qastle string)', 'one_ds')
+    assert len(r) == 283458
+
+
+@pytest.mark.asyncio
+async def test_incremental_save_fails(good_transform_request, reduce_wait_time, files_back_1, mocker,
+                                      clean_incremental_results):
+    'A store that can not be written to does not fail the query'
+    mocker.patch.object(clean_incremental_results, 'save', side_effect=PermissionError('not yours'))
+    r = await fe.get_data_async('(valid qastle string)', 'one_ds', incremental=True)
+    assert len(r) == 283458
+
+
+@pytest.mark.asyncio
+async def test_journal_start_fails(good_transform_request, reduce_wait_time, files_back_1, mocker,
+                                   clean_query_journal):
+    'A journal that can not be written to does not fail the query'
+    mocker.patch.object(clean_query_journal, 'start', side_effect=PermissionError('not yours'))
+    r = await fe.get_data_async('(valid qastle string)', 'one_ds')
+    assert len(r) == 283458
+
+
+def test_run_sync_refused_closes_coroutine():
+    'A coroutine that is refused is closed, rather than reported as never awaited'
+    async def nothing():
+        return 1
+
+    async def run_from_loop():
+        c = nothing()
+        with pytest.raises(fe.ServiceX_Exception):
+            fe.servicex._run_sync(c)
+        return c.cr_frame is None
+
+    assert fe.servicex._run_sync(run_from_loop())
+
+
+def test_default_adaptors_closed_at_exit(good_transform_request, reduce_wait_time, files_back_1):
+    fe.get_data('(valid qastle string)', 'one_ds', servicex_endpoint='http://closing:5000/servicex')
+    a = fe.servicex._default_adaptor('http://closing:5000/servicex')
+    sessions = list(a._sessions.values())
+    assert len(sessions) == 1
+    fe.servicex._close_default_adaptors()
+    assert sessions[0].closed
+
+
+@pytest.mark.asyncio
+async def test_cache_off_event_loop(good_transform_request, reduce_wait_time, files_back_1,
+                                    clean_query_cache, mocker):
+    'Pickling and unpickling a large result must not hold up the event loop'
+    main_thread = threading.current_thread()
+    threads = []
+    for name in ['lookup', 'save']:
+        original = getattr(clean_query_cache, name)
+
+        def record(*args, original=original):
+            threads.append(threading.current_thread())
+            return original(*args)
+
+        mocker.patch.object(clean_query_cache, name, side_effect=record)
+
+    await fe.get_data_async('(valid qastle string)', 'one_ds')
+    r = await fe.get_data_async('(valid qastle string)', 'one_ds')
+    assert len(r) == 283458
+    assert len(threads) == 3
+    assert main_thread not in threads
+
+
+@pytest.mark.asyncio
+async def test_incremental_saves_only_new_files(good_transform_request, reduce_wait_time, mocker,
+                                                clean_incremental_results):
+    'A refresh writes the new file and the list of files - not the files it already had'
+    listing = mocker.patch('minio.api.Minio.list_objects_v2', return_value=[make_minio_file('file1')])
+    mocker.patch('minio.api.Minio.fget_object', side_effect=good_copy)
+    await fe.get_data_async('(valid qastle string)', 'one_ds', incremental=True)
+
+    save = mocker.spy(clean_incremental_results, 'save')
+    listing.return_value = [make_minio_file('file1'), make_minio_file('file2')]
+    r = await fe.get_data_async('(valid qastle string)', 'one_ds', incremental=True)
+    assert len(r) == 283458*2
+
+    key = fe.servicex.query_cache_key(fe.servicex._build_json_query('(valid qastle string)', 'one_ds',
+                                                                    'sslhep/servicex_xaod_cpp_transformer:v0.2'),
+                                      'pandas')
+    saved = sorted(c[0][0] for c in save.call_args_list)
+    assert saved == sorted([key, fe.servicex._incremental_file_key(key, 'file2')])
+    assert clean_incremental_results.lookup(key) == ['file1', 'file2']
+
+
+@pytest.mark.asyncio
+async def test_incremental_file_evicted(good_transform_request, reduce_wait_time, mocker,
+                                        clean_incremental_results):
+    'A file that was evicted from the store is fetched again'
+    mocker.patch('minio.api.Minio.list_objects_v2',
+                 return_value=[make_minio_file('file1'), make_minio_file('file2')])
+    copy = mocker.patch('minio.api.Minio.fget_object', side_effect=good_copy)
+    await fe.get_data_async('(valid qastle string)', 'one_ds', incremental=True)
+
+    key = fe.servicex.query_cache_key(fe.servicex._build_json_query('(valid qastle string)', 'one_ds',
+                                                                    'sslhep/servicex_xaod_cpp_transformer:v0.2'),
+                                      'pandas')
+    clean_incremental_results.invalidate(fe.servicex._incremental_file_key(key, 'file1'))
+    r = await fe.get_data_async('(valid qastle string)', 'one_ds', incremental=True)
+    assert len(r) == 283458*2
+    assert copy.call_count == 3
+    assert copy.call_args[0][1] == 'file1'
+
+
+@pytest.mark.asyncio
+async def test_decode_processes_not_forked(good_transform_request, reduce_wait_time, files_back_1, mocker):
+    'Forking a process with threads running can deadlock, so the workers are started fresh'
+    mocker.patch('servicex.servicex.servicex_decode_processes', 2)
+    await fe.get_data_async('(valid qastle string)', 'one_ds')
+    executor = fe.servicex._decode_process_executors[2]
+    assert executor._mp_context.get_start_method() in ('forkserver', 'spawn')
+
+
+@pytest.mark.asyncio
+async def test_decode_processes_shut_down(good_transform_request, reduce_wait_time, files_back_1, mocker):
+    mocker.patch('servicex.servicex.servicex_decode_processes', 2)
+    await fe.get_data_async('(valid qastle string)', 'one_ds')
+    executor = fe.servicex._decode_process_executors[2]
+    fe.servicex._shutdown_decode_processes()
+    assert fe.servicex._decode_process_executors == {}
+    with pytest.raises(RuntimeError):
+        executor.submit(len, [])
+
+    # A pool is started again if needed
+    r = await fe.get_data_async('(valid qastle string)', 'one_ds', use_cache=False)
+    assert len(r) == 283458
+
 # TODO:
 # Other tests
 #  Loose connection for a while after we submit the request
@@ -0,0 +1,183 @@
+import asyncio
+
+import pytest
+
+from servicex.servicex_adaptor import PollSchedule, ServiceXAdaptor, StatusTracker
+
+
+def test_poll_starts_fast():
+    p = PollSchedule(0.5, 5.0)
+    assert p.delay == 0.5
+
+
+def test_poll_backs_off():
+    p = PollSchedule(0.5, 5.0, backoff=2.0)
+    p.update(False)
+    assert p.delay == 1.0
+    p.update(False)
+    assert p.delay == 2.0
+
+
+def test_poll_backoff_limited():
+    p = PollSchedule(0.5, 5.0, backoff=2.0)
+    for _ in range(10):
+        p.update(False)
+    assert p.delay == 5.0
+
+
+def test_poll_snaps_back():
+    p = PollSchedule(0.5, 5.0, backoff=2.0)
+    for _ in range(10):
+        p.update(False)
+    p.update(True)
+    assert p.delay == 0.5
+
+
+def test_poll_min_above_max():
+    p = PollSchedule(0.5, 0.01)
+    assert p.delay == 0.01
+
+
+def test_adaptor_default_minio():
+    a = ServiceXAdaptor('http://servicex.org:5000/servicex')
+    assert a.endpoint == 'http://servicex.org:5000/servicex'
+    assert a.minio_client._endpoint_url == 'http://servicex.org:9000'
+
+
+def test_adaptor_minio_config():
+    a = ServiceXAdaptor('http://servicex.org:5000/servicex', minio_endpoint='minio.org:1234',
+                        minio_access_key='me', minio_secret_key='secret', minio_secure=True,
+                        pool_size=12)
+    assert a.minio_client._endpoint_url == 'https://minio.org:1234'
+    assert a.minio_client._http.connection_pool_kw['maxsize'] == 12
+
+
+@pytest.mark.asyncio
+async def test_adaptor_session_reused():
+    a = ServiceXAdaptor(pool_size=12)
+    s1 = a.session()
+    s2 = a.session()
+    assert s1 is s2
+    assert s1.connector.limit == 12
+    await a.close_async()
+    assert s1.closed
+
+
+@pytest.mark.asyncio
+async def test_adaptor_session_after_close():
+    a = ServiceXAdaptor()
+    s1 = a.session()
+    await a.close_async()
+    s2 = a.session()
+    assert s1 is not s2
+    assert not s2.closed
+    await a.close_async()
+
+
+@pytest.mark.asyncio
+async def test_adaptor_async_context_manager():
+    async with ServiceXAdaptor() as a:
+        s1 = a.session()
+    assert s1.closed
+
+
+def test_adaptor_close_other_loop():
+    'A sync close closes sessions on a loop running on another thread'
+    import servicex.servicex as sx
+    a = ServiceXAdaptor()
+
+    async def make_session():
+        return a.session()
+
+    s1 = sx._run_sync(make_session())
+    with a:
+        pass
+    assert s1.closed
+    assert len(a._sessions) == 0
+
+
+class status_fetcher:
+    'Stand-in for fetching the status of a transform, that records what it is asked for'
+    def __init__(self, delays=None, errors=()):
+        self.calls = []
+        self.running = 0
+        self.max_running = 0
+        self._delays = delays or {}
+        self._errors = errors
+
+    async def __call__(self, request_id):
+        self.calls.append(request_id)
+        self.running += 1
+        self.max_running = max(self.max_running, self.running)
+        try:
+            await asyncio.sleep(self._delays.get(request_id, 0.01))
+            if request_id in self._errors:
+                raise BaseException(f'No status for {request_id}')
+            return 0, len(self.calls)
+        finally:
+            self.running -= 1
+
+
+@pytest.mark.asyncio
+async def test_tracker_many_transforms():
+    fetch = status_fetcher()
+    t = StatusTracker(fetch, max_concurrent=4)
+    r = await asyncio.gather(*[t.wait_for_status(f'r{i}', 0.05) for i in range(20)])
+    assert len(r) == 20
+    assert sorted(fetch.calls) == sorted(f'r{i}' for i in range(20))
+    assert 1 < fetch.max_running <= 4
+    assert t.request_ids == []
+
+
+@pytest.mark.asyncio
+async def test_tracker_same_transform_shared():
+    fetch = status_fetcher()
+    t = StatusTracker(fetch)
+    r = await asyncio.gather(*[t.wait_for_status('r1', 0.05) for _ in range(5)])
+    assert fetch.calls == ['r1']
+    assert r == [(0, 1)] * 5
+
+
+@pytest.mark.asyncio
+async def test_tracker_waits_for_delay():
+    fetch = status_fetcher()
+    t = StatusTracker(fetch, batch_window=0.0)
+    loop = asyncio.get_event_loop()
+    start = loop.time()
+    await t.wait_for_status('r1', 0.2)
+    assert loop.time() - start >= 0.2
+
+
+@pytest.mark.asyncio
+async def test_tracker_separate_delays():
+    'Waits that come due at different times get their own requests'
+    fetch = status_fetcher()
+    t = StatusTracker(fetch, batch_window=0.0)
+    await asyncio.gather(t.wait_for_status('r1', 0.0), t.wait_for_status('r1', 0.3))
+    assert fetch.calls == ['r1', 'r1']
+
+
+@pytest.mark.asyncio
+async def test_tracker_slow_transform_does_not_block():
+    fetch = status_fetcher(delays={'slow': 10.0})
+    t = StatusTracker(fetch)
+    slow = asyncio.ensure_future(t.wait_for_status('slow', 0.0))
+    r = await asyncio.wait_for(t.wait_for_status('fast', 0.0), 1.0)
+    assert r == (0, 2)
+    assert not slow.done()
+    slow.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await slow
+    await asyncio.sleep(0.01)
+    assert fetch.running == 0
+    assert t.request_ids == []
+
+
+@pytest.mark.asyncio
+async def test_tracker_error_only_for_its_transform():
+    fetch = status_fetcher(errors=('bad',))
+    t = StatusTracker(fetch)
+    bad, good = await asyncio.gather(t.wait_for_status('bad', 0.0), t.wait_for_status('good', 0.0),
+                                     return_exceptions=True)
+    assert isinstance(bad, BaseException) and 'bad' in str(bad)
+    assert good[0] == 0
@@ -0,0 +1,166 @@
+import os
+import shutil
+
+import awkward
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pytest
+
+from servicex.shared_cache import SharedFileCache
+
+
+@pytest.fixture()
+def cache(tmp_path):
+    return SharedFileCache(str(tmp_path / 'shared'))
+
+
+def test_lookup_missing(cache):
+    assert cache.lookup('key', 'file1') is None
+    assert cache.misses == 1
+
+
+def test_save_lookup_pandas(cache):
+    df = pd.DataFrame({'JetPt': np.arange(10.0)})
+    assert cache.save('key', 'file1', df)
+    r = cache.lookup('key', 'file1')
+    pd.testing.assert_frame_equal(r, df)
+    assert cache.hits == 1
+
+
+def test_save_lookup_awkward(cache):
+    data = {b'JetPt': awkward.JaggedArray.fromcounts([2, 0, 1], [1.0, 2.0, 3.0])}
+    assert cache.save('key', 'file1', data)
+    r = cache.lookup('key', 'file1')
+    assert list(r.keys()) == [b'JetPt']
+    assert r[b'JetPt'].tolist() == data[b'JetPt'].tolist()
+
+
+def test_save_lookup_arrow(cache):
+    t = pa.table({'JetPt': np.arange(10.0)})
+    assert cache.save('key', 'file1', t)
+    assert cache.lookup('key', 'file1').equals(t)
+
+
+def test_lookup_is_copy_on_write(cache):
+    cache.save('key', 'file1', pd.DataFrame({'JetPt': np.arange(10.0)}))
+    r = cache.lookup('key', 'file1')
+    r['JetPt'].values[0] = 100.0
+    assert cache.lookup('key', 'file1')['JetPt'][0] == 0.0
+
+
+def test_keys_and_files_separate(cache):
+    cache.save('key1', 'file1', pd.DataFrame({'a': [1.0]}))
+    cache.save('key2', 'file1', pd.DataFrame({'a': [2.0]}))
+    cache.save('key1', 'file2', pd.DataFrame({'a': [3.0]}))
+    assert cache.lookup('key1', 'file1')['a'][0] == 1.0
+    assert cache.lookup('key2', 'file1')['a'][0] == 2.0
+    assert cache.lookup('key1', 'file2')['a'][0] == 3.0
+
+
+def test_save_twice(cache):
+    'The first copy saved wins'
+    assert cache.save('key', 'file1', pd.DataFrame({'a': [1.0]}))
+    assert not cache.save('key', 'file1', pd.DataFrame({'a': [2.0]}))
+    assert cache.lookup('key', 'file1')['a'][0] == 1.0
+    assert [n for n in os.listdir(os.path.join(cache.path, 'key')) if n.startswith('.tmp')] == []
+
+
+def test_save_not_columnar(cache):
+    assert not cache.save('key', 'file1', pd.DataFrame({'a': ['hi']}))
+    assert cache.lookup('key', 'file1') is None
+
+
+def test_lookup_damaged(cache):
+    cache.save('key', 'file1', pd.DataFrame({'a': [1.0]}))
+    entry = [n for n in os.listdir(os.path.join(cache.path, 'key')) if not n.endswith('.lock')][0]
+    with open(os.path.join(cache.path, 'key', entry, 'contents.json'), 'w') as f:
+        f.write('{bad')
+    assert cache.lookup('key', 'file1') is None
+
+
+def test_lock(cache):
+    lock = cache.try_lock('key', 'file1')
+    assert lock is not None
+    assert cache.try_lock('key', 'file1') is None
+    other = cache.try_lock('key', 'file2')
+    assert other is not None
+    lock.release()
+    other.release()
+    again = cache.try_lock('key', 'file1')
+    assert again is not None
+    again.release()
+
+
+def test_objects(cache):
+    assert cache.objects('key') is None
+    cache.save_objects('key', ['file1', 'file2'])
+    assert cache.objects('key') == ['file1', 'file2']
+
+
+def test_invalidate(cache):
+    cache.save('key1', 'file1', pd.DataFrame({'a': [1.0]}))
+    cache.save('key2', 'file1', pd.DataFrame({'a': [1.0]}))
+    cache.save_objects('key1', ['file1'])
+    cache.invalidate('key1')
+    assert cache.lookup('key1', 'file1') is None
+    assert cache.objects('key1') is None
+    assert cache.lookup('key2', 'file1') is not None
+    cache.invalidate()
+    assert cache.lookup('key2', 'file1') is None
+
+
+def test_evict(tmp_path):
+    cache = SharedFileCache(str(tmp_path / 'shared'), max_size=12000)
+    for i in range(3):
+        cache.save('key', f'file{i}', pd.DataFrame({'a': np.zeros(1000)}))
+        entry = cache._entry_dir('key', f'file{i}')
+        os.utime(os.path.join(entry, 'last-used'), (i, i))
+    cache.save('key', 'file3', pd.DataFrame({'a': np.zeros(1000)}))
+    assert cache.lookup('key', 'file0') is None
+    assert cache.lookup('key', 'file3') is not None
+    assert cache.size <= 12000
+
+
+@pytest.mark.skipif(not hasattr(os, 'getuid'), reason='No file modes on this platform')
+def test_entries_usable_by_others(cache):
+    'Whatever the umask, other users can read an entry, mark it as used, and evict it'
+    old_umask = os.umask(0o077)
+    try:
+        cache.save('key', 'file1', pd.DataFrame({'a': [1.0]}))
+    finally:
+        os.umask(old_umask)
+    entry = cache._entry_dir('key', 'file1')
+    assert os.stat(entry).st_mode & 0o777 == 0o777
+    assert os.stat(os.path.join(entry, 'last-used')).st_mode & 0o777 == 0o666
+    for name in os.listdir(entry):
+        assert os.stat(os.path.join(entry, name)).st_mode & 0o044 == 0o044
+
+
+def test_lookup_marks_used(cache):
+    cache.save('key', 'file1', pd.DataFrame({'a': [1.0]}))
+    last_used = os.path.join(cache._entry_dir('key', 'file1'), 'last-used')
+    os.utime(last_used, (1, 1))
+    assert cache.lookup('key', 'file1') is not None
+    assert os.stat(last_used).st_mtime > 1
+
+
+def test_evict_not_removable(tmp_path, mocker):
+    'An entry that can not be removed does not count as freed space'
+    cache = SharedFileCache(str(tmp_path / 'shared'))
+    for i in range(3):
+        cache.save('key', f'file{i}', pd.DataFrame({'a': np.zeros(1000)}))
+        entry = cache._entry_dir('key', f'file{i}')
+        os.utime(os.path.join(entry, 'last-used'), (i, i))
+
+    # Room for two entries - the one that can't be removed, and the new one
+    cache.max_size = 20000
+    stuck = cache._entry_dir('key', 'file0')
+    rmtree = shutil.rmtree
+    mocker.patch('shutil.rmtree',
+                 side_effect=lambda p, ignore_errors=False: None if p == stuck else rmtree(p))
+    cache.save('key', 'file3', pd.DataFrame({'a': np.zeros(1000)}))
+    assert cache.lookup('key', 'file0') is not None
+    assert cache.lookup('key', 'file1') is None
+    assert cache.lookup('key', 'file2') is None
+    assert cache.lookup('key', 'file3') is not None
@@ -0,0 +1,56 @@
+from servicex.sizing import choose_transform_size, TransformHistory, TransformSize
+
+default = TransformSize(5, 1000, 5)
+
+
+def test_nothing_known():
+    s = choose_transform_size(None, None, default, 100, 20)
+    assert (s.workers, s.chunk_size, s.download_concurrency) == (5, 1000, 5)
+
+
+def test_one_worker_per_file():
+    s = choose_transform_size(10 * 1024 * 1024, 2, default, 100, 20)
+    assert s.workers == 2
+    assert s.chunk_size == 1000
+    assert s.download_concurrency == 5
+
+
+def test_workers_limited():
+    s = choose_transform_size(None, 5000, default, 100, 20)
+    assert s.workers == 100
+    assert s.download_concurrency == 20
+
+
+def test_workers_from_size():
+    s = choose_transform_size(10 * 1024 ** 3, None, default, 100, 20)
+    assert s.workers == 40
+    assert s.download_concurrency == 20
+    tiny = choose_transform_size(1000, None, default, 100, 20)
+    assert tiny.workers == 1
+
+
+def test_large_files_larger_chunks():
+    s = choose_transform_size(10 * 100 * 1024 * 1024, 10, default, 100, 20)
+    assert s.chunk_size == 10000
+
+
+def test_history_empty(tmp_path):
+    h = TransformHistory(str(tmp_path))
+    assert h.lookup({'did': 'ds', 'selection': 'q'}) is None
+
+
+def test_history_same_query(tmp_path):
+    h = TransformHistory(str(tmp_path))
+    h.record({'did': 'ds', 'selection': 'q'}, 10, 1000)
+    r = h.lookup({'did': 'ds', 'selection': 'q'})
+    assert (r['files'], r['size']) == (10, 1000)
+
+
+def test_history_same_dataset(tmp_path):
+    'A query that has not been run uses what the last query on the dataset produced'
+    h = TransformHistory(str(tmp_path))
+    h.record({'did': 'ds', 'selection': 'q1'}, 10, 1000)
+    h.record({'did': 'ds', 'selection': 'q2'}, 3, 500)
+    assert h.lookup({'did': 'ds', 'selection': 'q1'})['files'] == 10
+    assert h.lookup({'did': 'ds', 'selection': 'q3'})['files'] == 3
+    assert h.lookup({'did': 'other', 'selection': 'q1'}) is None
@@ -0,0 +1,63 @@
+import awkward
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pytest
+
+from servicex.spill import data_size, spill
+
+
+def test_data_size():
+    df = pd.DataFrame({'a': np.zeros(100)})
+    assert data_size(df) >= 800
+    assert data_size({b'a': np.zeros(100), b'b': np.zeros(100)}) == 1600
+    assert data_size(pa.table({'a': np.zeros(100)})) == 800
+
+
+@pytest.mark.parametrize('in_memory', [True, False])
+def test_spill_pandas(tmp_path, in_memory):
+    df = pd.DataFrame({'a': np.arange(10.0), 'b': np.arange(10)})
+    s = spill(df, str(tmp_path), '0')
+    pd.testing.assert_frame_equal(s.load(in_memory), df)
+
+
+def test_spill_pandas_multi_index(tmp_path):
+    index = pd.MultiIndex.from_arrays([[0, 0, 1], [0, 1, 0]], names=['entry', 'subentry'])
+    df = pd.DataFrame({'JetPt': [1.0, 2.0, 3.0]}, index=index)
+    s = spill(df, str(tmp_path), '0')
+    pd.testing.assert_frame_equal(s.load(), df)
+
+
+def test_spill_pandas_memory_mapped(tmp_path):
+    df = pd.DataFrame({'a': np.arange(10.0)})
+    r = spill(df, str(tmp_path), '0').load()
+    assert not r['a'].values.flags.owndata
+
+
+def test_spill_pandas_objects_not_spilled(tmp_path):
+    df = pd.DataFrame({'a': ['hi', 'there']})
+    assert spill(df, str(tmp_path), '0') is None
+
+
+def test_spill_pandas_unnamed_index_not_spilled(tmp_path):
+    df = pd.DataFrame({'a': [1.0, 2.0]}, index=[5, 6])
+    assert spill(df, str(tmp_path), '0') is None
+
+
+@pytest.mark.parametrize('in_memory', [True, False])
+def test_spill_awkward(tmp_path, in_memory):
+    data = {b'n': np.arange(3),
+            b'jets': awkward.JaggedArray.fromcounts([2, 0, 1], [1.0, 2.0, 3.0])}
+    r = spill(data, str(tmp_path), '0').load(in_memory)
+    assert (r[b'n'] == data[b'n']).all()
+    assert r[b'jets'].tolist() == data[b'jets'].tolist()
+
+
+@pytest.mark.parametrize('in_memory', [True, False])
+def test_spill_arrow(tmp_path, in_memory):
+    t = pa.table({'a': np.arange(10.0)})
+    assert spill(t, str(tmp_path), '0').load(in_memory).equals(t)
+
+
+def test_spill_unknown(tmp_path):
+    assert spill([1, 2, 3], str(tmp_path), '0') is None